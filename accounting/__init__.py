@@ -1,14 +1,18 @@
 #You will need to pip install flask and the sqlalchemy extension for flask.
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
+from database import AccountingSQLAlchemy
 
 # Initialize the application.
 app = Flask(__name__)
 app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+db = AccountingSQLAlchemy(app)
 
 # Import the views file for view routing.
 import views
 
 # Import the endpoints file for end point routing.
-import endpoints
\ No newline at end of file
+import endpoints
+
+# Gzip responses, and serve static files fingerprinted and precompressed.
+import compression
+import assets
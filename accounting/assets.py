@@ -0,0 +1,165 @@
+import hashlib
+import mimetypes
+import os
+import re
+import time
+from datetime import datetime
+
+from flask import Response, request
+
+from accounting import app
+from compression import accepts_gzip, gzip_bytes
+
+"""
+#######################################################
+Fingerprinted and precompressed static files.
+#######################################################
+"""
+
+# A static file name with a hash of its content before the extension, e.g.
+# js/app.3f2a9c1b0d4e.js
+_FINGERPRINTED = re.compile(r'^(.+)\.([0-9a-f]{12})(\.[^./]+)$')
+
+
+class StaticAsset(object):
+    """
+     A file of the static folder: its name, the hash of its content, its
+     modification time and its gzipped content, or None if gzip does not
+     make it smaller.
+    """
+    def __init__(self, filename, digest, mtime, gzipped):
+        self.filename = filename
+        self.digest = digest
+        self.mtime = mtime
+        self.gzipped = gzipped
+        self.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    @property
+    def fingerprinted(self):
+        """
+        The file's name with its hash before the extension.
+        """
+        root, extension = os.path.splitext(self.filename)
+        return '{}.{}{}'.format(root, self.digest, extension)
+
+
+class StaticAssets(object):
+    """
+     Serves the static folder with content-hashed file names and
+     precompressed copies of its files.
+
+     url_for('static', filename=...) links to the file's fingerprinted
+     name, e.g. js/app.3f2a9c1b0d4e.js, which is served with far-future
+     cache headers (STATIC_MAX_AGE seconds): a changed file gets a new
+     name, so browsers can keep each copy without ever checking back.
+     Names without a hash, or with the hash of another version of the
+     file, are served as Flask serves static files.
+
+     Files which gzip makes at least a tenth smaller are compressed once,
+     at the highest level, and that copy is sent to clients accepting
+     gzip.  build() hashes and compresses the whole folder.  runserver.py
+     calls it at startup, and otherwise the first link or request does.  In
+     debug mode, files changed since are picked up on their next use.
+    """
+    def __init__(self, app=None):
+        self.app = None
+        self.max_age = 31536000
+        self._assets = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STATIC_MAX_AGE', 31536000)
+        self.app = app
+        self.max_age = app.config['STATIC_MAX_AGE']
+        app.url_defaults(self._fingerprint)
+        app.view_functions['static'] = self.send_static_file
+
+    def _load(self, filename):
+        path = os.path.join(self.app.static_folder, *filename.split('/'))
+        with open(path, 'rb') as f:
+            data = f.read()
+        gzipped = gzip_bytes(data, 9)
+        if len(gzipped) > len(data) * 0.9:
+            gzipped = None
+        return StaticAsset(filename,
+                           hashlib.md5(data).hexdigest()[:12],
+                           datetime.utcfromtimestamp(int(os.path.getmtime(path))),
+                           gzipped)
+
+    def build(self):
+        """
+        Hashes and compresses every file of the static folder, and returns
+        how many there are.
+        """
+        assets = {}
+        root = self.app.static_folder
+        for directory, _, files in os.walk(root):
+            for name in files:
+                filename = os.path.relpath(os.path.join(directory, name), root)
+                filename = filename.replace(os.sep, '/')
+                assets[filename] = self._load(filename)
+        self._assets = assets
+        return len(assets)
+
+    def get(self, filename):
+        """
+        Returns the StaticAsset for filename, or None if there is no such
+        file in the static folder.
+        """
+        if self._assets is None:
+            self.build()
+        asset = self._assets.get(filename)
+        if asset is not None and self.app.debug:
+            path = os.path.join(self.app.static_folder, *filename.split('/'))
+            if not os.path.exists(path):
+                return None
+            if datetime.utcfromtimestamp(int(os.path.getmtime(path))) != asset.mtime:
+                asset = self._assets[filename] = self._load(filename)
+        return asset
+
+    def _fingerprint(self, endpoint, values):
+        if endpoint != 'static' or 'filename' not in values:
+            return
+        asset = self.get(values['filename'])
+        if asset is not None:
+            values['filename'] = asset.fingerprinted
+
+    def send_static_file(self, filename):
+        """
+        The static view: serves filename, by its name or its fingerprinted
+        name, gzipped if it was compressed and the client accepts it.
+        """
+        immutable = False
+        match = _FINGERPRINTED.match(filename)
+        if match is not None:
+            original = match.group(1) + match.group(3)
+            asset = self.get(original)
+            if asset is not None:
+                # A stale hash, e.g. from a page rendered before a deploy,
+                # still gets the current file, but not for keeps.
+                immutable = asset.digest == match.group(2)
+                filename = original
+        asset = self.get(filename)
+
+        if asset is not None and asset.gzipped is not None and accepts_gzip():
+            response = Response(asset.gzipped, mimetype=asset.mimetype)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(asset.digest, weak=True)
+            response.last_modified = asset.mtime
+            response.cache_control.public = True
+            response.cache_control.max_age = self.app.get_send_file_max_age(filename)
+            response.make_conditional(request)
+        else:
+            response = self.app.send_static_file(filename)
+
+        if asset is not None and asset.gzipped is not None:
+            response.vary.add('Accept-Encoding')
+        if immutable:
+            response.headers['Cache-Control'] = 'public, max-age={:d}, immutable'.format(
+                self.max_age)
+            response.expires = int(time.time() + self.max_age)
+        return response
+
+
+static_assets = StaticAssets(app)
@@ -0,0 +1,253 @@
+import multiprocessing
+import time
+import traceback
+from datetime import datetime
+
+from accounting import app, db
+from cache import policy_cache
+from models import Invoice, Policy
+from payment_queue import payment_queue
+from utils import bulk_make_invoices, evaluate_schedule, find_cancellations, find_scheduled, \
+    pending_cancellation_due_to_non_pay, save_schedule, scheduled_pending, touch_policies
+
+"""
+#######################################################
+Nightly billing run, sharded over worker processes.
+#######################################################
+"""
+
+# Lock held by a worker while it writes, shared by every worker of a run.
+# SQLite takes a single writer at a time, so writes are queued here rather
+# than failing with "database is locked" once the busy timeout runs out.
+_write_lock = None
+
+
+class NightlyReport(object):
+    """
+     Combined outcome of a nightly run.  invoiced counts the invoices
+     generated for the policies listed in invoiced_policies, which had
+     none before the run, and evaluated the policies whose cancellation
+     status was evaluated.  pending lists the ids of the
+     policies with a past due invoice and cancelled a (policy_id, date)
+     tuple for every cancellation recorded.  errors lists a
+     ((low, high), message) tuple for every shard which failed.  flushed
+     counts the queued payments recorded before the run.
+    """
+    def __init__(self, date_cursor):
+        self.date_cursor = date_cursor
+        self.shards = 0
+        self.policies = 0
+        self.invoiced = 0
+        self.invoiced_policies = []
+        self.evaluated = 0
+        self.pending = []
+        self.cancelled = []
+        self.errors = []
+        self.flushed = 0
+        self.elapsed = 0.0
+        # Time spent by the workers, summed over every shard
+        self.work_time = 0.0
+
+    def add(self, result):
+        """
+        Merges the result of one shard into the report.
+        """
+        self.shards += 1
+        self.policies += result['policies']
+        self.invoiced += result['invoiced']
+        self.invoiced_policies.extend(result['invoiced_policies'])
+        self.evaluated += result['evaluated']
+        self.pending.extend(result['pending'])
+        self.cancelled.extend(result['cancelled'])
+        self.work_time += result['elapsed']
+        if result['error'] is not None:
+            self.errors.append((result['range'], result['error']))
+
+    @property
+    def parallelism(self):
+        """
+        Work time over wall clock time: how many shards were being worked
+        on at once on average.  Compare elapsed across worker counts to
+        measure the speedup itself.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.work_time / self.elapsed
+
+    def __repr__(self):
+        return "<NightlyReport policies={} invoiced={} evaluated={} pending={} cancelled={} errors={}>".format(
+            self.policies, self.invoiced, self.evaluated, len(self.pending), len(self.cancelled),
+            len(self.errors))
+
+
+def policy_id_ranges(shards, low=None, high=None):
+    """
+    Splits the policy ids between low (included) and high (excluded), or
+    all of them, into at most shards (low, high) ranges of the same width.
+    """
+    query = db.session.query(db.func.min(Policy.id), db.func.max(Policy.id))
+    if low is not None:
+        query = query.filter(Policy.id >= low)
+    if high is not None:
+        query = query.filter(Policy.id < high)
+    first, last = query.one()
+    if first is None:
+        return []
+
+    width = max(1, -(-(last + 1 - first) // shards))
+    return [(start, min(start + width, last + 1))
+            for start in range(first, last + 1, width)]
+
+
+def _init_worker(lock):
+    global _write_lock
+    _write_lock = lock
+    # Connections must not be shared with the parent process, so the worker
+    # starts from an empty pool and opens its own.
+    db.session.remove()
+    db.get_engine(app).dispose()
+    policy_cache.clear()
+
+
+def run_shard(id_range, date_cursor, batch_size=500, incremental=False):
+    """
+    Runs the nightly work for the policies whose ids are in the
+    (low, high) id_range and returns its result as a dict:
+
+    - invoices are generated for the policies which have none, as
+      PolicyAccounting does when it is first built for a policy;
+    - the policies with a past due invoice are listed;
+    - the policies which should be cancelled are cancelled.
+
+    If incremental, only the policies due for it in the cancellation
+    schedule are evaluated, and the schedule is updated.  The reads run in
+    parallel with the other shards, only the writes are made while holding
+    the write lock.
+    """
+    low, high = id_range
+    result = {'range': id_range, 'policies': 0, 'invoiced': 0, 'invoiced_policies': [],
+              'evaluated': 0, 'pending': [], 'cancelled': [], 'error': None}
+    start = time.time()
+    try:
+        policies = db.session.query(Policy.id, Policy.effective_date,
+                                    Policy.billing_schedule, Policy.annual_premium)\
+                             .filter(Policy.id >= low)\
+                             .filter(Policy.id < high)\
+                             .order_by(Policy.id)\
+                             .all()
+        policy_ids = [policy.id for policy in policies]
+        result['policies'] = len(policy_ids)
+
+        invoiced = set(
+            row.policy_id for row in
+            db.session.query(Invoice.policy_id)
+                      .filter(Invoice.policy_id >= low)
+                      .filter(Invoice.policy_id < high)
+                      .distinct()
+        )
+        uninvoiced = [tuple(policy) for policy in policies if policy.id not in invoiced]
+        if uninvoiced:
+            with _write_lock:
+                result['invoiced'] = bulk_make_invoices(uninvoiced)
+            result['invoiced_policies'] = [policy[0] for policy in uninvoiced]
+
+        if incremental:
+            scheduled = find_scheduled(date_cursor, low, high)
+            cancellations, entries = evaluate_schedule(scheduled, date_cursor, batch_size)
+            if entries:
+                with _write_lock:
+                    save_schedule(cancellations, entries)
+            result['evaluated'] = len(entries)
+            result['pending'] = sorted(scheduled_pending(low, high))
+        else:
+            result['evaluated'] = len(policy_ids)
+            result['pending'] = sorted(
+                pending_cancellation_due_to_non_pay(policy_ids, date_cursor, batch_size))
+
+            cancellations = find_cancellations(policy_ids, date_cursor, batch_size)
+            if cancellations:
+                with _write_lock:
+                    for cancellation in cancellations:
+                        db.session.add(cancellation)
+                    touch_policies([c.policy_id for c in cancellations])
+                    db.session.commit()
+        result['cancelled'] = [(c.policy_id, c.date) for c in cancellations]
+    except Exception:
+        db.session.rollback()
+        result['error'] = traceback.format_exc()
+    finally:
+        db.session.remove()
+    result['elapsed'] = time.time() - start
+    return result
+
+
+def _run_shard(args):
+    return run_shard(*args)
+
+
+def run_nightly(date_cursor=None, workers=None, shards=None, low=None, high=None,
+                batch_size=500, incremental=False):
+    """
+    Runs the nightly billing work over the policies with ids between low
+    and high (excluded), or the whole book, and returns a NightlyReport.
+
+    The ids are split into shards ranges, four per worker by default so
+    that workers finishing early pick up more work, and the shards are run
+    by a pool of workers processes, one per CPU by default, each with its
+    own database connections.  With a single worker everything runs in
+    this process.
+
+    With incremental, cancellations are only evaluated for the policies
+    whose data changed or which reached a due or cancel date since the
+    previous incremental run (see utils.run_cancellation_schedule).
+
+    Payments waiting in the payment queue are flushed first: they were
+    already accepted, so they have to count before any policy is found
+    past due or cancelled for non-payment.
+    """
+    global _write_lock
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    if not shards:
+        shards = workers * 4
+
+    report = NightlyReport(date_cursor)
+    start = time.time()
+    report.flushed = payment_queue.flush_all()
+    ranges = policy_id_ranges(shards, low, high)
+    tasks = [(id_range, date_cursor, batch_size, incremental) for id_range in ranges]
+
+    # Hand every connection back and close them before forking, so no
+    # SQLite connection is inherited by the workers.
+    db.session.commit()
+    db.get_engine(app).dispose()
+
+    lock = multiprocessing.Lock()
+    if workers == 1:
+        _write_lock = lock
+        results = map(_run_shard, tasks)
+    else:
+        pool = multiprocessing.Pool(workers, _init_worker, (lock,))
+        try:
+            results = list(pool.imap_unordered(_run_shard, tasks))
+        finally:
+            pool.close()
+            pool.join()
+
+    for result in results:
+        report.add(result)
+    report.invoiced_policies.sort()
+    report.pending.sort()
+    report.cancelled.sort()
+    report.elapsed = time.time() - start
+
+    # The workers' caches went away with them, this process' cache may
+    # still hold entries for the policies they changed.
+    for policy_id in report.invoiced_policies:
+        policy_cache.invalidate(policy_id)
+    for policy_id, _ in report.cancelled:
+        policy_cache.invalidate(policy_id)
+
+    return report
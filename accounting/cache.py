@@ -0,0 +1,134 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from accounting import app
+
+"""
+#######################################################
+In-process cache of per-policy data.
+#######################################################
+"""
+
+class PolicyCache(object):
+    """
+     A least-recently-used cache of values computed for a policy as of a
+     date, e.g. its balance or its serialized invoices.  Entries are keyed
+     by (kind, policy_id, as_of_date) and expire after ttl seconds.  At most
+     max_size entries are kept, the least recently used being evicted first.
+     String values, e.g. serialized listings, are also bounded in bytes: at
+     most max_bytes are held in all, and a value longer than
+     max_entry_bytes is not cached at all.
+
+     Anything that changes a policy's invoices, payments or cancellation
+     must call invalidate(policy_id).  The cache lives in one process, so
+     writes made by other processes are only picked up once entries expire.
+
+     To fill an entry, take token(policy_id) before reading the data and
+     pass it to set(); the value is then dropped if the policy was
+     invalidated in the meantime, as it may be stale.
+    """
+    def __init__(self, max_size=10000, ttl=300, max_bytes=64 * 1024 * 1024,
+                 max_entry_bytes=1024 * 1024):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Length of the string values held
+        self._bytes = 0
+        # Keys of the entries held for each policy, for invalidation
+        self._policy_keys = {}
+        # Number of times each policy was invalidated
+        self._generations = {}
+        self._lock = Lock()
+
+    def get(self, kind, policy_id, as_of_date):
+        """
+        Returns the cached value, or None if there is no live entry.
+        """
+        key = (kind, policy_id, as_of_date)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            # Re-insert the entry to mark it as the most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def token(self, policy_id):
+        with self._lock:
+            return self._generations.get(policy_id, 0)
+
+    def set(self, kind, policy_id, as_of_date, value, token=None):
+        size = len(value) if isinstance(value, basestring) else 0
+        if self.max_size <= 0 or size > self.max_entry_bytes:
+            return
+        key = (kind, policy_id, as_of_date)
+        with self._lock:
+            if token is not None and token != self._generations.get(policy_id, 0):
+                return
+            self._drop(key)
+            self._entries[key] = (time.time() + self.ttl, value, size)
+            self._bytes += size
+            self._policy_keys.setdefault(policy_id, set()).add(key)
+            while len(self._entries) > self.max_size or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, policy_id):
+        """
+        Drops every entry held for the policy.
+        """
+        with self._lock:
+            self._generations[policy_id] = self._generations.get(policy_id, 0) + 1
+            for key in list(self._policy_keys.get(policy_id, ())):
+                self._drop(key)
+            self._policy_keys.pop(policy_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._policy_keys.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _drop(self, key):
+        # Must be called with the lock held.
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry[2]
+        keys = self._policy_keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._policy_keys[key[1]]
+
+
+policy_cache = PolicyCache(
+    max_size=app.config.get('POLICY_CACHE_SIZE', 10000),
+    ttl=app.config.get('POLICY_CACHE_TTL', 300),
+    max_bytes=app.config.get('POLICY_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+    max_entry_bytes=app.config.get('POLICY_CACHE_MAX_ENTRY_BYTES', 1024 * 1024)
+)
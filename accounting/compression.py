@@ -0,0 +1,123 @@
+import zlib
+
+from flask import request
+
+from accounting import app
+
+"""
+#######################################################
+Gzip compression of responses.
+#######################################################
+"""
+
+def accepts_gzip():
+    """
+    Returns whether the client of the current request accepts gzip encoded
+    responses.
+    """
+    return request.accept_encodings['gzip'] > 0
+
+def _compressor(level):
+    # 16 + MAX_WBITS makes zlib write a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def gzip_bytes(data, level=6):
+    """
+    Returns data gzipped at the given compression level.
+    """
+    compressor = _compressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_stream(chunks, level=6):
+    """
+    Gzips an iterable of chunks, such as a streamed response's body, as it
+    is read.  Each chunk is sent on as soon as it is compressed, so a
+    streamed response still reaches the client as it is produced.
+    """
+    compressor = _compressor(level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # Let a streamed body release what it holds, e.g. the request
+        # context kept by stream_with_context, if the client goes away.
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compression(object):
+    """
+     Gzips the responses of the application whose mimetype is listed in
+     COMPRESS_MIMETYPES, for clients which accept it.
+
+     Bodies smaller than COMPRESS_MIN_SIZE bytes are sent as they are, as
+     compressing them saves less than it costs.  Streamed bodies are
+     compressed chunk by chunk as they are sent, whatever their size.  A
+     compressed response's ETag is made weak, as its bytes differ from the
+     uncompressed response's while the content is the same.
+
+     Files served by send_file, including static files, are left alone:
+     static files are precompressed by StaticAssets (see assets.py).
+    """
+    def __init__(self, app=None):
+        self.enabled = False
+        self.min_size = 1024
+        self.level = 6
+        self.mimetypes = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ENABLED', True)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.config.setdefault('COMPRESS_MIMETYPES', ['application/json', 'text/html'])
+        self.enabled = app.config['COMPRESS_ENABLED']
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.level = app.config['COMPRESS_LEVEL']
+        self.mimetypes = set(app.config['COMPRESS_MIMETYPES'])
+
+        @app.after_request
+        def compress_response(response):
+            return self.compress(response)
+
+    def compress(self, response):
+        """
+        Gzips response, if it should be for the current request, and
+        returns it.
+        """
+        if not self.enabled or response.status_code != 200 \
+                or response.mimetype not in self.mimetypes \
+                or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers:
+            return response
+
+        # Whether the body is compressed depends on the request's
+        # Accept-Encoding, which caches have to know.
+        response.vary.add('Accept-Encoding')
+        if not accepts_gzip():
+            return response
+
+        if response.is_streamed:
+            response.response = gzip_stream(response.response, self.level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.data
+            if len(data) < self.min_size:
+                return response
+            response.data = gzip_bytes(data, self.level)
+        response.headers['Content-Encoding'] = 'gzip'
+
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+compression = Compression(app)
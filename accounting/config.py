@@ -1,3 +1,65 @@
 import os
 
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+
+# Read-only endpoints use their own engine, whose connections cannot write.
+# None points it at SQLALCHEMY_DATABASE_URI.
+SQLALCHEMY_READONLY_DATABASE_URI = None
+
+# Connections kept open per engine, and how many more may be opened under
+# load.  Without a pool size, SQLite connections are not pooled at all.
+SQLALCHEMY_POOL_SIZE = 5
+SQLALCHEMY_MAX_OVERFLOW = 10
+
+# Applied to every new SQLite connection, in order.  WAL lets readers and a
+# writer work at the same time, and a busy writer is waited on for up to
+# busy_timeout milliseconds instead of failing with "database is locked".
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),      # in KiB
+    ('mmap_size', 268435456),    # in bytes
+    ('busy_timeout', 5000),
+]
+
+# Per-policy cache of balances and invoice/payment listings (see cache.py).
+# Entries expire after POLICY_CACHE_TTL seconds; a size of 0 disables it.
+POLICY_CACHE_SIZE = 10000
+POLICY_CACHE_TTL = 300
+# Cached response bodies take at most POLICY_CACHE_MAX_BYTES in all, and
+# bodies longer than POLICY_CACHE_MAX_ENTRY_BYTES are sent without being
+# cached.
+POLICY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+POLICY_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+# Installment dates memoized per (effective date, billing schedule), see
+# BillingCalendar in utils.py; a size of 0 disables it.
+BILLING_CALENDAR_SIZE = 20000
+
+# Count SQL statements, rows and time per request and PolicyAccounting method
+# (see metrics.py).  Costs nothing while off; metrics.enable() turns it on at
+# runtime.
+METRICS_ENABLED = False
+
+# Write-behind mode for payments posted to the web tier (see
+# payment_queue.py): they are queued and acknowledged at once, then flushed
+# to the payments table by a background thread, PAYMENT_QUEUE_BATCH_SIZE at
+# a time every PAYMENT_QUEUE_FLUSH_INTERVAL seconds.  Once
+# PAYMENT_QUEUE_MAX_SIZE payments are waiting, posting one waits up to
+# PAYMENT_QUEUE_TIMEOUT seconds for room before failing with a 503.
+PAYMENT_QUEUE_ENABLED = False
+PAYMENT_QUEUE_MAX_SIZE = 10000
+PAYMENT_QUEUE_BATCH_SIZE = 500
+PAYMENT_QUEUE_FLUSH_INTERVAL = 1.0
+PAYMENT_QUEUE_TIMEOUT = 5.0
+
+# Responses of these types are gzipped for clients accepting it, unless
+# their body is smaller than COMPRESS_MIN_SIZE bytes (see compression.py).
+COMPRESS_ENABLED = True
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+COMPRESS_MIMETYPES = ['application/json', 'text/html', 'text/csv', 'text/plain']
+
+# Static files are linked by names carrying a hash of their content, and
+# served under those names with this max-age in seconds (see assets.py).
+STATIC_MAX_AGE = 31536000
@@ -0,0 +1,146 @@
+import sqlite3
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+import sqlalchemy
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+"""
+#######################################################
+Engine configuration for the accounting database.
+#######################################################
+"""
+
+# Oldest SQLite library the schema and queries work with: policy_search is
+# an FTS5 table with the trigram tokenizer (3.34), and policy versions and
+# the cancellation schedule are upserted with ON CONFLICT ... DO UPDATE
+# (3.24).
+MIN_SQLITE_VERSION = (3, 34, 0)
+
+def check_sqlite_version(version=None):
+    """
+    Raises a RuntimeError if the SQLite library, or version given as a
+    string such as "3.34.1", is older than MIN_SQLITE_VERSION, or if the
+    library was built without FTS5.
+    """
+    if version is None:
+        version = sqlite3.sqlite_version
+    if tuple(int(part) for part in version.split('.')[:3]) < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            "SQLite {} or later is required, Python's sqlite3 module uses SQLite {}".format(
+                '.'.join(map(str, MIN_SQLITE_VERSION)), version))
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute("CREATE VIRTUAL TABLE t USING fts5(x, tokenize = 'trigram')")
+    except sqlite3.OperationalError as e:
+        raise RuntimeError("SQLite must be built with FTS5: {}".format(e))
+    finally:
+        connection.close()
+
+def _pragma_listener(pragmas):
+    """
+    Returns a pool connect listener running PRAGMA name = value for each
+    (name, value) in pragmas on every new DBAPI connection.
+    """
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+    return set_pragmas
+
+
+class AccountingSQLAlchemy(SQLAlchemy):
+    """
+     Flask-SQLAlchemy extension which adds, on top of the stock one:
+
+     - a real connection pool for SQLite file databases when
+       SQLALCHEMY_POOL_SIZE is set, with SQLALCHEMY_MAX_OVERFLOW extra
+       connections;
+     - SQLITE_PRAGMAS, a list of (name, value) pairs applied to every new
+       SQLite connection (journal mode, synchronous, cache size...);
+     - readonly_session, a scoped session for read-only endpoints bound to
+       a separate engine, at SQLALCHEMY_READONLY_DATABASE_URI or the main
+       database, whose connections are query_only;
+     - a check, when the database is SQLite, that the SQLite library is
+       recent enough (see MIN_SQLITE_VERSION).
+    """
+    def __init__(self, app=None, **kwargs):
+        self._tuned_engines = WeakKeyDictionary()
+        self._tuning_lock = Lock()
+        self._readonly_engine = None
+        self._readonly_uri = None
+        self.readonly_session = orm.scoped_session(
+            lambda: orm.Session(bind=self.get_readonly_engine(), autoflush=False)
+        )
+        SQLAlchemy.__init__(self, app, **kwargs)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_MAX_OVERFLOW', None)
+        app.config.setdefault('SQLALCHEMY_READONLY_DATABASE_URI', None)
+        app.config.setdefault('SQLITE_PRAGMAS', [])
+        SQLAlchemy.init_app(self, app)
+        if make_url(app.config['SQLALCHEMY_DATABASE_URI']).drivername == 'sqlite':
+            check_sqlite_version()
+
+        @app.teardown_request
+        def shutdown_readonly_session(exception=None):
+            self.readonly_session.remove()
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        # pysqlite's default pool for file databases takes no size, so a
+        # queue pool is used when one is configured.  Its connections move
+        # between threads, which pysqlite refuses unless told otherwise.
+        if info.drivername == 'sqlite' and options.get('pool_size') \
+                and info.database not in (None, '', ':memory:'):
+            options['poolclass'] = QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+            max_overflow = app.config['SQLALCHEMY_MAX_OVERFLOW']
+            if max_overflow is not None:
+                options['max_overflow'] = max_overflow
+
+    def _tune(self, app, engine, readonly=False):
+        """
+        Hooks the configured pragmas onto engine's new connections.
+        """
+        with self._tuning_lock:
+            if engine in self._tuned_engines:
+                return
+            self._tuned_engines[engine] = True
+        if engine.dialect.name != 'sqlite':
+            return
+        pragmas = list(app.config['SQLITE_PRAGMAS'])
+        if readonly:
+            pragmas.append(('query_only', 1))
+        if pragmas:
+            event.listen(engine, 'connect', _pragma_listener(pragmas))
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        self._tune(app, engine)
+        return engine
+
+    def get_readonly_engine(self):
+        """
+        Returns the engine behind readonly_session, creating it the same
+        way as the main engine the first time and whenever the configured
+        URI changes.
+        """
+        app = self.get_app()
+        uri = app.config['SQLALCHEMY_READONLY_DATABASE_URI'] \
+            or app.config['SQLALCHEMY_DATABASE_URI']
+        with self._tuning_lock:
+            if self._readonly_uri != uri:
+                info = make_url(uri)
+                options = {'convert_unicode': True}
+                self.apply_pool_defaults(app, options)
+                self.apply_driver_hacks(app, info, options)
+                self._readonly_engine = sqlalchemy.create_engine(info, **options)
+                self._readonly_uri = uri
+            engine = self._readonly_engine
+        self._tune(app, engine, readonly=True)
+        return engine
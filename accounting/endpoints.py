@@ -1,11 +1,20 @@
 # Needed to serialize and deserialize data
+import csv
+import hashlib
 import json
+from StringIO import StringIO
+from collections import OrderedDict
 from datetime import datetime
-from flask import request, Response
+from flask import request, Response, stream_with_context
 # Import things from Flask that we need.
 from accounting import app, db
+from cache import policy_cache
+from metrics import metrics
 from dateutil.parser import parse as date_parse
-from models import Contact, Invoice, Policy, Payment
+from models import Contact, Invoice, Policy, PolicyCancellation, Payment
+from payment_queue import PaymentQueueFull, payment_queue
+from utils import PolicyAccounting, ReadOnlyPolicyAccounting, book_snapshot, \
+    parse_payment_row, policy_versions, search_policy_ids
 
 def to_json(o):
     if isinstance(o, list):
@@ -15,63 +24,481 @@ def to_json(o):
         )
     return json.dumps(o, default=str)
 
+def to_json_stream(query, encoder, chunk_size=100):
+    """
+    Serializes the rows of query as a JSON array, yielding it a chunk of
+    rows at a time as the rows are read from the database cursor.  Each
+    row is encoded with encoder (see Serializable.row_encoder).
+    """
+    encoder = metrics.timed_serializer(encoder)
+    yield '['
+    separator = ''
+    chunk = []
+    for row in query.yield_per(chunk_size):
+        chunk.append(encoder(row))
+        if len(chunk) == chunk_size:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+    if chunk:
+        yield separator + ','.join(chunk)
+    yield ']'
+
+def to_csv_stream(query, chunk_size=1000):
+    """
+    Serializes the rows of query as UTF-8 encoded CSV, with a header row
+    naming the columns, yielding chunk_size rows at a time as they are read
+    from the database cursor.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    def encode_row(row):
+        # Python 2's csv module only writes byte strings
+        writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value
+                         for value in row])
+    writerow = metrics.timed_serializer(encode_row)
+    writerow([column['name'] for column in query.column_descriptions])
+    for i, row in enumerate(query.yield_per(chunk_size), 1):
+        writerow(row)
+        if i % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def stream_json(query, model):
+    """
+    Streams the rows of query, which must select
+    model.serializable_columns(), as a JSON array.
+    """
+    # stream_with_context keeps the request, and so the db session, alive
+    # until the whole response has been sent.
+    return Response(
+        stream_with_context(to_json_stream(query, model.row_encoder())),
+        mimetype='application/json'
+    )
+
+def cached_json(kind, policy_id, as_of_date, version, query, model):
+    """
+    Like stream_json, but serves the response from policy_cache when it
+    holds one for (kind, policy_id, as_of_date) at the policy's current
+    version, and otherwise stores the response there once it has been
+    streamed.
+
+    Keying entries by version means a body cached before another process
+    changed the policy, which cannot invalidate this process's cache, is
+    never sent under the new version's ETag.  Bodies longer than the
+    cache's max_entry_bytes are streamed without being kept.
+    """
+    key = (as_of_date, version)
+    body = policy_cache.get(kind, policy_id, key)
+    if body is not None:
+        return Response(body, mimetype='application/json')
+
+    token = policy_cache.token(policy_id)
+    def fill():
+        chunks = []
+        size = 0
+        for chunk in to_json_stream(query, model.row_encoder()):
+            if chunks is not None:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > policy_cache.max_entry_bytes:
+                    chunks = None
+            yield chunk
+        if chunks is not None:
+            policy_cache.set(kind, policy_id, key, ''.join(chunks), token)
+
+    return Response(
+        stream_with_context(fill()),
+        mimetype='application/json'
+    )
+
+def validators(policy_ids, *key):
+    """
+    Returns the ETag and Last-Modified of a response built from the data
+    of the given policies, and their versions by id.  The ETag covers the
+    request's path and query string, the version of each policy and
+    anything else the response depends on, passed as key (e.g. the date it
+    defaults to).  Last-Modified is the latest change to the policies, or
+    None if none was recorded.
+    """
+    recorded = policy_versions(policy_ids, session=db.readonly_session)
+    versions = dict((policy_id, recorded.get(policy_id, (0, None))[0])
+                    for policy_id in policy_ids)
+    digest = hashlib.sha1(request.full_path.encode('utf-8'))
+    digest.update(repr(key))
+    for policy_id in policy_ids:
+        digest.update(';{}:{}'.format(policy_id, versions[policy_id]))
+    modified = [modified_at for _, modified_at in recorded.values()]
+    return digest.hexdigest(), max(modified) if modified else None, versions
+
+def with_validators(response, etag, last_modified):
+    """
+    Tags response with etag and last_modified.  Clients must check with
+    the server before reusing it, which costs them a 304 when it is still
+    current.
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+def not_modified(etag, last_modified):
+    """
+    Returns a 304 response if the request's If-None-Match matches etag,
+    and None otherwise.  The comparison is weak, so the weak ETag of a
+    compressed copy of the response matches as well.
+    """
+    if request.if_none_match.contains_weak(etag):
+        return with_validators(Response(status=304), etag, last_modified)
+    return None
+
+def is_paged():
+    return 'limit' in request.args or 'after' in request.args
+
+def bad_request(message):
+    return Response(
+        json.dumps({"error": message}),
+        status=400
+    )
+
+def parse_date_arg():
+    """
+    Returns the date query parameter, or the current date if there is
+    none.  Raises a ValueError if it is formatted incorrectly.
+    """
+    date = request.args.get('date', None)
+    if date is None:
+        return datetime.now().date()
+    return date_parse(date).date()
+
+# Largest page a listing or search returns, whatever limit is asked for
+MAX_PAGE_SIZE = 100
+
+def page(query, model, date_column):
+    """
+    Orders query by date_column and id and applies the limit and after
+    query parameters to it.  after is the id of the last row of the
+    previous page.  limit is brought within 1 and MAX_PAGE_SIZE.  Raises
+    a ValueError if either parameter is invalid.
+    """
+    limit = request.args.get('limit', None)
+    after = request.args.get('after', None)
+
+    if after is not None:
+        # Look the row up through query so that it belongs to the same
+        # listing
+        last = query.filter(model.id == int(after)).first()
+        if last is None:
+            raise ValueError("Unknown after")
+        last_date = getattr(last, date_column.key)
+        query = query.filter(db.or_(
+            date_column > last_date,
+            db.and_(date_column == last_date, model.id > last.id)
+        ))
+
+    query = query.order_by(date_column, model.id)
+    if limit is not None:
+        query = query.limit(max(1, min(int(limit), MAX_PAGE_SIZE)))
+    return query
+
 # Routing for the server.
 @app.route("/policies/search", methods=["GET"])
 def search():
-    query = request.args.get('query')
-    query = "%{}%".format(query)
-    policies = Policy.query\
-        .filter(Policy.policy_number.ilike(query))\
-        .all()
+    query = request.args.get('query', '')
+
+    # Keyset pagination: `after` is the cursor returned with the previous
+    # page, `limit` the size of the page.
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        r = json.dumps({
+            "error": "after and limit must be integers"
+        })
+        return Response(
+            r,
+            status=400
+        )
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    ids, cursor = search_policy_ids(query, after=after, limit=limit,
+                                    session=db.readonly_session)
+
+    # The page shows the policies' own columns and their agents, which
+    # policy versions do not follow, so it is tagged with a hash of those
+    # columns instead.  They are read as plain rows, and a client holding
+    # the page already is answered before anything is serialized.
+    policy_columns = Policy.serializable_columns()
+    rows = []
+    if ids:
+        rows = db.readonly_session.query(*(policy_columns + Contact.serializable_columns()))\
+            .select_from(Policy)\
+            .outerjoin(Contact, Contact.id == Policy.agent)\
+            .filter(Policy.id.in_(ids))\
+            .order_by(Policy.id)\
+            .all()
+    digest = hashlib.sha1(request.full_path.encode('utf-8'))
+    digest.update(repr((cursor, [tuple(row) for row in rows])))
+    etag = digest.hexdigest()
+    response = not_modified(etag, None)
+    if response is not None:
+        return response
 
-    agents = [p.agent_relation for p in policies]
-    serialized = [p.to_dict() for p in policies]
-    print(agents)
-    # Replace agent id in policies dicts with objects
-    for s, a in zip(serialized, agents):
-        if s['agent'] is not None:
-            s['agent'] = a.to_dict()
+    def serialize(rows):
+        serialized = []
+        for row in rows:
+            policy = OrderedDict(zip(Policy.serializable_cols, row[:len(policy_columns)]))
+            # Replace agent id in policies dicts with objects
+            if policy['agent'] is not None:
+                policy['agent'] = OrderedDict(
+                    zip(Contact.serializable_cols, row[len(policy_columns):]))
+            serialized.append(policy)
 
-    return json.dumps(serialized, default=str)
+        return json.dumps({
+            "policies": serialized,
+            "next": cursor
+        }, default=str)
 
-@app.route("/policies/<id>/invoices")
+    return with_validators(
+        Response(metrics.timed_serializer(serialize)(rows)),
+        etag, None
+    )
+
+@app.route("/policies/<int:id>/invoices")
 def invoices(id):
-    # get date query parameter
-    date = request.args.get('date', None)
-    
-    # If no date is provided, use the current date
-    if date is None:
-        date = datetime.now().date()
+    # get date query parameter; if no date is provided, use the current date
+    try:
+        date = parse_date_arg()
+    # If we failed, return an error
+    except ValueError:
+        return bad_request("Date formatted incorrectly")
+
+    etag, last_modified, versions = validators([id], date)
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    # Select plain rows of the serialized columns rather than objects
+    invoices = db.readonly_session.query(*Invoice.serializable_columns())\
+        .filter(Invoice.policy_id == id)\
+        .filter(Invoice.bill_date <= date)\
+        .filter(Invoice.deleted == False)
+
+    try:
+        invoices = page(invoices, Invoice, Invoice.bill_date)
+    except ValueError:
+        return bad_request("Invalid limit or after")
+
+    # Only whole listings are cached; pages are served straight from the db.
+    if is_paged():
+        response = stream_json(invoices, Invoice)
     else:
-        # otherwise, try to parse date
-        try: 
-            date = date_parse(
-                request.args.get('date')
-            )
-        # If we failed, return an error
+        response = cached_json('invoices', id, date, versions[id], invoices, Invoice)
+    return with_validators(response, etag, last_modified)
+
+@app.route("/policies/<int:id>/payments")
+def payments(id):
+    # Only filter by date if asked to, as payments used to be listed
+    # regardless of date.
+    date = None
+    if request.args.get('date', None) is not None:
+        try:
+            date = parse_date_arg()
         except ValueError:
-            r = json.dumps({
-                "error": "Date formatted incorrectly"
-            })
+            return bad_request("Date formatted incorrectly")
+
+    etag, last_modified, versions = validators([id], date)
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    payments = db.readonly_session.query(*Payment.serializable_columns())\
+        .filter(Payment.policy_id == id)
+    if date is not None:
+        payments = payments.filter(Payment.transaction_date <= date)
+
+    try:
+        payments = page(payments, Payment, Payment.transaction_date)
+    except ValueError:
+        return bad_request("Invalid limit or after")
+
+    if is_paged():
+        response = stream_json(payments, Payment)
+    else:
+        response = cached_json('payments', id, date, versions[id], payments, Payment)
+    return with_validators(response, etag, last_modified)
+
+@app.route("/policies/<int:id>/payments", methods=["POST"])
+def make_payment(id):
+    """
+    Records a payment from the amount, date and contact_id fields of a
+    form or JSON body.  The amount is in dollars and must be a string, e.g.
+    "12.34", in JSON bodies too: JSON numbers are refused with a 400, as
+    12 and 12.0 would otherwise be read in different units.  The date
+    defaults to today and the contact to the policy's named insured.
+
+    In write-behind mode (PAYMENT_QUEUE_ENABLED) the payment is queued and
+    its queue id returned with a 202, or a 503 if the queue stays full.
+    Otherwise it is recorded at once and returned with a 201.
+    """
+    values = request.json if request.json is not None else request.form
+    policy = db.session.query(Policy.named_insured).filter(Policy.id == id).first()
+    if policy is None:
+        return Response(
+            json.dumps({"error": "Policy not found"}),
+            status=404
+        )
+
+    amount = values.get('amount')
+    if not isinstance(amount, basestring):
+        return bad_request('amount must be a string of dollars, e.g. "12.34"')
+
+    try:
+        payment = parse_payment_row(
+            (id, values.get('contact_id'), amount,
+             values.get('date') or datetime.now().date()),
+            {id: policy.named_insured},
+            unit='dollars'
+        )
+    except (TypeError, ValueError) as e:
+        return bad_request(str(e))
+
+    if app.config['PAYMENT_QUEUE_ENABLED']:
+        try:
+            queued = payment_queue.put(payment['policy_id'], payment['contact_id'],
+                                       payment['amount_paid'], payment['transaction_date'])
+        except PaymentQueueFull as e:
             return Response(
-                r,
-                status=400
+                json.dumps({"error": str(e)}),
+                status=503,
+                headers={'Retry-After': '1'}
             )
+        return Response(json.dumps({"queued": queued}), status=202,
+                        mimetype='application/json')
+
+    recorded = PolicyAccounting(id).make_payment(payment['contact_id'],
+                                                 payment['transaction_date'],
+                                                 payment['amount_paid'])
+    return Response(to_json(recorded.to_dict()), status=201, mimetype='application/json')
 
-    invoices = Invoice.query\
-        .filter_by(policy_id=id)\
+@app.route("/policies/<int:id>/summary")
+def summary(id):
+    """
+    Everything the policy page shows as of the date query parameter, in one
+    response: the policy, its invoices billed and payments made up to that
+    date, its balance, whether an invoice is past due and its cancellation
+    if it was cancelled by then.  Amounts are in cents, as in every
+    response.
+    """
+    try:
+        date = parse_date_arg()
+    except ValueError:
+        return bad_request("Date formatted incorrectly")
+
+    body = policy_cache.get('summary', id, date)
+    if body is not None:
+        return Response(body, mimetype='application/json')
+    token = policy_cache.token(id)
+
+    session = db.readonly_session
+    policy = session.query(*Policy.serializable_columns())\
+        .filter(Policy.id == id)\
+        .first()
+    if policy is None:
+        return Response(
+            json.dumps({"error": "Policy not found"}),
+            status=404
+        )
+
+    invoices = session.query(*Invoice.serializable_columns())\
+        .filter(Invoice.policy_id == id)\
         .filter(Invoice.bill_date <= date)\
         .filter(Invoice.deleted == False)\
-        .order_by(Invoice.bill_date)\
+        .order_by(Invoice.bill_date, Invoice.id)\
         .all()
+    payments = session.query(*Payment.serializable_columns())\
+        .filter(Payment.policy_id == id)\
+        .filter(Payment.transaction_date <= date)\
+        .order_by(Payment.transaction_date, Payment.id)\
+        .all()
+    cancellation = session.query(*PolicyCancellation.serializable_columns())\
+        .filter(PolicyCancellation.policy_id == id)\
+        .filter(PolicyCancellation.date <= date)\
+        .first()
 
-    return to_json(invoices)
+    pa = ReadOnlyPolicyAccounting(id)
+    balance = pa.return_account_balance(date)
+    past_due = pa.evaluate_cancellation_pending_due_to_non_pay(date)
 
-@app.route("/policies/<id>/payments")
-def payments(id):
-    payments = Payment.query\
-        .filter_by(policy_id=id)\
-        .all()
+    def serialize():
+        encode_invoice = Invoice.row_encoder()
+        encode_payment = Payment.row_encoder()
+        return '{{"policy": {}, "date": {}, "invoices": [{}], "payments": [{}], ' \
+               '"balance": {}, "past_due": {}, "cancellation": {}}}'.format(
+            Policy.row_encoder()(policy),
+            json.dumps(str(date)),
+            ','.join(encode_invoice(row) for row in invoices),
+            ','.join(encode_payment(row) for row in payments),
+            json.dumps(balance),
+            json.dumps(past_due),
+            PolicyCancellation.row_encoder()(cancellation) if cancellation else 'null'
+        )
+
+    body = metrics.timed_serializer(serialize)()
+    policy_cache.set('summary', id, date, body, token)
+    return Response(body, mimetype='application/json')
+
+@app.route("/reports/balances")
+def balance_report():
+    """
+    Balance of every policy in the book as of the date query parameter,
+    optionally broken down by agent or billing_schedule (group_by), as a
+    JSON array or as CSV (format=csv).  Amounts are in cents.
+    """
+    try:
+        date = parse_date_arg()
+    except ValueError:
+        return bad_request("Date formatted incorrectly")
+
+    format = request.args.get('format', 'json')
+    if format not in ('json', 'csv'):
+        return bad_request("format must be json or csv")
+
+    try:
+        rows = book_snapshot(date, request.args.get('group_by', None),
+                             session=db.readonly_session)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    if format == 'csv':
+        return Response(
+            stream_with_context(to_csv_stream(rows)),
+            mimetype='text/csv',
+            headers={'Content-Disposition':
+                     'attachment; filename=balances-{}.csv'.format(date)}
+        )
+
+    names = [column['name'] for column in rows.column_descriptions]
+    def encoder(row):
+        return json.dumps(OrderedDict(zip(names, row)), default=str)
+    return Response(
+        stream_with_context(to_json_stream(rows, encoder, chunk_size=1000)),
+        mimetype='application/json'
+    )
 
-    return to_json(payments)
+@app.route("/cache/stats")
+def cache_stats():
+    return Response(
+        json.dumps(policy_cache.stats()),
+        mimetype='application/json'
+    )
 
+@app.route("/metrics")
+def metrics_totals():
+    return Response(
+        metrics.render(),
+        mimetype='text/plain'
+    )
@@ -0,0 +1,258 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock, local
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from accounting import app
+
+"""
+#######################################################
+Query count and latency instrumentation.
+#######################################################
+"""
+
+class Scope(object):
+    """
+     What was spent on behalf of one request or method call: the number of
+     SQL statements run, the time spent in the database, the rows fetched
+     from it and the time spent serializing responses, in seconds.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.serialize_time = 0.0
+        self.start = time.time()
+        self.elapsed = None
+
+
+class _CountingCursor(object):
+    """
+     Wraps a DBAPI cursor, counting the rows fetched from it into scopes.
+    """
+    def __init__(self, cursor, scopes):
+        self._cursor = cursor
+        self._scopes = scopes
+
+    def _count(self, rows):
+        for scope in self._scopes:
+            scope.rows += rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class Metrics(object):
+    """
+     Counts SQL statements, database time, rows loaded and serialization
+     time per request and per instrumented method, and keeps running totals
+     by request route and method name.
+
+     Statements are seen through SQLAlchemy cursor events on every engine,
+     and requests through Flask hooks.  While disabled the event listeners
+     are not installed at all (or return at once, once they have been), and
+     instrumented methods and serializers are called straight through.
+
+     Responses get X-SQL-Statements, X-Rows-Loaded and Server-Timing
+     headers.  Headers are sent before a streamed body, so for streamed
+     responses they only cover the work done by the view itself; the totals
+     include the whole response.
+    """
+    def __init__(self, app=None):
+        self.enabled = False
+        self._installed = False
+        self._local = local()
+        self._lock = Lock()
+        self._totals = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', False)
+
+        @app.before_request
+        def start_request_scope():
+            if self.enabled:
+                rule = request.url_rule.rule if request.url_rule else '<unmatched>'
+                g.metrics_scope = self.start("{} {}".format(request.method, rule))
+
+        @app.after_request
+        def add_timing_headers(response):
+            scope = getattr(g, 'metrics_scope', None)
+            if scope is not None:
+                total = (time.time() - scope.start) * 1000
+                response.headers['X-SQL-Statements'] = str(scope.statements)
+                response.headers['X-Rows-Loaded'] = str(scope.rows)
+                response.headers['Server-Timing'] = \
+                    "db;dur={:.3f}, serialize;dur={:.3f}, total;dur={:.3f}".format(
+                        scope.db_time * 1000, scope.serialize_time * 1000, total)
+            return response
+
+        @app.teardown_request
+        def stop_request_scope(exception=None):
+            scope = getattr(g, 'metrics_scope', None)
+            if scope is not None:
+                g.metrics_scope = None
+                self.stop(scope)
+
+        if app.config['METRICS_ENABLED']:
+            self.enable()
+
+    def enable(self):
+        with self._lock:
+            if not self._installed:
+                # Listening on the Engine class covers every engine, including
+                # the read-only one and engines created later on.
+                event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+                event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+                self._installed = True
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+    def _scopes(self):
+        scopes = getattr(self._local, 'scopes', None)
+        if scopes is None:
+            scopes = self._local.scopes = []
+        return scopes
+
+    def start(self, name):
+        """
+        Opens a scope named name in this thread and returns it.  Everything
+        measured until it is stopped is added to it, and to the scopes it
+        is nested in.
+        """
+        scope = Scope(name)
+        self._scopes().append(scope)
+        return scope
+
+    def stop(self, scope):
+        """
+        Closes scope and adds it to the totals for its name.
+        """
+        scope.elapsed = time.time() - scope.start
+        scopes = self._scopes()
+        if scope in scopes:
+            scopes.remove(scope)
+        with self._lock:
+            totals = self._totals.setdefault(scope.name, [0, 0, 0.0, 0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += scope.statements
+            totals[2] += scope.db_time
+            totals[3] += scope.rows
+            totals[4] += scope.serialize_time
+            totals[5] += scope.elapsed
+
+    def instrument(self, name):
+        """
+        Decorator measuring each call to a function in a scope named name.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                scope = self.start(name)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.stop(scope)
+            return wrapper
+        return decorator
+
+    def timed_serializer(self, serializer):
+        """
+        Returns serializer, a function encoding rows or objects, wrapped to
+        count the time it takes as serialization time.  It is returned as
+        is while disabled.
+        """
+        if not self.enabled:
+            return serializer
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return serializer(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                for scope in self._scopes():
+                    scope.serialize_time += elapsed
+        return wrapper
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled and getattr(self._local, 'scopes', None):
+            self._local.cursor_start = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(self._local, 'cursor_start', None)
+        if start is None:
+            return
+        self._local.cursor_start = None
+        elapsed = time.time() - start
+        scopes = list(self._scopes())
+        for scope in scopes:
+            scope.statements += 1
+            scope.db_time += elapsed
+        # Rows are fetched from the cursor by the result proxy built on
+        # context.cursor after this event.
+        if cursor.description is not None and context is not None:
+            context.cursor = _CountingCursor(cursor, scopes)
+
+    def totals(self):
+        """
+        Returns the totals by scope name, as dicts.
+        """
+        keys = ('calls', 'statements', 'db_seconds', 'rows', 'serialize_seconds', 'seconds')
+        with self._lock:
+            return OrderedDict(
+                (name, dict(zip(keys, self._totals[name])))
+                for name in sorted(self._totals)
+            )
+
+    def render(self):
+        """
+        Renders the totals in the Prometheus text format.
+        """
+        totals = self.totals()
+        lines = []
+        for key, help in [('calls', 'Requests or method calls measured'),
+                          ('statements', 'SQL statements executed'),
+                          ('db_seconds', 'Time spent executing SQL statements'),
+                          ('rows', 'Rows fetched from the database'),
+                          ('serialize_seconds', 'Time spent serializing responses'),
+                          ('seconds', 'Time spent in total')]:
+            metric = 'accounting_{}_total'.format(key)
+            lines.append('# HELP {} {}'.format(metric, help))
+            lines.append('# TYPE {} counter'.format(metric))
+            for name, values in totals.items():
+                lines.append('{}{{name="{}"}} {}'.format(
+                    metric, name.replace('\\', '\\\\').replace('"', '\\"'), values[key]))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(app)
@@ -1,28 +1,98 @@
+import json
+from collections import OrderedDict
+
+from sqlalchemy import event
+
 from accounting import db
+from money import MONEY_IN_CENTS_VERSION
 # from sqlalchemy.ext.declarative import declarative_base
 # 
 # DeclarativeBase = declarative_base()
 
+def _encode_integer(value):
+    return 'null' if value is None else str(value)
+
+def _encode_date(value):
+    return 'null' if value is None else '"%s"' % value.isoformat()
+
+def _encode_boolean(value):
+    if value is None:
+        return 'null'
+    return 'true' if value else 'false'
+
+def _encode_string(value):
+    return json.dumps(value)
+
 class Serializable(object):
+    # Classes implementing Serializable list their columns in a tuple named
+    # serializable_cols, so that keys are always serialized in that order.
+
     def to_dict(self, custom_cols=None):
         try:
             cols = custom_cols if custom_cols else self.serializable_cols
-            return {
-                c: getattr(self, c)
+            return OrderedDict(
+                (c, getattr(self, c))
                 for c in cols
-            }
+            )
         except AttributeError:
             raise RuntimeError("Error in to_dict.  Make sure class "\
                 "implementing Serializable has 'serializable_cols' class "\
                 "variable and that it contains valid columns.  If passing "\
                 "custom_cols, make sure the collection contains valid columns")
 
+    @classmethod
+    def serializable_columns(cls):
+        """
+        Returns the columns named by serializable_cols, in order, for querying
+        rows as plain tuples instead of objects, e.g.
+        db.session.query(*Invoice.serializable_columns())
+        """
+        return [getattr(cls, c) for c in cls.serializable_cols]
+
+    @classmethod
+    def row_encoder(cls):
+        """
+        Returns a function which encodes a row of serializable_columns() as
+        a JSON object.  The output is identical to
+        json.dumps(obj.to_dict(), default=str) for the same object.
+
+        The encoder is built once per class: the keys are baked into a
+        template and each value goes through an encoder picked by the type of
+        its column.
+        """
+        encoder = _row_encoders.get(cls)
+        if encoder is None:
+            template = '{' + ', '.join(
+                json.dumps(c).replace('%', '%%') + ': %s'
+                for c in cls.serializable_cols
+            ) + '}'
+            value_encoders = []
+            for column in cls.serializable_columns():
+                column_type = column.property.columns[0].type
+                if isinstance(column_type, db.Boolean):
+                    value_encoders.append(_encode_boolean)
+                elif isinstance(column_type, db.Date):
+                    value_encoders.append(_encode_date)
+                elif isinstance(column_type, db.Integer):
+                    value_encoders.append(_encode_integer)
+                else:
+                    value_encoders.append(_encode_string)
+
+            def encoder(row):
+                return template % tuple(
+                    encode(value) for encode, value in zip(value_encoders, row)
+                )
+            _row_encoders[cls] = encoder
+        return encoder
+
+_row_encoders = {}
+
 class Policy(db.Model, Serializable):
     __tablename__ = 'policies'
 
     __table_args__ = {}
 
-    serializable_cols = {
+    serializable_cols = (
         'id',
         'policy_number',
         'effective_date',
@@ -31,7 +101,7 @@ class Policy(db.Model, Serializable):
         'annual_premium',
         'named_insured',
         'agent'
-    }
+    )
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -39,6 +109,7 @@ class Policy(db.Model, Serializable):
     effective_date = db.Column(u'effective_date', db.DATE(), nullable=False)
     status = db.Column(u'status', db.Enum(u'Active', u'Canceled', u'Expired'), default=u'Active', nullable=False)
     billing_schedule = db.Column(u'billing_schedule', db.Enum(u'Annual', u'Two-Pay', u'Quarterly', u'Monthly'), default=u'Annual', nullable=False)
+    # In cents, see accounting.money
     annual_premium = db.Column(u'annual_premium', db.INTEGER(), nullable=False)
     named_insured = db.Column(u'named_insured', db.INTEGER(), db.ForeignKey('contacts.id'))
     agent = db.Column(u'agent', db.INTEGER(), db.ForeignKey('contacts.id'))
@@ -53,16 +124,71 @@ class Policy(db.Model, Serializable):
         return self.cancellation is not None
 
     invoices = db.relation('Invoice', primaryjoin="Invoice.policy_id==Policy.id")
+    # The invoices which count towards the balance, for reading only
+    active_invoices = db.relation('Invoice',
+                                  primaryjoin="and_(Invoice.policy_id == Policy.id, Invoice.deleted == False)",
+                                  order_by="Invoice.bill_date", viewonly=True)
     cancellation = db.relation('PolicyCancellation', backref="policy", uselist=False)
     agent_relation = db.relation('Contact', primaryjoin="Contact.id == Policy.agent", uselist=False)
     named_insured_relation = db.relation('Contact', primaryjoin="Contact.id == Policy.named_insured", uselist=False)
 
 
-class PolicyCancellation(db.Model):
+# Full-text index over policy numbers and named insured names, used by the
+# policy search.  The trigram tokenizer matches any substring of three or more
+# characters, case-insensitively, like the ILIKE '%query%' it replaces.  The
+# index is keyed by policy id (its rowid) and kept in sync by triggers.
+policy_search_ddl = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS policy_search
+       USING fts5(policy_number, insured_name, tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS policy_search_insert AFTER INSERT ON policies
+       BEGIN
+         INSERT INTO policy_search(rowid, policy_number, insured_name)
+         VALUES (new.id, new.policy_number,
+                 COALESCE((SELECT name FROM contacts WHERE id = new.named_insured), ''));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS policy_search_update
+       AFTER UPDATE OF id, policy_number, named_insured ON policies
+       BEGIN
+         DELETE FROM policy_search WHERE rowid = old.id;
+         INSERT INTO policy_search(rowid, policy_number, insured_name)
+         VALUES (new.id, new.policy_number,
+                 COALESCE((SELECT name FROM contacts WHERE id = new.named_insured), ''));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS policy_search_delete AFTER DELETE ON policies
+       BEGIN
+         DELETE FROM policy_search WHERE rowid = old.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS policy_search_contact_update
+       AFTER UPDATE OF name ON contacts
+       BEGIN
+         UPDATE policy_search SET insured_name = new.name
+         WHERE rowid IN (SELECT id FROM policies WHERE named_insured = new.id);
+       END""",
+]
+
+for statement in policy_search_ddl:
+    event.listen(Policy.__table__, 'after_create', db.DDL(statement))
+# A new schema stores money in cents from the start, which is recorded so
+# that utils.migrate_money_to_cents never converts its amounts again.
+event.listen(Policy.__table__, 'after_create',
+             db.DDL("PRAGMA user_version = {:d}".format(MONEY_IN_CENTS_VERSION))
+               .execute_if(dialect='sqlite'))
+event.listen(Policy.__table__, 'before_drop',
+             db.DDL("DROP TABLE IF EXISTS policy_search"))
+
+
+class PolicyCancellation(db.Model, Serializable):
     __tablename__ = 'policy_cancellations'
 
     __table_args__ = {}
 
+    serializable_cols = (
+        'policy_id',
+        'reason',
+        'date',
+        'notes'
+    )
+
     # column definitions
     policy_id = db.Column(u'policy_id', db.ForeignKey('policies.id'), primary_key=True)
     # Why was this policy cancelled
@@ -83,11 +209,11 @@ class Contact(db.Model, Serializable):
 
     __table_args__ = {}
 
-    serializable_cols = {
+    serializable_cols = (
         'id',
         'name',
         'role'
-    }
+    )
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -102,9 +228,18 @@ class Contact(db.Model, Serializable):
 class Invoice(db.Model, Serializable):
     __tablename__ = 'invoices'
 
-    __table_args__ = {}
+    # Invoices are always looked up for one policy, excluding deleted ones,
+    # over a range of one of the dates.  Keying on (policy_id, deleted) keeps
+    # deleted invoices out of the scanned range, and amount_due makes the
+    # bill_date index covering for balance sums.
+    __table_args__ = (
+        db.Index('ix_invoices_policy_bill_date', 'policy_id', 'deleted', 'bill_date', 'amount_due'),
+        db.Index('ix_invoices_policy_due_date', 'policy_id', 'deleted', 'due_date'),
+        db.Index('ix_invoices_policy_cancel_date', 'policy_id', 'deleted', 'cancel_date'),
+        {}
+    )
 
-    serializable_cols = {
+    serializable_cols = (
         "id",
         "policy_id",
         "bill_date",
@@ -112,13 +247,14 @@ class Invoice(db.Model, Serializable):
         "cancel_date",
         "amount_due",
         "deleted"
-    }
+    )
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
     policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
     bill_date = db.Column(u'bill_date', db.DATE(), nullable=False)
     due_date = db.Column(u'due_date', db.DATE(), nullable=False)
     cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
+    # In cents, see accounting.money
     amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
     deleted = db.Column(u'deleted', db.Boolean, default=False, server_default='0', nullable=False)
 
@@ -130,22 +266,45 @@ class Invoice(db.Model, Serializable):
         self.amount_due = amount_due
 
 
+# Deleted invoices moved out of the invoices table once they are long dead
+# (see utils.archive_deleted_invoices), keeping their original ids.
+class InvoiceArchive(db.Model):
+    __tablename__ = 'invoices_archive'
+
+    __table_args__ = {}
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, autoincrement=False, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    bill_date = db.Column(u'bill_date', db.DATE(), nullable=False)
+    due_date = db.Column(u'due_date', db.DATE(), nullable=False)
+    cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
+    # In cents, see accounting.money
+    amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
+    archived_on = db.Column(u'archived_on', db.DATE(), nullable=False)
+
+
 class Payment(db.Model, Serializable):
     __tablename__ = 'payments'
 
-    __table_args__ = {}
+    # Payments are summed for one policy up to a transaction date.
+    __table_args__ = (
+        db.Index('ix_payments_policy_transaction_date', 'policy_id', 'transaction_date', 'amount_paid'),
+        {}
+    )
 
-    serializable_cols = {
+    serializable_cols = (
         "id",
         "policy_id",
         "contact_id",
         "amount_paid",
         "transaction_date"
-    }
+    )
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
     policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
     contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
+    # In cents, see accounting.money
     amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
     transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
 
@@ -154,3 +313,96 @@ class Payment(db.Model, Serializable):
         self.contact_id = contact_id
         self.amount_paid = amount_paid
         self.transaction_date = transaction_date
+
+
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger_entries'
+
+    # Balance lookups seek to the latest entry for a policy at or before a
+    # date, so the index follows that ordering.
+    __table_args__ = (
+        db.Index('ix_ledger_entries_policy_date', 'policy_id', 'entry_date', 'id'),
+        {}
+    )
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    entry_date = db.Column(u'entry_date', db.DATE(), nullable=False)
+    # Change in the amount owed, in cents: positive for invoices, negative
+    # for payments and for invoices that were deleted.
+    amount = db.Column(u'amount', db.INTEGER(), nullable=False)
+    # Sum of the amounts of every entry for the policy dated on or before
+    # entry_date, up to and including this one.
+    balance = db.Column(u'balance', db.INTEGER(), nullable=False)
+
+    def __init__(self, policy_id, entry_date, amount, balance):
+        self.policy_id = policy_id
+        self.entry_date = entry_date
+        self.amount = amount
+        self.balance = balance
+
+
+# When each policy next needs its cancellation status evaluated, so that
+# scheduled runs only look at the policies whose status may have changed
+# (see utils.run_cancellation_schedule).
+class CancellationSchedule(db.Model):
+    __tablename__ = 'cancellation_schedule'
+
+    __table_args__ = (
+        db.Index('ix_cancellation_schedule_next_event', 'next_event'),
+        db.Index('ix_cancellation_schedule_dirty', 'dirty'),
+        {}
+    )
+
+    #column definitions
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), primary_key=True, autoincrement=False)
+    # The next due or cancel date of the policy's invoices after the last
+    # evaluation, the only dates on which its status can change by itself.
+    next_event = db.Column(u'next_event', db.DATE())
+    # Whether the policy's invoices or payments changed since it was last
+    # evaluated.
+    dirty = db.Column(u'dirty', db.Boolean, default=True, server_default='1', nullable=False)
+    # Whether an invoice was past due as of the last evaluation
+    pending = db.Column(u'pending', db.Boolean, default=False, server_default='0', nullable=False)
+    # Bumped every time the policy is marked dirty, so an evaluation only
+    # clears the flag if nothing changed while it ran.
+    generation = db.Column(u'generation', db.INTEGER(), default=0, server_default='0', nullable=False)
+
+
+# Payments accepted by the web tier in write-behind mode, waiting to be
+# moved to payments by the payment queue's flusher (see payment_queue.py).
+class QueuedPayment(db.Model):
+    __tablename__ = 'payment_queue'
+
+    # Ids are never reused, so payments are flushed in the order they came.
+    __table_args__ = (
+        db.Index('ix_payment_queue_policy_date', 'policy_id', 'transaction_date'),
+        {'sqlite_autoincrement': True}
+    )
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
+    # In cents, see accounting.money
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
+    transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
+    queued_at = db.Column(u'queued_at', db.DATETIME(), nullable=False)
+
+
+# A version stamp per policy, bumped by every change to its invoices,
+# payments or cancellation (see utils.touch_policies).  Responses built from
+# a policy's data are tagged with its version, so clients holding a current
+# copy can be answered without rebuilding it.  Policies not changed since
+# the table was created have no row, which stands for version 0.
+class PolicyVersion(db.Model):
+    __tablename__ = 'policy_versions'
+
+    __table_args__ = {}
+
+    #column definitions
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), primary_key=True, autoincrement=False)
+    version = db.Column(u'version', db.INTEGER(), default=0, server_default='0', nullable=False)
+    # When the version was last bumped, in UTC
+    modified_at = db.Column(u'modified_at', db.DATETIME(), nullable=False)
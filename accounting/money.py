@@ -0,0 +1,69 @@
+import re
+
+"""
+#######################################################
+Money amounts, as integer cents.
+#######################################################
+"""
+
+# Annual premiums, invoice amounts, payments and ledger amounts are all
+# stored and computed as whole numbers of cents, so balances are exact and
+# stay plain integer arithmetic.  Dollars only appear at the edges: when
+# reading amounts typed by people or banks, and when displaying them.
+
+# Version of the database, stored in SQLite's user_version, from which
+# money amounts are stored in cents rather than whole dollars.  It is set
+# when the schema is created (see models.py), and by
+# utils.migrate_money_to_cents on older databases.
+MONEY_IN_CENTS_VERSION = 1
+
+_DOLLARS = re.compile(r'^([+-]?)\$?(\d[\d,]*)?(?:\.(\d*))?$')
+_CENTS = re.compile(r'^[+-]?\d+$')
+
+
+def dollars_to_cents(value):
+    """
+    Converts a dollar amount, e.g. 12, "1,234.5", "$12.34" or a Decimal, to
+    a number of cents.  Raises a ValueError if value is not a dollar amount
+    or has fractions of a cent.  Floats are rejected, as they cannot hold
+    most amounts of cents exactly.
+    """
+    # bool is an int, but True is not an amount
+    if isinstance(value, (bool, float)):
+        raise ValueError("Not a dollar amount: {!r}".format(value))
+    if isinstance(value, (int, long)):
+        return value * 100
+
+    match = _DOLLARS.match(str(value).strip())
+    if not match or not (match.group(2) or match.group(3)):
+        raise ValueError("Not a dollar amount: {!r}".format(value))
+    sign, whole, fraction = match.groups()
+    fraction = (fraction or '').ljust(2, '0')
+    if fraction[2:].strip('0'):
+        raise ValueError("Fractions of a cent in {!r}".format(value))
+
+    cents = int((whole or '0').replace(',', '')) * 100 + int(fraction[:2])
+    return -cents if sign == '-' else cents
+
+
+def parse_cents(value):
+    """
+    Reads a whole number of cents, e.g. 1234 or "1234".  Raises a ValueError
+    if value is anything else, including a float or a dollar amount such as
+    "12.34".
+    """
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, basestring) and _CENTS.match(value.strip()):
+        return int(value)
+    raise ValueError("Not a number of cents: {!r}".format(value))
+
+
+def split_cents(total, parts):
+    """
+    Splits total cents into parts installments which add up to exactly
+    total.  The installments are even, except for the first one which also
+    carries the remainder, e.g. split_cents(1000, 3) == [334, 333, 333].
+    """
+    amount, remainder = divmod(total, parts)
+    return [amount + remainder] + [amount] * (parts - 1)
@@ -0,0 +1,228 @@
+import atexit
+import time
+from datetime import datetime
+from threading import Condition, Thread
+
+from accounting import app, db
+from cache import policy_cache
+from models import QueuedPayment
+from utils import insert_payments
+
+"""
+#######################################################
+Write-behind queue of payments.
+#######################################################
+"""
+
+class PaymentQueueFull(Exception):
+    """
+     Raised when a payment cannot be queued because the queue stayed full
+     for the whole timeout.
+    """
+
+
+class PaymentQueue(object):
+    """
+     Durable write-behind queue of payments, so that taking a payment on
+     the web tier costs a single short insert instead of holding SQLite's
+     write lock for the whole of PolicyAccounting.make_payment.
+
+     put() stores the payment in the payment_queue table and returns its
+     queue id right away.  A background thread moves queued payments to the
+     payments table batch_size at a time, every flush_interval seconds or as
+     soon as a batch is full.  Each batch is deleted from the queue in the
+     same transaction as its payments are inserted, so a payment is flushed
+     exactly once, and payments still queued when a process dies are flushed
+     by the next queue started.
+
+     At most max_size payments wait in the queue.  When it is full, put()
+     waits up to timeout seconds for the flusher to make room, then raises
+     PaymentQueueFull.  stop(), which is also called when the interpreter
+     exits, flushes every payment left.
+
+     The size is tracked by each process for its own puts and flushes,
+     starting from the number of payments queued when it first looks.
+    """
+    def __init__(self, max_size=10000, batch_size=500, flush_interval=1.0, timeout=5.0):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.flushed = 0
+        self._size = None
+        self._condition = Condition()
+        self._thread = None
+        self._stopping = False
+        self._registered = False
+        # Number of puts waiting for room in the queue
+        self._waiting = 0
+
+    def size(self):
+        """
+        Returns the number of payments waiting in the queue.
+        """
+        with self._condition:
+            if self._size is None:
+                self._size = db.session.query(db.func.count(QueuedPayment.id)).scalar()
+            return self._size
+
+    def put(self, policy_id, contact_id, amount, transaction_date, timeout=None):
+        """
+        Queues a payment of amount cents and returns its queue id, starting
+        the flusher if needed.
+        """
+        self.start()
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.size() >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PaymentQueueFull("{} payments are waiting to be flushed".format(
+                        self._size))
+                self._waiting += 1
+                self._condition.notify_all()
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            # The place is taken before inserting, so concurrent puts cannot
+            # overfill the queue.
+            self._size += 1
+
+        try:
+            result = db.session.execute(QueuedPayment.__table__.insert(), {
+                'policy_id': policy_id,
+                'contact_id': contact_id,
+                'amount_paid': amount,
+                'transaction_date': transaction_date,
+                'queued_at': datetime.now(),
+            })
+            db.session.commit()
+        except:
+            db.session.rollback()
+            with self._condition:
+                self._size -= 1
+            raise
+
+        with self._condition:
+            if self._size >= self.batch_size:
+                self._condition.notify_all()
+        return result.inserted_primary_key[0]
+
+    def flush(self):
+        """
+        Moves the oldest batch_size queued payments to the payments table in
+        one transaction, and returns how many were moved.
+        """
+        rows = db.session.query(QueuedPayment.id, QueuedPayment.policy_id,
+                                QueuedPayment.contact_id, QueuedPayment.amount_paid,
+                                QueuedPayment.transaction_date)\
+                         .order_by(QueuedPayment.id)\
+                         .limit(self.batch_size)\
+                         .all()
+        if not rows:
+            return 0
+
+        # Deleting the batch first takes the write lock.  Fewer rows are
+        # deleted than read if another process flushed some of them in the
+        # meantime, in which case the batch is read again.
+        deleted = QueuedPayment.query.filter(QueuedPayment.id.in_([row.id for row in rows]))\
+                                     .delete(synchronize_session=False)
+        if deleted != len(rows):
+            db.session.rollback()
+            return self.flush()
+
+        insert_payments([{'policy_id': row.policy_id,
+                          'contact_id': row.contact_id,
+                          'amount_paid': row.amount_paid,
+                          'transaction_date': row.transaction_date}
+                         for row in rows])
+        db.session.commit()
+
+        for policy_id in set(row.policy_id for row in rows):
+            policy_cache.invalidate(policy_id)
+        with self._condition:
+            if self._size is not None:
+                self._size = max(0, self._size - len(rows))
+            self.flushed += len(rows)
+            self._condition.notify_all()
+        return len(rows)
+
+    def flush_all(self):
+        """
+        Flushes batches until the queue is empty, and returns how many
+        payments were moved.
+        """
+        flushed = 0
+        while True:
+            count = self.flush()
+            if not count:
+                return flushed
+            flushed += count
+
+    def start(self):
+        """
+        Starts the flusher thread, unless it is running already.
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = Thread(target=self._run, name='payment-queue-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+            if not self._registered:
+                atexit.register(self.stop)
+                self._registered = True
+
+    def stop(self):
+        """
+        Stops the flusher thread and flushes every payment left in the
+        queue.  Returns how many were flushed by this call.
+        """
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join()
+        try:
+            return self.flush_all()
+        finally:
+            db.session.remove()
+
+    def _run(self):
+        while True:
+            try:
+                with self._condition:
+                    # Flush once the interval is over, or before that if a
+                    # batch is full or a put is waiting for room.
+                    deadline = time.time() + self.flush_interval
+                    while not self._stopping and not self._waiting \
+                            and self.size() < self.batch_size:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    if self._stopping:
+                        return
+                    if not self._size:
+                        continue
+                while self.flush() == self.batch_size and not self._stopping:
+                    pass
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Failed to flush the payment queue")
+                # The payments stay queued, and are tried again later
+                time.sleep(self.flush_interval)
+            finally:
+                db.session.remove()
+
+payment_queue = PaymentQueue(
+    max_size=app.config.get('PAYMENT_QUEUE_MAX_SIZE', 10000),
+    batch_size=app.config.get('PAYMENT_QUEUE_BATCH_SIZE', 500),
+    flush_interval=app.config.get('PAYMENT_QUEUE_FLUSH_INTERVAL', 1.0),
+    timeout=app.config.get('PAYMENT_QUEUE_TIMEOUT', 5.0)
+)
@@ -7,13 +7,33 @@ var PolicyViewModel = function() {
 
 	this.invoices = ko.observable();
 	this.payments = ko.observable();
+	// Worked out by the server as of the selected date
+	this.balance = ko.observable(0);
+	this.pastDue = ko.observable(false);
+	this.cancellation = ko.observable();
 	this.policies = ko.observable();
+	// Cursor of the next page of search results, if any
+	this.nextPolicies = ko.observable();
+
+	this.searchUrl = function() {
+		return "/policies/search?query=" + encodeURIComponent(that.policySearch() || "");
+	};
 
 	this.search = function() {
-		var url = "/policies/search?query=" + this.policySearch();
-		$.getJSON(url, that.policies);
+		$.getJSON(that.searchUrl(), function(data) {
+			that.policies(data.policies);
+			that.nextPolicies(data.next);
+		});
 	}
 
+	this.morePolicies = function() {
+		var url = that.searchUrl() + "&after=" + that.nextPolicies();
+		$.getJSON(url, function(data) {
+			that.policies(that.policies().concat(data.policies));
+			that.nextPolicies(data.next);
+		});
+	};
+
 	this.loadInvoices = function(policy) {
 		location.hash = "policy/" + policy.id;
 	};
@@ -23,11 +43,14 @@ var PolicyViewModel = function() {
 		return d.format("MMM D, YYYY");
 	}
 
+	// Amounts come from the API in cents, and are formatted with integer
+	// arithmetic so no floating point rounding shows up.
 	this.formatDollarAmount = function(m) {
-		if(typeof(m) === 'number') {
-			return "$" + m.toFixed(2);
-		}
-		return "$" + m().toFixed(2);
+		var cents = typeof(m) === 'number' ? m : m();
+		var sign = cents < 0 ? "-" : "";
+		cents = Math.abs(cents);
+		var fraction = cents % 100;
+		return sign + "$" + (cents - fraction) / 100 + "." + (fraction < 10 ? "0" : "") + fraction;
 	};
 
 	this.len = function(x) {
@@ -35,18 +58,6 @@ var PolicyViewModel = function() {
 		return x().length;
 	};
 
-	this.balance = ko.computed(function() {
-		var total = 0;
-		$.each(that.invoices(), function(i, e) {
-			total += e.amount_due;
-		});
-
-		$.each(that.payments(), function(i, e) {
-			total -= e.amount_paid;
-		});
-		return total;
-	}, this);
-
 	Sammy(function() {
 		this.get("#policy/:policy_id", function() {
 			var canonicalDate = function(d) {
@@ -55,16 +66,19 @@ var PolicyViewModel = function() {
 					"YYYY-MM-DD"
 				);
 			};
-			var url = "/policies/" + this.params.policy_id + "/invoices";
-			url += "?date=" + canonicalDate(that.date());			
-			$.getJSON(url, that.invoices)
+			var url = "/policies/" + this.params.policy_id + "/summary";
+			url += "?date=" + canonicalDate(that.date());
+			$.getJSON(url, function(data) {
+				that.payments(data.payments);
+				that.balance(data.balance);
+				that.pastDue(data.past_due);
+				that.cancellation(data.cancellation);
+				that.invoices(data.invoices);
+			})
 				.fail(function(e) {
 					e = e.responseJSON;
 					alert("Am error occurred: " + e.error +'. Please contact support');
 				});
-
-			url = "/policies/" + this.params.policy_id + "/payments";
-			$.getJSON(url, that.payments);
 		});
 	}).run();
 
@@ -1,12 +1,37 @@
 #!/user/bin/env python2.7
 
+import json
+import os
+import tempfile
+import time
 import unittest
+import zlib
+from StringIO import StringIO
 from datetime import date, datetime
+from decimal import Decimal
+from threading import Event, Thread
+from flask import Flask
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 from dateutil.relativedelta import relativedelta
 
-from accounting import db
-from models import Contact, Invoice, Payment, Policy
-from utils import PolicyAccounting
+from accounting import app, db
+import endpoints
+from assets import static_assets
+from batch import run_nightly
+from cache import PolicyCache, policy_cache
+from database import AccountingSQLAlchemy, check_sqlite_version
+from metrics import metrics
+from money import dollars_to_cents, parse_cents, split_cents
+from models import CancellationSchedule, Contact, Invoice, InvoiceArchive, LedgerEntry, Payment, Policy, \
+    PolicyCancellation, PolicyVersion, QueuedPayment
+from payment_queue import PaymentQueue, PaymentQueueFull
+from utils import BillingCalendar, PolicyAccounting, ReadOnlyPolicyAccounting, archive_deleted_invoices, \
+    book_snapshot, bulk_make_invoices, pending_cancellation_due_to_non_pay, import_payments, import_payments_csv, rebuild_ledger, \
+    load_policies, migrate_money_to_cents, search_policies, sweep_cancellations, with_relations, \
+    evaluate_schedule, find_cancellations, find_scheduled, run_cancellation_schedule, save_schedule, \
+    scheduled_pending, policy_versions, ledger_balance, touch_policies
 
 """
 #######################################################
@@ -43,6 +68,7 @@ class TestBillingSchedules(unittest.TestCase):
     def tearDown(self):
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         db.session.commit()
 
     def test_annual_billing_schedule(self):
@@ -105,7 +131,7 @@ class TestBillingSchedules(unittest.TestCase):
         self.assertEquals(len(self.policy.invoices), 2)
 
         # Change the billing cycle to monthly
-        pa.change_billing_schedule("Monthly")
+        pa.change_billing_schedule("Monthly", self.policy.effective_date)
 
         # Now we should have 2 + 12 = 14 invoices
         self.assertEquals(len(self.policy.invoices), 14)
@@ -122,6 +148,83 @@ class TestBillingSchedules(unittest.TestCase):
         for invoice in new_invoices:
             self.assertEquals(invoice.amount_due, 100)
 
+class TestIncrementalScheduleChange(unittest.TestCase):
+    """
+    Tests for PolicyAccounting.change_billing_schedule part way through a
+    policy year, and utils.archive_deleted_invoices
+    """
+
+    def setUp(self):
+        policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        self.pa = PolicyAccounting(self.policy_id)
+
+    def tearDown(self):
+        for model in [Invoice, InvoiceArchive, LedgerEntry]:
+            model.query.filter_by(policy_id=self.policy_id).delete()
+        Policy.query.filter_by(id=self.policy_id).delete()
+        db.session.commit()
+        db.session.remove()
+
+    def invoices(self, deleted=False):
+        return db.session.query(Invoice.bill_date, Invoice.amount_due)\
+                         .filter(Invoice.policy_id == self.policy_id)\
+                         .filter(Invoice.deleted == deleted)\
+                         .order_by(Invoice.bill_date)\
+                         .all()
+
+    def test_billed_invoices_are_kept(self):
+        self.pa.change_billing_schedule("Monthly", date(2015, 2, 15))
+
+        # The first quarter was billed, the other 900 is split over the ten
+        # months left.
+        invoices = self.invoices()
+        self.assertEquals(invoices[0], (date(2015, 1, 1), 300))
+        self.assertEquals(invoices[1:], [(date(2015, month, 1), 90) for month in range(3, 13)])
+        self.assertEquals([i.bill_date for i in self.invoices(deleted=True)],
+                          [date(2015, 4, 1), date(2015, 7, 1), date(2015, 10, 1)])
+        self.assertEquals(self.pa.return_account_balance(date(2015, 12, 31)), 1200)
+
+    def test_unchanged_installments_are_kept(self):
+        self.pa.change_billing_schedule("Quarterly", date(2015, 2, 15))
+        self.assertEquals(self.invoices(deleted=True), [])
+
+        self.pa.change_billing_schedule("Monthly", date(2015, 2, 15))
+        self.pa.change_billing_schedule("Monthly", date(2015, 5, 15))
+        self.assertEquals(len(self.invoices(deleted=True)), 3)
+
+    def test_odd_cents_are_billed(self):
+        self.pa.change_billing_schedule("Monthly", date(2015, 5, 15))
+
+        # 600 left over seven months: 85 a month and 5 more on the first
+        invoices = self.invoices()
+        self.assertEquals(invoices[2:], [(date(2015, 6, 1), 90)] +
+                          [(date(2015, month, 1), 85) for month in range(7, 13)])
+        self.assertEquals(self.pa.return_account_balance(date(2015, 12, 31)), 1200)
+
+    def test_remainder_billed_when_no_installment_left(self):
+        self.pa.change_billing_schedule("Annual", date(2015, 2, 15))
+        self.assertEquals(self.invoices(), [(date(2015, 1, 1), 300), (date(2015, 2, 15), 900)])
+
+    def test_archive_deleted_invoices(self):
+        self.pa.change_billing_schedule("Monthly", date(2015, 2, 15))
+        balances = [self.pa.return_account_balance(date(2015, m, 1)) for m in range(1, 13)]
+
+        self.assertEquals(archive_deleted_invoices(date(2015, 8, 1), batch_size=1), 2)
+        self.assertEquals([i.bill_date for i in self.invoices(deleted=True)], [date(2015, 10, 1)])
+        archived = InvoiceArchive.query.filter_by(policy_id=self.policy_id)\
+                                       .order_by(InvoiceArchive.bill_date).all()
+        self.assertEquals([a.bill_date for a in archived], [date(2015, 4, 1), date(2015, 7, 1)])
+        self.assertEquals(len(self.invoices()), 11)
+
+        policy_cache.invalidate(self.policy_id)
+        self.assertEquals([self.pa.return_account_balance(date(2015, m, 1)) for m in range(1, 13)],
+                          balances)
+
+
 class TestReturnAccountBalance(unittest.TestCase):
 
     @classmethod
@@ -151,6 +254,7 @@ class TestReturnAccountBalance(unittest.TestCase):
     def tearDown(self):
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         for payment in self.payments:
             db.session.delete(payment)
         db.session.commit()
@@ -171,7 +275,7 @@ class TestReturnAccountBalance(unittest.TestCase):
         """
         self.policy.billing_schedule = "Monthly"
         pa = PolicyAccounting(self.policy.id)
-        pa.change_billing_schedule("Quarterly")
+        pa.change_billing_schedule("Quarterly", self.policy.effective_date)
         self.assertEquals(pa.return_account_balance(date_cursor=self.policy.effective_date), 300)
 
     def test_quarterly_on_last_installment_bill_date(self):
@@ -188,7 +292,7 @@ class TestReturnAccountBalance(unittest.TestCase):
         """
         self.policy.billing_schedule = "Monthly"
         pa = PolicyAccounting(self.policy.id)
-        pa.change_billing_schedule("Quarterly")
+        pa.change_billing_schedule("Quarterly", self.policy.effective_date)
         invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
                                 .filter(Invoice.deleted == False)\
                                 .order_by(Invoice.bill_date).all()
@@ -210,7 +314,7 @@ class TestReturnAccountBalance(unittest.TestCase):
         """
         self.policy.billing_schedule = "Monthly"
         pa = PolicyAccounting(self.policy.id)
-        pa.change_billing_schedule("Quarterly")
+        pa.change_billing_schedule("Quarterly", self.policy.effective_date)
         invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
                                 .filter(Invoice.deleted == False)\
                                 .order_by(Invoice.bill_date).all()
@@ -219,6 +323,76 @@ class TestReturnAccountBalance(unittest.TestCase):
         self.assertEquals(pa.return_account_balance(date_cursor=invoices[1].bill_date), 0)
 
 
+class TestReadOnlyPolicyAccounting(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.billing_schedule = "Quarterly"
+        db.session.add(cls.policy)
+        db.session.commit()
+        cls.policy_id = cls.policy.id
+
+        # Listeners cannot be removed from an engine, so this one only
+        # records statements while statements is a list.
+        cls.statements = None
+        event.listen(db.engine, 'before_cursor_execute', cls.count_statement)
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def count_statement(cls, conn, cursor, statement, parameters, context, executemany):
+        if cls.statements is not None:
+            cls.statements.append(statement)
+
+    def setUp(self):
+        TestReadOnlyPolicyAccounting.statements = []
+
+    def tearDown(self):
+        TestReadOnlyPolicyAccounting.statements = None
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        LedgerEntry.query.filter_by(policy_id=self.policy_id).delete()
+        db.session.commit()
+        policy_cache.invalidate(self.policy_id)
+
+    def test_construction_runs_no_query(self):
+        policy = Policy.query.get(self.policy_id)
+        del self.statements[:]
+        ReadOnlyPolicyAccounting(self.policy_id)
+        ReadOnlyPolicyAccounting(policy)
+        self.assertEquals(self.statements, [])
+
+    def test_policy_loaded_on_demand(self):
+        pa = ReadOnlyPolicyAccounting(self.policy_id)
+        self.assertEquals(pa.policy.policy_number, 'Test Policy')
+        self.assertIs(ReadOnlyPolicyAccounting(self.policy).policy, self.policy)
+
+    def test_never_makes_invoices(self):
+        pa = ReadOnlyPolicyAccounting(self.policy_id)
+        self.assertEquals(pa.return_account_balance(date(2015, 12, 31)), 0)
+        self.assertFalse(pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 12, 31)))
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy_id).count(), 0)
+        self.assertFalse([s for s in self.statements if not s.lstrip().upper().startswith('SELECT')])
+
+    def test_matches_policy_accounting(self):
+        pa = PolicyAccounting(self.policy_id)
+        ro = ReadOnlyPolicyAccounting(self.policy_id)
+        for month in range(1, 13):
+            date_cursor = date(2015, month, 1)
+            self.assertEquals(ro.return_account_balance(date_cursor),
+                              pa.return_account_balance(date_cursor))
+
+
 class TestEvaluateCancellationPending(unittest.TestCase):
     """
     Tests for PolicyAccount.evaluate_cancellation_pending_due_to_non_pay
@@ -252,6 +426,7 @@ class TestEvaluateCancellationPending(unittest.TestCase):
     def tearDown(self):
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         for payment in self.payments:
             db.session.delete(payment)
         db.session.commit()
@@ -404,6 +579,7 @@ class TestCancellation(unittest.TestCase):
     def tearDown(self):
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         for payment in self.payments:
             db.session.delete(payment)
         if self.policy.cancellation:
@@ -450,3 +626,1863 @@ class TestCancellation(unittest.TestCase):
 
 
 
+
+
+class TestCancellationSweep(unittest.TestCase):
+    """
+    Tests for utils.sweep_cancellations
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policies = []
+        for billing_schedule in ["Annual", "Quarterly", "Monthly"]:
+            policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+            cls.policies.append(policy)
+        db.session.commit()
+
+        for policy in cls.policies:
+            PolicyAccounting(policy.id)
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy in cls.policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            LedgerEntry.query.filter_by(policy_id=policy.id).delete()
+            db.session.delete(policy)
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+
+    def tearDown(self):
+        for payment in self.payments:
+            db.session.delete(payment)
+        for policy in self.policies:
+            if policy.cancellation:
+                db.session.delete(policy.cancellation)
+        db.session.commit()
+        rebuild_ledger(self.policy_ids())
+
+    def policy_ids(self):
+        return [policy.id for policy in self.policies]
+
+    def test_sweep_cancels_unpaid_policies(self):
+        cancellations = sweep_cancellations(self.policy_ids(), date(2015, 6, 1))
+
+        self.assertEquals(len(cancellations), 3)
+        for policy in self.policies:
+            self.assertTrue(policy.cancelled)
+            self.assertEquals(policy.cancellation.date, date(2015, 2, 15))
+
+    def test_sweep_skips_paid_policies(self):
+        annual = PolicyAccounting(self.policies[0].id)
+        self.payments.append(annual.make_payment(date_cursor=date(2015, 1, 15),
+                                                 amount=1200))
+
+        cancellations = sweep_cancellations(self.policy_ids(), date(2015, 6, 1))
+
+        self.assertEquals(len(cancellations), 2)
+        self.assertFalse(self.policies[0].cancelled)
+
+    def test_sweep_skips_cancelled_policies(self):
+        sweep_cancellations(self.policy_ids(), date(2015, 6, 1))
+        self.assertEquals(sweep_cancellations(self.policy_ids(), date(2015, 6, 1)), [])
+
+    def test_sweep_matches_evaluate_cancel(self):
+        quarterly = PolicyAccounting(self.policies[1].id)
+        self.payments.append(quarterly.make_payment(date_cursor=date(2015, 1, 15),
+                                                    amount=300))
+        d = date(2015, 6, 1)
+
+        sweep_cancellations(self.policy_ids(), d)
+        swept = [(p.id, p.cancellation and p.cancellation.date) for p in self.policies]
+        for policy in self.policies:
+            if policy.cancellation:
+                db.session.delete(policy.cancellation)
+        db.session.commit()
+
+        for policy in self.policies:
+            PolicyAccounting(policy.id).evaluate_cancel(d)
+        evaluated = [(p.id, p.cancellation and p.cancellation.date) for p in self.policies]
+
+        self.assertEquals(swept, evaluated)
+
+
+class TestNightlyRun(unittest.TestCase):
+    """
+    Tests for batch.run_nightly
+    """
+
+    def setUp(self):
+        insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(insured)
+        db.session.commit()
+        self.insured_id = insured.id
+
+        policies = []
+        for billing_schedule in ["Monthly", "Quarterly", "Annual"]:
+            policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = insured.id
+            db.session.add(policy)
+            policies.append(policy)
+        db.session.commit()
+        self.policy_ids = [policy.id for policy in policies]
+        self.monthly, self.quarterly, self.annual = self.policy_ids
+
+        # The monthly policy is left without invoices for the run to make
+        PolicyAccounting(self.quarterly).make_payment(date_cursor=date(2015, 1, 15), amount=300)
+        PolicyAccounting(self.annual)
+
+    def tearDown(self):
+        for model in [PolicyCancellation, QueuedPayment, Payment, Invoice, LedgerEntry,
+                      CancellationSchedule]:
+            model.query.filter(model.policy_id.in_(self.policy_ids))\
+                       .delete(synchronize_session=False)
+        Policy.query.filter(Policy.id.in_(self.policy_ids)).delete(synchronize_session=False)
+        Contact.query.filter_by(id=self.insured_id).delete()
+        db.session.commit()
+        db.session.remove()
+
+    def run_nightly(self, workers, incremental=False):
+        return run_nightly(date(2015, 3, 1), workers=workers, shards=3,
+                           low=self.policy_ids[0], high=self.policy_ids[-1] + 1,
+                           incremental=incremental)
+
+    def assert_report(self, report):
+        self.assertEquals(report.errors, [])
+        self.assertEquals(report.shards, 3)
+        self.assertEquals(report.policies, 3)
+        self.assertEquals(report.invoiced, 12)
+        self.assertEquals(report.invoiced_policies, [self.monthly])
+        self.assertEquals(report.pending, [self.monthly, self.annual])
+        self.assertEquals(report.cancelled, [(self.monthly, date(2015, 2, 15)),
+                                             (self.annual, date(2015, 2, 15))])
+
+        cancelled = db.session.query(PolicyCancellation.policy_id)\
+                              .filter(PolicyCancellation.policy_id.in_(self.policy_ids))
+        self.assertEquals(sorted(row.policy_id for row in cancelled),
+                          [self.monthly, self.annual])
+        self.assertEquals(PolicyAccounting(self.monthly).return_account_balance(date(2015, 3, 1)), 300)
+
+    def test_single_worker(self):
+        self.assert_report(self.run_nightly(1))
+
+    def test_worker_pool(self):
+        self.assert_report(self.run_nightly(2))
+
+    def test_run_is_idempotent(self):
+        self.run_nightly(2)
+        report = self.run_nightly(2)
+        self.assertEquals(report.invoiced, 0)
+        self.assertEquals(report.cancelled, [])
+        self.assertEquals(report.pending, [self.monthly, self.annual])
+
+    def test_queued_payments_count(self):
+        # Accepted by the web tier but not flushed yet
+        db.session.execute(QueuedPayment.__table__.insert(), {
+            'policy_id': self.annual,
+            'contact_id': self.insured_id,
+            'amount_paid': 1200,
+            'transaction_date': date(2015, 1, 20),
+            'queued_at': datetime.now(),
+        })
+        db.session.commit()
+
+        report = self.run_nightly(1)
+        self.assertEquals(report.flushed, 1)
+        self.assertEquals(report.pending, [self.monthly])
+        self.assertEquals(report.cancelled, [(self.monthly, date(2015, 2, 15))])
+        self.assertEquals(QueuedPayment.query.filter_by(policy_id=self.annual).count(), 0)
+        self.assertEquals(PolicyAccounting(self.annual).return_account_balance(date(2015, 3, 1)), 0)
+
+    def test_incremental(self):
+        report = self.run_nightly(2, incremental=True)
+        self.assert_report(report)
+        self.assertEquals(report.evaluated, 3)
+
+        # Nothing changed and no event was reached since
+        report = self.run_nightly(2, incremental=True)
+        self.assertEquals(report.evaluated, 0)
+        self.assertEquals(report.cancelled, [])
+        self.assertEquals(report.pending, [self.monthly, self.annual])
+
+
+class TestBookSnapshot(unittest.TestCase):
+    """
+    Tests for utils.book_snapshot and the /reports/balances endpoint
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        agent = Contact('Snapshot Agent', 'Agent')
+        insured = Contact('Snapshot Insured', 'Named Insured')
+        db.session.add(agent)
+        db.session.add(insured)
+        db.session.commit()
+
+        policies = []
+        for billing_schedule, effective_date in [("Quarterly", date(2015, 1, 1)),
+                                                 ("Monthly", date(2015, 1, 1)),
+                                                 ("Monthly", date(2016, 1, 1))]:
+            policy = Policy('Snapshot Policy', effective_date, 1200)
+            policy.billing_schedule = billing_schedule
+            policy.agent = agent.id
+            policy.named_insured = insured.id
+            db.session.add(policy)
+            policies.append(policy)
+        db.session.commit()
+
+        for policy in policies:
+            PolicyAccounting(policy.id)
+        PolicyAccounting(policies[0].id).make_payment(date_cursor=date(2015, 1, 15), amount=300)
+        PolicyAccounting(policies[1].id).make_payment(date_cursor=date(2015, 3, 15), amount=150)
+
+        # Requests remove the session, which detaches the objects above, so
+        # only their ids are kept.
+        cls.contact_ids = [agent.id, insured.id]
+        cls.agent_id = agent.id
+        cls.policy_ids = [policy.id for policy in policies]
+
+    @classmethod
+    def tearDownClass(cls):
+        for model in [Payment, Invoice, LedgerEntry]:
+            model.query.filter(model.policy_id.in_(cls.policy_ids))\
+                       .delete(synchronize_session=False)
+        Policy.query.filter(Policy.id.in_(cls.policy_ids)).delete(synchronize_session=False)
+        Contact.query.filter(Contact.id.in_(cls.contact_ids))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def snapshot(self, date_cursor, group_by=None):
+        return book_snapshot(date_cursor, group_by).filter(Policy.id.in_(self.policy_ids)).all()
+
+    def test_matches_return_account_balance(self):
+        for date_cursor in [date(2015, 1, 1), date(2015, 3, 31), date(2016, 6, 30)]:
+            balances = dict((row.policy_id, row.balance) for row in self.snapshot(date_cursor))
+            for policy_id in self.policy_ids:
+                if policy_id not in balances:
+                    continue
+                pa = ReadOnlyPolicyAccounting(policy_id)
+                self.assertEquals(balances[policy_id], pa.return_account_balance(date_cursor))
+
+    def test_policies_in_effect_only(self):
+        rows = self.snapshot(date(2015, 3, 31))
+        self.assertEquals([row.policy_id for row in rows], self.policy_ids[:2])
+        self.assertEquals([(row.billed, row.paid, row.balance) for row in rows],
+                          [(300, 300, 0), (300, 150, 150)])
+
+    def test_prepaid_policy(self):
+        policy = Policy('Snapshot Prepaid Policy', date(2015, 3, 1), 1200)
+        policy.agent = self.agent_id
+        policy.named_insured = self.contact_ids[1]
+        db.session.add(policy)
+        db.session.commit()
+        policy_id = policy.id
+        try:
+            PolicyAccounting(policy_id).make_payment(date_cursor=date(2015, 2, 1), amount=5000)
+            date_cursor = date(2015, 2, 15)
+            pa = ReadOnlyPolicyAccounting(policy_id)
+            self.assertEquals(pa.return_account_balance(date_cursor), -5000)
+
+            rows = book_snapshot(date_cursor).filter(Policy.id == policy_id).all()
+            self.assertEquals([(row.billed, row.paid, row.balance) for row in rows],
+                              [(0, 5000, -5000)])
+            rows = book_snapshot(date_cursor, 'agent')\
+                .filter(Policy.id.in_(self.policy_ids + [policy_id])).all()
+            self.assertEquals([tuple(row) for row in rows],
+                              [(self.agent_id, 'Snapshot Agent', 3, 500, 5300, -4800)])
+        finally:
+            for model in [Payment, Invoice, LedgerEntry]:
+                model.query.filter_by(policy_id=policy_id).delete()
+            Policy.query.filter_by(id=policy_id).delete()
+            db.session.commit()
+
+    def test_group_by(self):
+        rows = self.snapshot(date(2015, 3, 31), 'agent')
+        self.assertEquals([tuple(row) for row in rows],
+                          [(self.agent_id, 'Snapshot Agent', 2, 600, 450, 150)])
+
+        rows = self.snapshot(date(2015, 3, 31), 'billing_schedule')
+        self.assertEquals([tuple(row) for row in rows],
+                          [('Monthly', 1, 300, 150, 150), ('Quarterly', 1, 300, 300, 0)])
+
+        self.assertRaises(ValueError, book_snapshot, date(2015, 3, 31), 'status')
+
+    def test_endpoint(self):
+        client = app.test_client()
+        response = client.get('/reports/balances?date=2015-03-31')
+        rows = [row for row in json.loads(response.data)
+                if row['policy_id'] in self.policy_ids]
+        self.assertEquals([row['balance'] for row in rows], [0, 150])
+
+        response = client.get('/reports/balances?date=2015-03-31&group_by=agent&format=csv')
+        self.assertEquals(response.mimetype, 'text/csv')
+        lines = response.data.splitlines()
+        self.assertEquals(lines[0], 'agent,agent_name,policies,billed,paid,balance')
+        self.assertIn('%d,Snapshot Agent,2,600,450,150' % self.agent_id, lines)
+
+        for url in ['/reports/balances?group_by=status',
+                    '/reports/balances?format=xml',
+                    '/reports/balances?date=nonsense']:
+            self.assertEquals(client.get(url).status_code, 400)
+
+    def test_csv_non_ascii(self):
+        Contact.query.filter_by(id=self.agent_id).update({'name': u'Agent M\xfcller \u6797'})
+        db.session.commit()
+        try:
+            response = app.test_client().get(
+                '/reports/balances?date=2015-03-31&group_by=agent&format=csv')
+            lines = response.data.splitlines()
+            response.close()
+            self.assertIn(u'{},Agent M\xfcller \u6797,2,600,450,150'.format(self.agent_id)
+                          .encode('utf-8'), lines)
+        finally:
+            Contact.query.filter_by(id=self.agent_id).update({'name': 'Snapshot Agent'})
+            db.session.commit()
+
+
+class TestLedger(unittest.TestCase):
+    """
+    Tests for the balance ledger behind PolicyAccounting.return_account_balance
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def balances(self, pa):
+        return [pa.return_account_balance(date_cursor=date(2015, month, 1))
+                for month in range(1, 13)]
+
+    def test_backdated_payment(self):
+        """
+        A payment dated before invoices already in the ledger must be
+        reflected in the balances after it.
+        """
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(date_cursor=date(2015, 6, 1), amount=300))
+        self.payments.append(pa.make_payment(date_cursor=date(2015, 1, 15), amount=300))
+
+        self.assertEquals(pa.return_account_balance(date_cursor=date(2015, 1, 14)), 300)
+        self.assertEquals(pa.return_account_balance(date_cursor=date(2015, 1, 15)), 0)
+        self.assertEquals(pa.return_account_balance(date_cursor=date(2015, 4, 1)), 300)
+        self.assertEquals(pa.return_account_balance(date_cursor=date(2015, 6, 1)), 0)
+        self.assertEquals(pa.return_account_balance(date_cursor=date(2015, 12, 31)), 600)
+
+    def test_change_billing_schedule_reverses_deleted_invoices(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(date_cursor=date(2015, 1, 15), amount=300))
+        pa.change_billing_schedule("Monthly", self.policy.effective_date)
+
+        # The payment made on 2015/1/15 counts from February onwards
+        self.assertEquals(self.balances(pa),
+                          [100] + [100 * m - 300 for m in range(2, 13)])
+
+    def test_rebuild_matches_incremental(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(date_cursor=date(2015, 3, 3), amount=250))
+        pa.change_billing_schedule("Two-Pay", self.policy.effective_date)
+        self.payments.append(pa.make_payment(date_cursor=date(2015, 2, 1), amount=100))
+
+        incremental = self.balances(pa)
+        rebuild_ledger([self.policy.id])
+        self.assertEquals(self.balances(pa), incremental)
+
+    def test_concurrent_postings(self):
+        """
+        Payments posted at the same time from several threads must each be
+        counted once in the running balances.
+        """
+        policy_id = self.policy.id
+        PolicyAccounting(policy_id)
+        self.addCleanup(lambda: Payment.query.filter_by(policy_id=policy_id).delete())
+
+        start = Event()
+        errors = []
+        def pay(thread):
+            start.wait()
+            try:
+                for month in range(1, 7):
+                    PolicyAccounting(policy_id).make_payment(
+                        date_cursor=date(2015, 13 - 2 * month + thread % 2, 10 + thread),
+                        amount=10 + thread)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.session.remove()
+
+        threads = [Thread(target=pay, args=(thread,)) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+
+        for month in range(1, 13):
+            date_cursor = date(2015, month, 28)
+            billed = db.session.query(db.func.sum(Invoice.amount_due))\
+                               .filter(Invoice.policy_id == policy_id)\
+                               .filter(Invoice.deleted == False)\
+                               .filter(Invoice.bill_date <= date_cursor)\
+                               .scalar() or 0
+            paid = db.session.query(db.func.sum(Payment.amount_paid))\
+                             .filter(Payment.policy_id == policy_id)\
+                             .filter(Payment.transaction_date <= date_cursor)\
+                             .scalar() or 0
+            self.assertEquals(ledger_balance(policy_id, date_cursor), billed - paid)
+
+
+class TestBulkMakeInvoices(unittest.TestCase):
+    """
+    Tests for utils.bulk_make_invoices
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.policies = []
+
+    def tearDown(self):
+        for policy in self.policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            LedgerEntry.query.filter_by(policy_id=policy.id).delete()
+            db.session.delete(policy)
+        db.session.commit()
+
+    def make_policy(self, effective_date, billing_schedule, annual_premium):
+        policy = Policy('Test Policy', effective_date, annual_premium)
+        policy.billing_schedule = billing_schedule
+        policy.named_insured = self.test_insured.id
+        policy.agent = self.test_agent.id
+        db.session.add(policy)
+        db.session.commit()
+        self.policies.append(policy)
+        return policy
+
+    def invoice_rows(self, policy):
+        return [(i.bill_date, i.due_date, i.cancel_date, i.amount_due)
+                for i in Invoice.query.filter_by(policy_id=policy.id)
+                                      .order_by(Invoice.bill_date)]
+
+    def test_matches_make_invoices_helper(self):
+        cases = [
+            (date(2015, 1, 1), "Annual", 1200),
+            (date(2015, 1, 31), "Monthly", 1000),
+            (date(2016, 2, 29), "Quarterly", 1601),
+            (date(2015, 8, 31), "Two-Pay", 365),
+        ]
+        for effective_date, billing_schedule, annual_premium in cases:
+            expected = self.make_policy(effective_date, billing_schedule, annual_premium)
+            PolicyAccounting(expected.id)
+
+            bulk = self.make_policy(effective_date, billing_schedule, annual_premium)
+            bulk_make_invoices([(bulk.id, effective_date, billing_schedule, annual_premium)])
+
+            self.assertEquals(self.invoice_rows(bulk), self.invoice_rows(expected))
+
+            balances = [
+                (PolicyAccounting(expected.id).return_account_balance(row[0]),
+                 PolicyAccounting(bulk.id).return_account_balance(row[0]))
+                for row in self.invoice_rows(expected)
+            ]
+            for expected_balance, bulk_balance in balances:
+                self.assertEquals(bulk_balance, expected_balance)
+
+    def test_rejects_invoiced_policies(self):
+        policy = self.make_policy(date(2015, 1, 1), "Annual", 1200)
+        PolicyAccounting(policy.id)
+        self.assertRaises(RuntimeError, bulk_make_invoices,
+                          [(policy.id, date(2015, 1, 1), "Annual", 1200)])
+
+    def test_rejects_bad_billing_schedule(self):
+        policy = self.make_policy(date(2015, 1, 1), "Annual", 1200)
+        self.assertRaises(ValueError, bulk_make_invoices,
+                          [(policy.id, date(2015, 1, 1), "Weekly", 1200)])
+
+
+class TestPendingCancellationBook(unittest.TestCase):
+    """
+    Tests for utils.pending_cancellation_due_to_non_pay
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policies = []
+        for billing_schedule in ["Annual", "Quarterly", "Monthly", "Monthly"]:
+            policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+            cls.policies.append(policy)
+        db.session.commit()
+
+        cls.payments = []
+        for policy, amount in zip(cls.policies, [1200, 300, 100, 0]):
+            pa = PolicyAccounting(policy.id)
+            if amount:
+                cls.payments.append(pa.make_payment(date_cursor=date(2015, 1, 15),
+                                                    amount=amount))
+
+    @classmethod
+    def tearDownClass(cls):
+        for payment in cls.payments:
+            db.session.delete(payment)
+        for policy in cls.policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            LedgerEntry.query.filter_by(policy_id=policy.id).delete()
+            db.session.delete(policy)
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def policy_ids(self):
+        return [policy.id for policy in self.policies]
+
+    def test_matches_per_policy_evaluation(self):
+        for d in [date(2015, 1, 10), date(2015, 2, 1), date(2015, 3, 1),
+                  date(2015, 5, 1), date(2015, 12, 31)]:
+            expected = set(
+                policy.id for policy in self.policies
+                if PolicyAccounting(policy.id)
+                       .evaluate_cancellation_pending_due_to_non_pay(date_cursor=d)
+            )
+            self.assertEquals(
+                pending_cancellation_due_to_non_pay(self.policy_ids(), date_cursor=d),
+                expected
+            )
+
+    def test_small_batches(self):
+        d = date(2015, 3, 1)
+        self.assertEquals(
+            pending_cancellation_due_to_non_pay(self.policy_ids(), date_cursor=d, batch_size=1),
+            pending_cancellation_due_to_non_pay(self.policy_ids(), date_cursor=d)
+        )
+
+    def test_whole_book(self):
+        d = date(2015, 3, 1)
+        pending = pending_cancellation_due_to_non_pay(date_cursor=d)
+        self.assertEquals(
+            pending & set(self.policy_ids()),
+            set(self.policy_ids()[2:])
+        )
+
+
+class TestSearchPolicies(unittest.TestCase):
+    """
+    Tests for utils.search_policies
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Searchable Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policies = []
+        for i in range(5):
+            policy = Policy('Searchable Policy %d' % i, date(2015, 1, 1), 1200)
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+            cls.policies.append(policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy in cls.policies:
+            db.session.delete(policy)
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def ids(self, policies):
+        return [policy.id for policy in policies]
+
+    def test_substring_of_policy_number(self):
+        policies, cursor = search_policies('HABLE pol')
+        self.assertEquals(self.ids(policies), self.ids(self.policies))
+        self.assertIsNone(cursor)
+
+    def test_named_insured_name(self):
+        policies, cursor = search_policies('able insured')
+        self.assertEquals(self.ids(policies), self.ids(self.policies))
+
+    def test_short_query(self):
+        policies, cursor = search_policies(' 3')
+        self.assertEquals(self.ids(policies), [self.policies[3].id])
+
+    def test_no_match(self):
+        self.assertEquals(search_policies('Nonexistent'), ([], None))
+
+    def test_pagination(self):
+        policies, cursor = search_policies('Searchable Policy', limit=2)
+        pages = [self.ids(policies)]
+        while cursor is not None:
+            policies, cursor = search_policies('Searchable Policy', after=cursor, limit=2)
+            pages.append(self.ids(policies))
+
+        self.assertEquals([len(page) for page in pages], [2, 2, 1])
+        self.assertEquals(sum(pages, []), self.ids(self.policies))
+
+    def test_index_follows_changes(self):
+        policy = self.policies[0]
+        policy.policy_number = 'Renamed Policy'
+        db.session.commit()
+        try:
+            self.assertEquals(self.ids(search_policies('renamed')[0]), [policy.id])
+            self.assertNotIn(policy.id, self.ids(search_policies('Searchable Policy')[0]))
+        finally:
+            policy.policy_number = 'Searchable Policy 0'
+            db.session.commit()
+
+
+class TestListingEndpoints(unittest.TestCase):
+    """
+    Tests for the /policies/<id>/invoices, /policies/<id>/payments and
+    /policies/<id>/summary endpoints
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Monthly"
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+        pa = PolicyAccounting(cls.policy.id)
+        for month in range(1, 7):
+            pa.make_payment(date_cursor=date(2015, month, 15), amount=100)
+
+        # Requests remove the session, which detaches the objects above, so
+        # only their ids are kept.
+        cls.policy_id = cls.policy.id
+        cls.contact_ids = [cls.test_agent.id, cls.test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        Payment.query.filter_by(policy_id=cls.policy_id).delete()
+        Invoice.query.filter_by(policy_id=cls.policy_id).delete()
+        LedgerEntry.query.filter_by(policy_id=cls.policy_id).delete()
+        Policy.query.filter_by(id=cls.policy_id).delete()
+        Contact.query.filter(Contact.id.in_(cls.contact_ids))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def get(self, url):
+        response = self.client.get(url.format(id=self.policy_id))
+        return response.status_code, json.loads(response.data)
+
+    def test_invoices_up_to_date(self):
+        status, invoices = self.get('/policies/{id}/invoices?date=2015-03-01')
+        self.assertEquals(status, 200)
+        self.assertEquals([i['bill_date'] for i in invoices],
+                          ['2015-01-01', '2015-02-01', '2015-03-01'])
+
+    def test_invoices_pages(self):
+        status, first = self.get('/policies/{id}/invoices?date=2015-12-31&limit=5')
+        self.assertEquals(len(first), 5)
+        status, rest = self.get('/policies/{id}/invoices?date=2015-12-31&after=%d'
+                                % first[-1]['id'])
+        self.assertEquals(len(rest), 7)
+        self.assertEquals(rest[0]['bill_date'], '2015-06-01')
+
+    def test_payments_date_and_limit(self):
+        status, payments = self.get('/policies/{id}/payments')
+        self.assertEquals(len(payments), 6)
+        status, payments = self.get('/policies/{id}/payments?date=2015-03-31&limit=2')
+        self.assertEquals([p['transaction_date'] for p in payments],
+                          ['2015-01-15', '2015-02-15'])
+
+    def test_limit_bounds(self):
+        for limit in ['0', '-1']:
+            status, invoices = self.get('/policies/{id}/invoices?date=2015-12-31&limit=' + limit)
+            self.assertEquals(len(invoices), 1)
+        original, endpoints.MAX_PAGE_SIZE = endpoints.MAX_PAGE_SIZE, 5
+        try:
+            status, invoices = self.get('/policies/{id}/invoices?date=2015-12-31&limit=1000')
+            self.assertEquals(len(invoices), 5)
+        finally:
+            endpoints.MAX_PAGE_SIZE = original
+
+    def test_summary(self):
+        status, summary = self.get('/policies/{id}/summary?date=2015-03-01')
+        self.assertEquals(status, 200)
+        self.assertEquals(summary['policy']['id'], self.policy_id)
+        self.assertEquals(len(summary['invoices']), 3)
+        # Only the payments made up to the date are listed and counted
+        self.assertEquals([p['transaction_date'] for p in summary['payments']],
+                          ['2015-01-15', '2015-02-15'])
+        self.assertEquals(summary['balance'], 100)
+        self.assertFalse(summary['past_due'])
+        self.assertIsNone(summary['cancellation'])
+
+        status, summary = self.get('/policies/{id}/summary?date=2015-08-01')
+        self.assertEquals((len(summary['invoices']), len(summary['payments'])), (8, 6))
+        self.assertEquals(summary['balance'], 200)
+        self.assertTrue(summary['past_due'])
+
+    def test_summary_unknown_policy(self):
+        status, body = self.get('/policies/0/summary')
+        self.assertEquals(status, 404)
+
+    def test_bad_arguments(self):
+        for url in ['/policies/{id}/invoices?date=nonsense',
+                    '/policies/{id}/summary?date=nonsense',
+                    '/policies/{id}/invoices?limit=many',
+                    '/policies/{id}/payments?after=0']:
+            status, body = self.get(url)
+            self.assertEquals(status, 400)
+            self.assertIn('error', body)
+
+
+class TestRowEncoder(unittest.TestCase):
+    """
+    Tests for Serializable.row_encoder
+    """
+
+    def assertEncodesLikeToDict(self, model):
+        encode = model.row_encoder()
+        objects = model.query.order_by(model.id).all()
+        rows = db.session.query(*model.serializable_columns()).order_by(model.id).all()
+        self.assertTrue(objects)
+        for o, row in zip(objects, rows):
+            self.assertEquals(encode(row), json.dumps(o.to_dict(), default=str))
+
+    def test_policies(self):
+        self.assertEncodesLikeToDict(Policy)
+
+    def test_contacts(self):
+        self.assertEncodesLikeToDict(Contact)
+
+    def test_invoices(self):
+        self.assertEncodesLikeToDict(Invoice)
+
+    def test_payments(self):
+        self.assertEncodesLikeToDict(Payment)
+
+    def test_key_order(self):
+        invoice = Invoice.query.first()
+        self.assertEquals(tuple(invoice.to_dict().keys()), Invoice.serializable_cols)
+
+
+class TestPolicyCache(unittest.TestCase):
+    """
+    Tests for cache.PolicyCache and its use by PolicyAccounting
+    """
+
+    def test_lru_eviction(self):
+        cache = PolicyCache(max_size=2, ttl=60)
+        cache.set('balance', 1, date(2015, 1, 1), 10)
+        cache.set('balance', 2, date(2015, 1, 1), 20)
+        self.assertEquals(cache.get('balance', 1, date(2015, 1, 1)), 10)
+        cache.set('balance', 3, date(2015, 1, 1), 30)
+
+        self.assertIsNone(cache.get('balance', 2, date(2015, 1, 1)))
+        self.assertEquals(cache.get('balance', 1, date(2015, 1, 1)), 10)
+        self.assertEquals(cache.get('balance', 3, date(2015, 1, 1)), 30)
+        stats = cache.stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['evictions']), (3, 1, 1))
+
+    def test_ttl(self):
+        cache = PolicyCache(max_size=2, ttl=-1)
+        cache.set('balance', 1, date(2015, 1, 1), 10)
+        self.assertIsNone(cache.get('balance', 1, date(2015, 1, 1)))
+        self.assertEquals(cache.stats()['size'], 0)
+
+    def test_invalidate(self):
+        cache = PolicyCache(max_size=10, ttl=60)
+        cache.set('balance', 1, date(2015, 1, 1), 10)
+        cache.set('invoices', 1, date(2015, 1, 1), '[]')
+        cache.set('balance', 2, date(2015, 1, 1), 20)
+        cache.invalidate(1)
+
+        self.assertIsNone(cache.get('balance', 1, date(2015, 1, 1)))
+        self.assertIsNone(cache.get('invoices', 1, date(2015, 1, 1)))
+        self.assertEquals(cache.get('balance', 2, date(2015, 1, 1)), 20)
+
+    def test_byte_limits(self):
+        cache = PolicyCache(max_size=10, ttl=60, max_bytes=10, max_entry_bytes=6)
+        cache.set('invoices', 1, date(2015, 1, 1), 'x' * 7)
+        self.assertIsNone(cache.get('invoices', 1, date(2015, 1, 1)))
+
+        cache.set('invoices', 1, date(2015, 1, 1), 'x' * 5)
+        cache.set('invoices', 2, date(2015, 1, 1), 'x' * 5)
+        cache.set('balance', 2, date(2015, 1, 1), 20)
+        self.assertEquals(cache.stats()['bytes'], 10)
+        cache.set('payments', 2, date(2015, 1, 1), 'x')
+        self.assertIsNone(cache.get('invoices', 1, date(2015, 1, 1)))
+        self.assertEquals(cache.get('balance', 2, date(2015, 1, 1)), 20)
+        self.assertEquals(cache.stats()['bytes'], 6)
+
+        cache.invalidate(2)
+        self.assertEquals((cache.stats()['size'], cache.stats()['bytes']), (0, 0))
+
+    def test_stale_token(self):
+        cache = PolicyCache(max_size=10, ttl=60)
+        token = cache.token(1)
+        cache.invalidate(1)
+        cache.set('balance', 1, date(2015, 1, 1), 10, token)
+        self.assertIsNone(cache.get('balance', 1, date(2015, 1, 1)))
+
+    def test_make_payment_invalidates_balance(self):
+        agent = Contact('Test Agent', 'Agent')
+        db.session.add(agent)
+        db.session.commit()
+        policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        policy.agent = agent.id
+        db.session.add(policy)
+        db.session.commit()
+        try:
+            pa = PolicyAccounting(policy.id)
+            d = date(2015, 2, 1)
+            self.assertEquals(pa.return_account_balance(d), 1200)
+            self.assertEquals(policy_cache.get('balance', policy.id, d), 1200)
+
+            payment = pa.make_payment(contact_id=agent.id, date_cursor=d, amount=200)
+            self.assertIsNone(policy_cache.get('balance', policy.id, d))
+            self.assertEquals(pa.return_account_balance(d), 1000)
+        finally:
+            Payment.query.filter_by(policy_id=policy.id).delete()
+            Invoice.query.filter_by(policy_id=policy.id).delete()
+            LedgerEntry.query.filter_by(policy_id=policy.id).delete()
+            db.session.delete(policy)
+            db.session.delete(agent)
+            db.session.commit()
+            policy_cache.invalidate(policy.id)
+
+
+class TestImportPayments(unittest.TestCase):
+    """
+    Tests for utils.import_payments and utils.import_payments_csv
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+        PolicyAccounting(cls.policy.id)
+
+    @classmethod
+    def tearDownClass(cls):
+        for invoice in cls.policy.invoices:
+            db.session.delete(invoice)
+        LedgerEntry.query.filter_by(policy_id=cls.policy.id).delete()
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def tearDown(self):
+        Payment.query.filter_by(policy_id=self.policy.id).delete()
+        db.session.commit()
+        rebuild_ledger([self.policy.id])
+
+    def balances(self):
+        pa = PolicyAccounting(self.policy.id)
+        return [pa.return_account_balance(date_cursor=date(2015, month, 20))
+                for month in range(1, 13)]
+
+    def test_import(self):
+        report = import_payments([
+            (self.policy.id, None, 300, date(2015, 4, 10)),
+            (str(self.policy.id), str(self.test_agent.id), '200', '2015-01-15'),
+            (self.policy.id, '', 100, '2015-01-15'),
+        ], batch_size=2)
+
+        self.assertEquals(report.imported, 3)
+        self.assertEquals(report.rejected, [])
+
+        payments = Payment.query.filter_by(policy_id=self.policy.id)\
+                                .order_by(Payment.id).all()
+        self.assertEquals([p.contact_id for p in payments],
+                          [self.test_insured.id, self.test_agent.id, self.test_insured.id])
+
+        imported = self.balances()
+        self.assertEquals(imported[0], 0)
+        self.assertEquals(imported[3], 0)
+        rebuild_ledger([self.policy.id])
+        self.assertEquals(self.balances(), imported)
+
+    def test_rejected_rows(self):
+        report = import_payments([
+            (self.policy.id, None, 300, date(2015, 4, 10)),
+            (0, None, 300, date(2015, 4, 10)),
+            (self.policy.id, None, 'lots', date(2015, 4, 10)),
+            (self.policy.id, None, -5, date(2015, 4, 10)),
+            (self.policy.id, None, 300, 'someday'),
+            (self.policy.id, None, 300),
+            (self.policy.id, None, True, date(2015, 4, 10)),
+            (self.policy.id, None, 300.0, date(2015, 4, 10)),
+            (self.policy.id, None, '3.00', date(2015, 4, 10)),
+        ])
+
+        self.assertEquals(report.imported, 1)
+        self.assertEquals([r[0] for r in report.rejected], [2, 3, 4, 5, 6, 7, 8, 9])
+        self.assertEquals(report.rejected[0][2], "Unknown policy")
+
+    def test_units(self):
+        for unit, amounts in [('cents', [300, 300L, '300']),
+                              ('dollars', [3, '3.00', '$3', Decimal('3')])]:
+            report = import_payments([(self.policy.id, None, amount, date(2015, 4, 10))
+                                      for amount in amounts + [3.0]], unit=unit)
+            self.assertEquals(report.imported, len(amounts))
+            self.assertEquals([r[0] for r in report.rejected], [len(amounts) + 1])
+            self.assertEquals([p.amount_paid for p in
+                               Payment.query.filter_by(policy_id=self.policy.id)],
+                              [300] * len(amounts))
+            Payment.query.filter_by(policy_id=self.policy.id).delete()
+            db.session.commit()
+
+        self.assertRaises(ValueError, import_payments, [], unit='euros')
+
+    def test_csv(self):
+        stream = StringIO(
+            "policy_id,contact_id,amount,date\n"
+            "{0},,3.00,2015-01-15\n"
+            "{0},{1},$3,2015-04-15\n"
+            "nonsense,,300,2015-04-15\n".format(self.policy.id, self.test_agent.id)
+        )
+        report = import_payments_csv(stream)
+
+        self.assertEquals(report.imported, 2)
+        self.assertEquals(len(report.rejected), 1)
+        self.assertEquals(self.balances()[:6], [0, 0, 0, 0, 0, 0])
+
+
+class TestDatabase(unittest.TestCase):
+    """
+    Tests for database.AccountingSQLAlchemy's engines
+    """
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + self.path
+        self.app.config['SQLALCHEMY_POOL_SIZE'] = 3
+        self.app.config['SQLALCHEMY_MAX_OVERFLOW'] = 2
+        self.app.config['SQLITE_PRAGMAS'] = [('journal_mode', 'WAL'),
+                                             ('synchronous', 'NORMAL'),
+                                             ('busy_timeout', 1234)]
+        self.db = AccountingSQLAlchemy(self.app)
+        self.engine = self.db.get_engine(self.app)
+        self.engine.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)")
+
+    def tearDown(self):
+        self.db.readonly_session.remove()
+        self.db.get_readonly_engine().dispose()
+        self.engine.dispose()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def pragma(self, engine, name):
+        return engine.execute("PRAGMA {}".format(name)).scalar()
+
+    def test_pragmas_applied_on_connect(self):
+        self.assertEquals(self.pragma(self.engine, 'journal_mode'), 'wal')
+        self.assertEquals(self.pragma(self.engine, 'synchronous'), 1)
+        self.assertEquals(self.pragma(self.engine, 'busy_timeout'), 1234)
+        self.assertEquals(self.pragma(self.engine, 'query_only'), 0)
+
+    def test_pool_settings(self):
+        for engine in [self.engine, self.db.get_readonly_engine()]:
+            self.assertIsInstance(engine.pool, QueuePool)
+            self.assertEquals(engine.pool.size(), 3)
+            self.assertEquals(engine.pool._max_overflow, 2)
+
+    def test_readonly_engine_refuses_writes(self):
+        self.engine.execute("INSERT INTO items (id) VALUES (1)")
+        engine = self.db.get_readonly_engine()
+        self.assertIsNot(engine, self.engine)
+        self.assertEquals(self.pragma(engine, 'query_only'), 1)
+        self.assertEquals(self.pragma(engine, 'busy_timeout'), 1234)
+        session = self.db.readonly_session
+        self.assertEquals(session.execute("SELECT count(*) FROM items").scalar(), 1)
+        self.assertRaises(OperationalError, session.execute,
+                          "INSERT INTO items (id) VALUES (2)")
+        session.rollback()
+        self.assertEquals(self.engine.execute("SELECT count(*) FROM items").scalar(), 1)
+
+    def test_sqlite_version_check(self):
+        check_sqlite_version()
+        check_sqlite_version('3.34.0')
+        for version in ['3.33.0', '3.24.0', '2.8.17']:
+            self.assertRaises(RuntimeError, check_sqlite_version, version)
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Tests for metrics.Metrics
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(insured)
+        db.session.commit()
+
+        policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        policy.named_insured = insured.id
+        db.session.add(policy)
+        db.session.commit()
+        PolicyAccounting(policy.id)
+
+        # Requests remove the session, which detaches the objects above, so
+        # only their ids are kept.
+        cls.insured_id = insured.id
+        cls.policy_id = policy.id
+
+    @classmethod
+    def tearDownClass(cls):
+        for model in [PolicyCancellation, Invoice, LedgerEntry]:
+            model.query.filter_by(policy_id=cls.policy_id).delete()
+        Policy.query.filter_by(id=cls.policy_id).delete()
+        Contact.query.filter_by(id=cls.insured_id).delete()
+        db.session.commit()
+
+    def setUp(self):
+        policy_cache.clear()
+        metrics.reset()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_method_totals(self):
+        pa = ReadOnlyPolicyAccounting(self.policy_id)
+        pa.return_account_balance(date(2015, 6, 1))
+        pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 6, 1))
+
+        totals = metrics.totals()
+        balance = totals['PolicyAccounting.return_account_balance']
+        self.assertEquals((balance['calls'], balance['statements'], balance['rows']), (1, 1, 1))
+        pending = totals['PolicyAccounting.evaluate_cancellation_pending_due_to_non_pay']
+        self.assertEquals((pending['calls'], pending['statements'], pending['rows']), (1, 2, 2))
+
+    def test_request_headers_and_totals(self):
+        client = app.test_client()
+        response = client.get('/policies/{}/invoices?date=2015-12-31'.format(self.policy_id))
+        self.assertEquals(len(json.loads(response.data)), 4)
+        response.close()
+        self.assertIn('X-SQL-Statements', response.headers)
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+        # The policy's version, then its invoices
+        totals = metrics.totals()['GET /policies/<int:id>/invoices']
+        self.assertEquals((totals['calls'], totals['statements'], totals['rows']), (1, 2, 5))
+        self.assertTrue(totals['serialize_seconds'] > 0)
+
+        body = client.get('/metrics').data
+        self.assertIn('accounting_rows_total{name="GET /policies/<int:id>/invoices"} 5', body)
+
+    def test_disabled(self):
+        metrics.disable()
+        encoder = Invoice.row_encoder()
+        self.assertIs(metrics.timed_serializer(encoder), encoder)
+
+        ReadOnlyPolicyAccounting(self.policy_id).return_account_balance(date(2015, 6, 1))
+        response = app.test_client().get('/policies/{}/payments'.format(self.policy_id))
+        response.data
+        response.close()
+        self.assertNotIn('X-SQL-Statements', response.headers)
+        self.assertEquals(metrics.totals(), {})
+
+
+class TestMoney(unittest.TestCase):
+    """
+    Tests for the money helpers, exact installments and
+    utils.migrate_money_to_cents
+    """
+
+    def test_dollars_to_cents(self):
+        self.assertEquals(dollars_to_cents('12.34'), 1234)
+        self.assertEquals(dollars_to_cents('$1,234.5'), 123450)
+        self.assertEquals(dollars_to_cents('.07'), 7)
+        self.assertEquals(dollars_to_cents('-3'), -300)
+        self.assertEquals(dollars_to_cents('1.2300'), 123)
+        self.assertEquals(dollars_to_cents(12), 1200)
+        for value in ['', '.', 'lots', '1.234', '1.2.3', None, 12.0, True]:
+            self.assertRaises(ValueError, dollars_to_cents, value)
+
+    def test_parse_cents(self):
+        self.assertEquals(parse_cents(1234), 1234)
+        self.assertEquals(parse_cents(' 1234 '), 1234)
+        self.assertEquals(parse_cents('-5'), -5)
+        for value in ['', '12.34', '$12', 'lots', None, 12.0, True, Decimal('12')]:
+            self.assertRaises(ValueError, parse_cents, value)
+
+    def test_split_cents(self):
+        self.assertEquals(split_cents(1000, 3), [334, 333, 333])
+        self.assertEquals(split_cents(1200, 12), [100] * 12)
+        self.assertEquals(split_cents(5, 1), [5])
+        for total in [0, 1, 99999, 100001]:
+            for parts in [1, 2, 4, 12]:
+                self.assertEquals(sum(split_cents(total, parts)), total)
+
+    def test_installments_add_up_to_premium(self):
+        policy = Policy('Test Policy', date(2015, 1, 1), 100001)
+        policy.billing_schedule = "Monthly"
+        db.session.add(policy)
+        db.session.commit()
+        policy_id = policy.id
+        try:
+            pa = PolicyAccounting(policy_id)
+            amounts = [i.amount_due for i in
+                       Invoice.query.filter_by(policy_id=policy_id).order_by(Invoice.bill_date)]
+            self.assertEquals(amounts, [8338] + [8333] * 11)
+            self.assertEquals(pa.return_account_balance(date(2015, 12, 31)), 100001)
+        finally:
+            for model in [Invoice, LedgerEntry]:
+                model.query.filter_by(policy_id=policy_id).delete()
+            Policy.query.filter_by(id=policy_id).delete()
+            db.session.commit()
+
+    def test_migrate_money_to_cents(self):
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        engine = create_engine('sqlite:///' + path)
+        try:
+            db.metadata.create_all(bind=engine)
+            # A new schema is in cents already
+            self.assertEquals(engine.execute("PRAGMA user_version").scalar(), 1)
+            self.assertFalse(migrate_money_to_cents(engine))
+            # Make it a database from the days of whole dollars
+            engine.execute("PRAGMA user_version = 0")
+            engine.execute(Contact.__table__.insert(), id=1, name='Test Insured',
+                           role='Named Insured')
+            engine.execute(Policy.__table__.insert(), id=1, policy_number='Test Policy',
+                           effective_date=date(2015, 1, 1), annual_premium=1200)
+            engine.execute(Invoice.__table__.insert(), policy_id=1, bill_date=date(2015, 1, 1),
+                           due_date=date(2015, 2, 1), cancel_date=date(2015, 2, 15),
+                           amount_due=1200)
+            engine.execute(Payment.__table__.insert(), policy_id=1, contact_id=1,
+                           amount_paid=400, transaction_date=date(2015, 1, 15))
+            engine.execute(LedgerEntry.__table__.insert(), policy_id=1,
+                           entry_date=date(2015, 1, 15), amount=-400, balance=800)
+
+            def amounts():
+                return [engine.execute("SELECT annual_premium FROM policies").scalar(),
+                        engine.execute("SELECT amount_due FROM invoices").scalar(),
+                        engine.execute("SELECT amount_paid FROM payments").scalar(),
+                        tuple(engine.execute("SELECT amount, balance FROM ledger_entries").first())]
+
+            self.assertTrue(migrate_money_to_cents(engine))
+            self.assertEquals(amounts(), [120000, 120000, 40000, (-40000, 80000)])
+            # Running it again leaves the amounts alone
+            self.assertFalse(migrate_money_to_cents(engine))
+            self.assertEquals(amounts(), [120000, 120000, 40000, (-40000, 80000)])
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+
+class TestLoadPolicies(unittest.TestCase):
+    """
+    Tests for utils.load_policies and utils.with_relations
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        agent = Contact('Test Agent', 'Agent')
+        insured = Contact('Test Insured', 'Named Insured')
+        db.session.add_all([agent, insured])
+        db.session.commit()
+
+        policies = []
+        for i in range(12):
+            policy = Policy('Test Policy %d' % i, date(2015, 1, 1), 1200)
+            policy.billing_schedule = "Quarterly"
+            policy.agent = agent.id
+            policy.named_insured = insured.id
+            db.session.add(policy)
+            policies.append(policy)
+        db.session.commit()
+
+        cls.contact_ids = [agent.id, insured.id]
+        cls.policy_ids = [policy.id for policy in policies]
+        bulk_make_invoices((p.id, p.effective_date, p.billing_schedule, p.annual_premium)
+                           for p in policies)
+        PolicyAccounting(cls.policy_ids[0]).change_billing_schedule("Annual", date(2015, 1, 1))
+        db.session.add(PolicyCancellation(cls.policy_ids[1], 'Underwriting', date(2015, 6, 1)))
+        db.session.commit()
+        db.session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        for model in [PolicyCancellation, Invoice, LedgerEntry]:
+            model.query.filter(model.policy_id.in_(cls.policy_ids)).delete(synchronize_session=False)
+        Policy.query.filter(Policy.id.in_(cls.policy_ids)).delete(synchronize_session=False)
+        Contact.query.filter(Contact.id.in_(cls.contact_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def statements(self, function):
+        """
+        Calls function and returns the number of statements it ran.
+        """
+        metrics.enable()
+        scope = metrics.start('TestLoadPolicies')
+        try:
+            function()
+        finally:
+            metrics.stop(scope)
+            metrics.disable()
+            metrics.reset()
+        return scope.statements
+
+    def use_relations(self, policies):
+        return [(p.agent_relation.name, p.named_insured_relation.name, p.cancelled,
+                 [i.amount_due for i in p.active_invoices])
+                for p in policies]
+
+    def test_statements_do_not_grow_with_policies(self):
+        for count in [1, 4, 12]:
+            db.session.remove()
+            self.assertEquals(self.statements(lambda: self.use_relations(
+                load_policies(self.policy_ids[:count]))), 2)
+
+    def test_relations_loaded(self):
+        policies = load_policies(reversed(self.policy_ids))
+        self.assertEquals([p.id for p in policies], self.policy_ids)
+        self.assertEquals(self.use_relations(policies[:3]), [
+            ('Test Agent', 'Test Insured', False, [1200]),
+            ('Test Agent', 'Test Insured', True, [300, 300, 300, 300]),
+            ('Test Agent', 'Test Insured', False, [300, 300, 300, 300]),
+        ])
+
+    def test_batches(self):
+        self.assertEquals(self.statements(
+            lambda: load_policies(self.policy_ids, batch_size=5)), 6)
+        self.assertEquals(self.statements(
+            lambda: load_policies(self.policy_ids, ['agent'], batch_size=5)), 3)
+
+    def test_unknown_relation(self):
+        self.assertRaises(ValueError, with_relations, Policy.query, ['payments'])
+
+
+class TestBillingCalendar(unittest.TestCase):
+    """
+    Tests for utils.BillingCalendar
+    """
+
+    def test_matches_relativedelta(self):
+        calendar = BillingCalendar(PolicyAccounting.billing_schedules)
+        effective_date = date(2015, 1, 1)
+        while effective_date < date(2017, 1, 1):
+            for billing_schedule, periodicity in PolicyAccounting.billing_schedules.items():
+                periodicity = periodicity or 1
+                expected = []
+                for i in range(periodicity):
+                    bill_date = effective_date + relativedelta(months=i * 12 / periodicity)
+                    expected.append((bill_date,
+                                     bill_date + relativedelta(months=1),
+                                     bill_date + relativedelta(months=1, days=14)))
+                self.assertEquals(calendar.dates(effective_date, billing_schedule),
+                                  tuple(expected))
+            effective_date += relativedelta(days=1)
+
+    def test_memoized_and_bounded(self):
+        calendar = BillingCalendar(PolicyAccounting.billing_schedules, max_size=2)
+        dates = calendar.dates(date(2015, 1, 31), 'Monthly')
+        self.assertIs(calendar.dates(date(2015, 1, 31), 'Monthly'), dates)
+        calendar.dates(date(2015, 2, 1), 'Monthly')
+        calendar.dates(date(2015, 2, 2), 'Monthly')
+        self.assertEquals(calendar.stats(),
+                          {'size': 2, 'max_size': 2, 'hits': 1, 'misses': 3})
+        self.assertIsNot(calendar.dates(date(2015, 1, 31), 'Monthly'), dates)
+
+    def test_warm(self):
+        calendar = BillingCalendar(PolicyAccounting.billing_schedules)
+        self.assertEquals(calendar.warm(date(2015, 1, 1), date(2015, 1, 10), ['Monthly', 'Annual']), 20)
+        calendar.dates(date(2015, 1, 5), 'Annual')
+        self.assertEquals(calendar.stats()['hits'], 1)
+        self.assertEquals(calendar.stats()['size'], 20)
+
+
+class TestCancellationSchedule(unittest.TestCase):
+    """
+    Tests for utils.run_cancellation_schedule and the marking of policies
+    changed by PolicyAccounting
+    """
+
+    def setUp(self):
+        insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(insured)
+        db.session.commit()
+        self.insured_id = insured.id
+
+        policies = []
+        for i in range(4):
+            policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+            policy.billing_schedule = "Quarterly"
+            policy.named_insured = insured.id
+            db.session.add(policy)
+            policies.append(policy)
+        db.session.commit()
+        self.policy_ids = [policy.id for policy in policies]
+        for policy_id in self.policy_ids:
+            PolicyAccounting(policy_id)
+        self.low, self.high = self.policy_ids[0], self.policy_ids[-1] + 1
+
+    def tearDown(self):
+        for model in [PolicyCancellation, Payment, Invoice, LedgerEntry, CancellationSchedule]:
+            model.query.filter(model.policy_id.in_(self.policy_ids))\
+                       .delete(synchronize_session=False)
+        Policy.query.filter(Policy.id.in_(self.policy_ids)).delete(synchronize_session=False)
+        Contact.query.filter_by(id=self.insured_id).delete()
+        db.session.commit()
+        db.session.remove()
+
+    def run_schedule(self, date_cursor):
+        return run_cancellation_schedule(date_cursor, self.low, self.high)
+
+    def test_only_changed_or_due_policies_are_evaluated(self):
+        self.assertEquals(self.run_schedule(date(2015, 1, 10)), ([], 4))
+        self.assertEquals(self.run_schedule(date(2015, 1, 20)), ([], 0))
+
+        PolicyAccounting(self.policy_ids[0]).make_payment(date_cursor=date(2015, 1, 25), amount=300)
+        self.assertEquals(self.run_schedule(date(2015, 1, 30)), ([], 1))
+
+        # Every first installment is due on 2/1
+        self.assertEquals(self.run_schedule(date(2015, 2, 1)), ([], 4))
+        self.assertEquals(scheduled_pending(self.low, self.high), set(self.policy_ids[1:]))
+
+        PolicyAccounting(self.policy_ids[1]).change_billing_schedule("Annual", date(2015, 1, 1))
+        self.assertEquals(self.run_schedule(date(2015, 2, 2)), ([], 1))
+
+        # And can be cancelled from 2/15
+        cancellations, evaluated = self.run_schedule(date(2015, 2, 15))
+        self.assertEquals(evaluated, 4)
+        self.assertEquals(sorted(c.policy_id for c in cancellations), self.policy_ids[1:])
+
+    def test_matches_full_evaluation(self):
+        pa = PolicyAccounting(self.policy_ids[0])
+        for month in [1, 4, 7]:
+            pa.make_payment(date_cursor=date(2015, month, 1), amount=300)
+        PolicyAccounting(self.policy_ids[1]).make_payment(date_cursor=date(2015, 5, 10), amount=600)
+        expected = dict((c.policy_id, c.date) for c in
+                        find_cancellations(self.policy_ids, date(2015, 12, 31)))
+
+        evaluated = 0
+        date_cursor = date(2015, 1, 1)
+        while date_cursor <= date(2015, 12, 31):
+            evaluated += self.run_schedule(date_cursor)[1]
+            self.assertEquals(scheduled_pending(self.low, self.high),
+                              pending_cancellation_due_to_non_pay(self.policy_ids, date_cursor))
+            date_cursor += relativedelta(days=3)
+
+        cancelled = PolicyCancellation.query.filter(
+            PolicyCancellation.policy_id.in_(self.policy_ids))
+        self.assertEquals(dict((c.policy_id, c.date) for c in cancelled), expected)
+        self.assertTrue(evaluated < len(self.policy_ids) * 122 / 4)
+
+    def test_changes_during_evaluation_are_not_lost(self):
+        scheduled = find_scheduled(date(2015, 1, 10), self.low, self.high)
+        cancellations, entries = evaluate_schedule(scheduled, date(2015, 1, 10))
+        PolicyAccounting(self.policy_ids[0]).make_payment(date_cursor=date(2015, 1, 5), amount=300)
+        save_schedule(cancellations, entries)
+
+        self.assertEquals([policy_id for policy_id, _ in
+                           find_scheduled(date(2015, 1, 10), self.low, self.high)],
+                          self.policy_ids[:1])
+
+
+class TestPaymentQueue(unittest.TestCase):
+    """
+    Tests for payment_queue.PaymentQueue and posting payments
+    """
+
+    def setUp(self):
+        insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(insured)
+        db.session.commit()
+        self.insured_id = insured.id
+
+        policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        policy.named_insured = insured.id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        PolicyAccounting(self.policy_id)
+        # Only flushed in the background when a put waits for room
+        self.queue = PaymentQueue(max_size=3, batch_size=10, flush_interval=60, timeout=0)
+
+    def tearDown(self):
+        self.queue.stop()
+        app.config['PAYMENT_QUEUE_ENABLED'] = False
+        for model in [QueuedPayment, Payment, Invoice, LedgerEntry, CancellationSchedule]:
+            model.query.filter_by(policy_id=self.policy_id).delete()
+        Policy.query.filter_by(id=self.policy_id).delete()
+        Contact.query.filter_by(id=self.insured_id).delete()
+        db.session.commit()
+        db.session.remove()
+        policy_cache.invalidate(self.policy_id)
+
+    def balance(self, include_queued=False):
+        return ReadOnlyPolicyAccounting(self.policy_id).return_account_balance(
+            date(2015, 3, 1), include_queued=include_queued)
+
+    def payments(self):
+        return [(p.amount_paid, p.transaction_date) for p in
+                Payment.query.filter_by(policy_id=self.policy_id).order_by(Payment.id)]
+
+    def test_queued_payments_are_flushed_in_order(self):
+        first = self.queue.put(self.policy_id, self.insured_id, 100, date(2015, 1, 10))
+        second = self.queue.put(self.policy_id, self.insured_id, 50, date(2015, 4, 10))
+        self.assertTrue(second > first)
+        self.assertEquals(self.queue.size(), 2)
+
+        self.assertEquals(self.payments(), [])
+        self.assertEquals(self.balance(), 300)
+        self.assertEquals(self.balance(include_queued=True), 200)
+
+        self.assertEquals(self.queue.flush(), 2)
+        self.assertEquals(self.queue.size(), 0)
+        self.assertEquals(self.payments(), [(100, date(2015, 1, 10)), (50, date(2015, 4, 10))])
+        self.assertEquals(self.balance(), 200)
+        self.assertEquals(self.balance(include_queued=True), 200)
+
+    def test_backpressure(self):
+        for day in range(1, 4):
+            self.queue.put(self.policy_id, self.insured_id, 10, date(2015, 1, day))
+        self.assertRaises(PaymentQueueFull, self.queue.put,
+                          self.policy_id, self.insured_id, 10, date(2015, 1, 4))
+
+        self.assertEquals(self.queue.flush(), 3)
+        self.queue.put(self.policy_id, self.insured_id, 10, date(2015, 1, 4))
+        self.assertEquals(self.queue.size(), 1)
+
+    def test_waiting_put_wakes_the_flusher(self):
+        for day in range(1, 4):
+            self.queue.put(self.policy_id, self.insured_id, 10, date(2015, 1, day))
+        self.queue.put(self.policy_id, self.insured_id, 10, date(2015, 1, 4), timeout=5)
+        self.assertEquals(self.queue.flushed, 3)
+
+    def test_flusher_thread(self):
+        self.queue.flush_interval = 0.01
+        self.queue.put(self.policy_id, self.insured_id, 100, date(2015, 1, 10))
+        for _ in range(500):
+            if self.queue.flushed:
+                break
+            time.sleep(0.01)
+        self.assertEquals(self.payments(), [(100, date(2015, 1, 10))])
+
+    def test_stop_flushes(self):
+        self.queue.put(self.policy_id, self.insured_id, 100, date(2015, 1, 10))
+        self.queue.put(self.policy_id, self.insured_id, 100, date(2015, 1, 11))
+        self.queue.put(self.policy_id, self.insured_id, 100, date(2015, 1, 12))
+        self.assertEquals(self.queue.stop(), 3)
+        self.assertEquals(len(self.payments()), 3)
+        self.assertEquals(QueuedPayment.query.filter_by(policy_id=self.policy_id).count(), 0)
+
+    def test_post_payment(self):
+        client = app.test_client()
+        response = client.post('/policies/{}/payments'.format(self.policy_id),
+                               data={'amount': '1.00', 'date': '2015-01-10'})
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(json.loads(response.data)['amount_paid'], 100)
+        self.assertEquals(self.payments(), [(100, date(2015, 1, 10))])
+
+        self.assertEquals(client.post('/policies/{}/payments'.format(self.policy_id),
+                                      data={'amount': 'lots'}).status_code, 400)
+        self.assertEquals(client.post('/policies/0/payments',
+                                      data={'amount': '1.00'}).status_code, 404)
+
+    def test_post_payment_amount_types(self):
+        client = app.test_client()
+        url = '/policies/{}/payments'.format(self.policy_id)
+        def post(amount):
+            return client.post(url, data=json.dumps({'amount': amount, 'date': '2015-01-10'}),
+                               content_type='application/json')
+
+        response = post('100')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(json.loads(response.data)['amount_paid'], 10000)
+        # Numbers would be ambiguous between dollars and cents
+        for amount in [100, 100.0, 1.5, True, None, ['1.00']]:
+            self.assertEquals(post(amount).status_code, 400)
+        self.assertEquals(self.payments(), [(10000, date(2015, 1, 10))])
+
+    def test_post_payment_write_behind(self):
+        app.config['PAYMENT_QUEUE_ENABLED'] = True
+        client = app.test_client()
+        url = '/policies/{}/payments'.format(self.policy_id)
+        original, endpoints.payment_queue = endpoints.payment_queue, self.queue
+        try:
+            response = client.post(url, data=json.dumps({'amount': '0.50', 'date': '2015-01-10'}),
+                                   content_type='application/json')
+            self.assertEquals(response.status_code, 202)
+            self.assertIn('queued', json.loads(response.data))
+            self.assertEquals(self.payments(), [])
+            self.assertEquals(self.balance(include_queued=True), 250)
+
+            client.post(url, data={'amount': '0.50', 'date': '2015-01-10'})
+            client.post(url, data={'amount': '0.50', 'date': '2015-01-10'})
+            response = client.post(url, data={'amount': '0.50', 'date': '2015-01-10'})
+            self.assertEquals(response.status_code, 503)
+            self.assertEquals(response.headers['Retry-After'], '1')
+        finally:
+            endpoints.payment_queue = original
+
+
+class TestPolicyVersions(unittest.TestCase):
+    """
+    Tests for policy versions and the ETags of the policy endpoints
+    """
+
+    def setUp(self):
+        insured = Contact('Versioned Insured', 'Named Insured')
+        db.session.add(insured)
+        db.session.commit()
+        self.insured_id = insured.id
+
+        policy = Policy('Versioned Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        policy.named_insured = insured.id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        PolicyAccounting(self.policy_id)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        for model in [PolicyCancellation, Payment, Invoice, LedgerEntry, CancellationSchedule,
+                      PolicyVersion]:
+            model.query.filter_by(policy_id=self.policy_id).delete()
+        Policy.query.filter_by(id=self.policy_id).delete()
+        Contact.query.filter_by(id=self.insured_id).delete()
+        db.session.commit()
+        db.session.remove()
+        policy_cache.invalidate(self.policy_id)
+
+    def version(self):
+        return policy_versions([self.policy_id])[self.policy_id][0]
+
+    def get(self, url, etag=None):
+        headers = {'If-None-Match': '"{}"'.format(etag)} if etag else {}
+        response = self.client.get(url.format(id=self.policy_id), headers=headers)
+        response.data
+        response.close()
+        return response
+
+    def test_changes_bump_the_version(self):
+        version = self.version()
+        pa = PolicyAccounting(self.policy_id)
+        pa.make_payment(date_cursor=date(2015, 1, 10), amount=300)
+        self.assertEquals(self.version(), version + 1)
+        pa.change_billing_schedule("Monthly", date(2015, 6, 1))
+        self.assertEquals(self.version(), version + 2)
+        import_payments([(self.policy_id, None, 100, date(2015, 2, 1))])
+        self.assertEquals(self.version(), version + 3)
+        pa.cancel_policy("Client", date(2015, 7, 1))
+        self.assertEquals(self.version(), version + 4)
+        self.assertEquals(policy_versions([0]), {})
+
+    def test_invoices_not_modified(self):
+        url = '/policies/{id}/invoices?date=2015-12-31'
+        response = self.get(url)
+        self.assertEquals(response.status_code, 200)
+        etag = response.get_etag()[0]
+        self.assertIsNotNone(response.last_modified)
+
+        metrics.enable()
+        try:
+            scope = metrics.start('test')
+            response = self.get(url, etag)
+            metrics.stop(scope)
+        finally:
+            metrics.disable()
+            metrics.reset()
+        # Answered from the policy's version alone
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.data, '')
+        self.assertEquals(response.get_etag()[0], etag)
+        self.assertEquals(scope.statements, 1)
+
+        # Other dates and pages are other listings
+        self.assertEquals(self.get('/policies/{id}/invoices?date=2015-06-30', etag).status_code, 200)
+        self.assertEquals(self.get(url + '&limit=2', etag).status_code, 200)
+
+        PolicyAccounting(self.policy_id).change_billing_schedule("Monthly", date(2015, 6, 1))
+        response = self.get(url, etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response.get_etag()[0], etag)
+
+    def test_payments_not_modified(self):
+        url = '/policies/{id}/payments'
+        etag = self.get(url).get_etag()[0]
+        self.assertEquals(self.get(url, etag).status_code, 304)
+
+        PolicyAccounting(self.policy_id).make_payment(date_cursor=date(2015, 1, 10), amount=300)
+        response = self.get(url, etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(json.loads(response.data)), 1)
+        self.assertEquals(self.get(url, response.get_etag()[0]).status_code, 304)
+
+    def test_cache_follows_versions_bumped_elsewhere(self):
+        """
+        A change made by another process bumps the version without
+        invalidating this process's cache.
+        """
+        url = '/policies/{id}/payments'
+        response = self.get(url)
+        etag = response.get_etag()[0]
+        self.assertEquals(json.loads(response.data), [])
+        # Cached now
+        self.assertEquals(json.loads(self.get(url).data), [])
+
+        db.session.add(Payment(self.policy_id, self.insured_id, 300, date(2015, 1, 10)))
+        touch_policies([self.policy_id])
+        db.session.commit()
+
+        response = self.get(url, etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([p['amount_paid'] for p in json.loads(response.data)], [300])
+        self.assertNotEquals(response.get_etag()[0], etag)
+
+    def test_large_listings_are_not_cached(self):
+        policy_cache.invalidate(self.policy_id)
+        url = '/policies/{id}/invoices?date=2015-12-31'
+        max_entry_bytes, policy_cache.max_entry_bytes = policy_cache.max_entry_bytes, 10
+        try:
+            size = policy_cache.stats()['size']
+            response = self.get(url)
+            self.assertEquals(len(json.loads(response.data)), 4)
+            self.assertEquals(policy_cache.stats()['size'], size)
+        finally:
+            policy_cache.max_entry_bytes = max_entry_bytes
+        self.get(url)
+        self.assertEquals(policy_cache.stats()['size'], size + 1)
+
+    def test_search_not_modified(self):
+        url = '/policies/search?query=versioned'
+        response = self.get(url)
+        self.assertEquals([p['id'] for p in json.loads(response.data)['policies']],
+                          [self.policy_id])
+        etag = response.get_etag()[0]
+        self.assertEquals(self.get(url, etag).status_code, 304)
+        self.assertEquals(self.get(url + '&limit=5', etag).status_code, 200)
+
+        PolicyAccounting(self.policy_id).change_billing_schedule("Annual", date(2015, 1, 1))
+        response = self.get(url, etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.data)['policies'][0]['billing_schedule'], 'Annual')
+
+    def test_search_follows_policy_and_agent_changes(self):
+        agent = Contact('Versioned Agent', 'Agent')
+        db.session.add(agent)
+        db.session.commit()
+        agent_id = agent.id
+        Policy.query.filter_by(id=self.policy_id).update({'agent': agent_id})
+        db.session.commit()
+        url = '/policies/search?query=versioned'
+        try:
+            etag = self.get(url).get_etag()[0]
+            self.assertEquals(self.get(url, etag).status_code, 304)
+
+            Contact.query.filter_by(id=agent_id).update({'name': 'Renamed Agent'})
+            db.session.commit()
+            response = self.get(url, etag)
+            self.assertEquals(response.status_code, 200)
+            policy = json.loads(response.data)['policies'][0]
+            self.assertEquals(policy['agent']['name'], 'Renamed Agent')
+
+            etag = response.get_etag()[0]
+            Policy.query.filter_by(id=self.policy_id).update({'annual_premium': 2400})
+            db.session.commit()
+            response = self.get(url, etag)
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(json.loads(response.data)['policies'][0]['annual_premium'], 2400)
+        finally:
+            Policy.query.filter_by(id=self.policy_id).update({'agent': None})
+            Contact.query.filter_by(id=agent_id).delete()
+            db.session.commit()
+
+
+class TestCompression(unittest.TestCase):
+    """
+    Tests for response compression and fingerprinted static files
+    """
+
+    def setUp(self):
+        insured = Contact('Compressed Insured', 'Named Insured')
+        db.session.add(insured)
+        db.session.commit()
+        self.insured_id = insured.id
+
+        policy = Policy('Compressed Policy', date(2015, 1, 1), 120000)
+        policy.billing_schedule = "Monthly"
+        policy.named_insured = insured.id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        PolicyAccounting(self.policy_id)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        for model in [Invoice, LedgerEntry, CancellationSchedule, PolicyVersion]:
+            model.query.filter_by(policy_id=self.policy_id).delete()
+        Policy.query.filter_by(id=self.policy_id).delete()
+        Contact.query.filter_by(id=self.insured_id).delete()
+        db.session.commit()
+        db.session.remove()
+        policy_cache.invalidate(self.policy_id)
+
+    def get(self, url, gzip=True, headers=None):
+        headers = dict(headers or {})
+        if gzip:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        response = self.client.get(url, headers=headers)
+        response.data
+        response.close()
+        return response
+
+    def gunzip(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def test_json_is_gzipped(self):
+        url = '/policies/{}/invoices?date=2015-12-31'.format(self.policy_id)
+        plain = self.get(url, gzip=False)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        response = self.get(url)
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(self.gunzip(response.data), plain.data)
+        self.assertEquals(len(json.loads(plain.data)), 12)
+
+        # The compressed copy has the same, but weak, ETag
+        etag, weak = response.get_etag()
+        self.assertTrue(weak)
+        self.assertEquals(etag, plain.get_etag()[0])
+        self.assertEquals(self.get(url, headers={'If-None-Match': 'W/"{}"'.format(etag)}).status_code, 304)
+
+        # Served from the policy cache, not streamed this time
+        response = self.get(url)
+        self.assertEquals(self.gunzip(response.data), plain.data)
+
+    def test_small_responses_are_not_gzipped(self):
+        response = self.get('/cache/stats')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('hits', json.loads(response.data))
+
+    def test_fingerprinted_static_files(self):
+        page = self.get('/', gzip=False).data
+        asset = static_assets.get('js/app.js')
+        url = '/static/' + asset.fingerprinted
+        self.assertIn(url, page)
+        self.assertNotIn('/static/js/app.js', page)
+
+        with open(os.path.join(app.static_folder, 'js', 'app.js'), 'rb') as f:
+            content = f.read()
+        response = self.get(url, gzip=False)
+        self.assertEquals(response.data, content)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+
+        response = self.get(url)
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(self.gunzip(response.data), content)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+        # Plain names and stale hashes get the file, without far-future caching
+        for stale in ['/static/js/app.js', '/static/js/app.000000000000.js']:
+            response = self.get(stale, gzip=False)
+            self.assertEquals(response.data, content)
+            self.assertNotIn('immutable', response.headers['Cache-Control'])
+        self.assertEquals(self.get('/static/js/missing.000000000000.js').status_code, 404)
@@ -1,10 +1,22 @@
 #!/user/bin/env python2.7
 
-from datetime import date, datetime
+import csv
+import time
+from calendar import monthrange
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from dateutil.parser import parse as date_parse
 from dateutil.relativedelta import relativedelta
+from itertools import groupby
+from operator import itemgetter
+from threading import Lock
 
-from accounting import db
-from models import Contact, Invoice, Payment, Policy, PolicyCancellation
+from accounting import app, db
+from cache import policy_cache
+from metrics import metrics
+from models import CancellationSchedule, Contact, Invoice, InvoiceArchive, LedgerEntry, \
+    Payment, Policy, PolicyCancellation, PolicyVersion, QueuedPayment, policy_search_ddl
+from money import MONEY_IN_CENTS_VERSION, dollars_to_cents, parse_cents, split_cents
 
 """
 #######################################################
@@ -12,7 +24,97 @@ This is the base code for the engineer project.
 #######################################################
 """
 
-class PolicyAccounting(object):
+class ReadOnlyPolicyAccounting(object):
+    """
+     Read-only accounting for a policy, built from a loaded Policy or a
+     bare policy id.  Nothing is loaded until a method needs it and nothing
+     is ever written, so it is cheap to build on read paths such as balance
+     lookups.  Use PolicyAccounting to record payments, invoices or
+     cancellations.
+    """
+    def __init__(self, policy):
+        if isinstance(policy, Policy):
+            self._policy = policy
+            self.policy_id = policy.id
+        else:
+            self._policy = None
+            self.policy_id = policy
+
+    @property
+    def policy(self):
+        """
+        The Policy, pulled from the DB the first time it is needed.
+        """
+        if self._policy is None:
+            self._policy = Policy.query.filter_by(id=self.policy_id).one()
+        return self._policy
+
+    @metrics.instrument('PolicyAccounting.return_account_balance')
+    def return_account_balance(self, date_cursor=None, include_queued=False):
+        """
+        Calculate account balance by computing the total invoices due
+        for the relevant policy and subtracting the sum of the payments
+        made on the policy.   If date_cursor is not specified, the 
+        calculation is made consider all invoices and payments made on
+        the policy up to (and including) the current date.  However, if 
+        a valid date_cursor is supplied, only invoices and payments 
+        occurring before the given date will be considered.  This is
+        useful in calculating, for instance, the amount that remains to
+        be paid on the entire policy.
+
+        With include_queued, payments accepted by the payment queue but not
+        yet flushed to the payments table are taken off as well.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+
+        if include_queued:
+            # The queue changes without invalidating the cache
+            return queued_balance(self.policy_id, date_cursor)
+
+        balance = policy_cache.get('balance', self.policy_id, date_cursor)
+        if balance is None:
+            token = policy_cache.token(self.policy_id)
+            # The ledger keeps a running total of every invoice and payment, so
+            # the balance is simply the latest total at or before date_cursor.
+            balance = ledger_balance(self.policy_id, date_cursor)
+            policy_cache.set('balance', self.policy_id, date_cursor, balance, token)
+        return balance
+
+    @metrics.instrument('PolicyAccounting.evaluate_cancellation_pending_due_to_non_pay')
+    def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
+        """
+         If this function returns true, an invoice
+         on a policy has passed the due date without
+         being paid in full. However, it has not necessarily
+         made it to the cancel_date yet.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+
+        # pull the amounts of all invoices due up to and including date_cursor
+        # for the relevant policy
+        invoices = db.session.query(Invoice.due_date, Invoice.amount_due)\
+                             .filter(Invoice.policy_id == self.policy_id)\
+                             .filter(Invoice.due_date <= date_cursor)\
+                             .filter(Invoice.deleted == False)\
+                             .order_by(Invoice.bill_date)\
+                             .all()
+
+        # pull the amounts of all payments made up to and including date_cursor
+        payments = db.session.query(Payment.transaction_date, Payment.amount_paid)\
+                             .filter(Payment.policy_id == self.policy_id)\
+                             .filter(Payment.transaction_date <= date_cursor)\
+                             .order_by(Payment.transaction_date)\
+                             .all()
+
+        # The account is past due if there is any invoice for which a
+        # balance is present after all payments up to the due date have
+        # been taken into account
+        return _past_due(invoices, payments)
+
+
+class PolicyAccounting(ReadOnlyPolicyAccounting):
 
     # Set the number of months associated with each billing schedule.
     billing_schedules = {'Annual': None, 'Two-Pay': 2, 'Semi-Annual': 3, 'Quarterly': 4, 'Monthly': 12}
@@ -20,79 +122,83 @@ class PolicyAccounting(object):
     """
      Each policy has its own instance of accounting.
     """
-    def __init__(self, policy_id):
+    def __init__(self, policy):
         """
-        Constructor for PolicyAccounting class
+        Constructor for PolicyAccounting class.  Takes a Policy or its id,
+        and generates the policy's invoices if it has none yet.
         """
+        ReadOnlyPolicyAccounting.__init__(self, policy)
 
         #  Pull the appropriate policy from DB
-        self.policy = Policy.query.filter_by(id=policy_id).one()
+        self.policy
 
-        if not self.policy.invoices:
+        # Only check whether an invoice exists rather than loading them all
+        has_invoices = db.session.query(Invoice.id)\
+                                 .filter(Invoice.policy_id == self.policy_id)\
+                                 .first()
+        if has_invoices is None:
             self.make_invoices()
 
-    def change_billing_schedule(self, new_billing_schedule):
+    @metrics.instrument('PolicyAccounting.change_billing_schedule')
+    def change_billing_schedule(self, new_billing_schedule, date_cursor=None):
         """
-        Changes billing schedule, current invoices are marked as deleted,
-        generates new invoices.
+        Changes billing schedule as of date_cursor, the current date if not
+        specified.  Invoices billed before date_cursor are kept as they are,
+        and the rest of the annual premium is split over the new schedule's
+        installments from date_cursor on (or billed on date_cursor if the
+        new schedule has none left).  Only current invoices which differ
+        from the new installments are marked as deleted and replaced.
         """
 
         # Make sure we were given a valid new_billing_schedule
         if new_billing_schedule not in self.billing_schedules:
             raise ValueError("billing_schedule must be one of: {}".format(self.billing_schedules))
 
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.deleted==False)\
-                                .all()
-
-        for invoice in invoices:
-            invoice.deleted = True
-
-        self.policy.billing_schedule = new_billing_schedule
-        new_invoices = self.make_invoices_helper()
-        for invoice in new_invoices:
-            db.session.add(invoice)
-        db.session.commit()
-
-
-    def return_account_balance(self, date_cursor=None):
-        """
-        Calculate account balance by computing the total invoices due
-        for the relevant policy and subtracting the sum of the payments
-        made on the policy.   If date_cursor is not specified, the 
-        calculation is made consider all invoices and payments made on
-        the policy up to (and including) the current date.  However, if 
-        a valid date_cursor is supplied, only invoices and payments 
-        occurring before the given date will be considered.  This is
-        useful in calculating, for instance, the amount that remains to
-        be paid on the entire policy.
-        """
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        # Pull invoices for the policy that occurred at or before the date_cursor.
         invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.bill_date <= date_cursor)\
                                 .filter(Invoice.deleted==False)\
                                 .order_by(Invoice.bill_date)\
                                 .all()
+        billed = [i for i in invoices if i.bill_date < date_cursor]
+        upcoming = [i for i in invoices if i.bill_date >= date_cursor]
 
-        # calculate the total invoiced
-        due_now = 0
-        for invoice in invoices:
-            due_now += invoice.amount_due
-
-        # Pull payments for the policy that occurred at or before the date_cursor;
-        payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Payment.transaction_date <= date_cursor)\
-                                .all()
+        self.policy.billing_schedule = new_billing_schedule
+        remaining = self.policy.annual_premium - sum(i.amount_due for i in billed)
+        installments = [dates for dates in self.billing_dates() if dates[0] >= date_cursor]
+        if remaining > 0 and not installments:
+            installments = [(date_cursor,
+                             date_cursor + relativedelta(months=1),
+                             date_cursor + relativedelta(months=1, days=14))]
+        elif remaining <= 0:
+            installments = []
 
-        # calculate the total paid.
-        for payment in payments:
-            due_now -= payment.amount_paid
+        # Upcoming invoices identical to an installment of the new schedule
+        # are kept, the others are replaced.
+        wanted = []
+        if installments:
+            wanted = [dates + (amount_due,) for dates, amount_due in
+                      zip(installments, split_cents(remaining, len(installments)))]
+        for invoice in upcoming:
+            key = (invoice.bill_date, invoice.due_date, invoice.cancel_date, invoice.amount_due)
+            if key in wanted:
+                wanted.remove(key)
+                continue
+            # Deleted invoices no longer count towards the balance, so their
+            # amounts are reversed in the ledger on their original bill dates.
+            invoice.deleted = True
+            post_ledger_entry(self.policy.id, invoice.bill_date, -invoice.amount_due)
 
-        return due_now
+        for bill_date, due_date, cancel_date, amount_due in wanted:
+            db.session.add(Invoice(self.policy.id, bill_date, due_date, cancel_date, amount_due))
+            post_ledger_entry(self.policy.id, bill_date, amount_due)
+        mark_dirty([self.policy.id])
+        touch_policies([self.policy.id])
+        db.session.commit()
+        policy_cache.invalidate(self.policy.id)
 
+    @metrics.instrument('PolicyAccounting.make_payment')
     def make_payment(self, contact_id=None, date_cursor=None, amount=0):
         """
         Logs in the database a payment made.  If no date_cursor is supplied,
@@ -101,7 +207,8 @@ class PolicyAccounting(object):
         be specified. 
 
         The contact_id is used to specify who is making the payment.  If it is not
-        specified, it is assumed to be the name of the policy holder.
+        specified, it is assumed to be the name of the policy holder.  The
+        amount is in cents.
         """
         if not date_cursor:
             date_cursor = datetime.now().date()
@@ -117,49 +224,15 @@ class PolicyAccounting(object):
                           amount,
                           date_cursor)
         db.session.add(payment)
+        post_ledger_entry(self.policy.id, date_cursor, -amount)
+        mark_dirty([self.policy.id])
+        touch_policies([self.policy.id])
         db.session.commit()
+        policy_cache.invalidate(self.policy.id)
 
         return payment
 
-    def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
-        """
-         If this function returns true, an invoice
-         on a policy has passed the due date without
-         being paid in full. However, it has not necessarily
-         made it to the cancel_date yet.
-        """
-        if not date_cursor:
-            date_cursor = datetime.now().date()
-
-        # pull all invoices due up to and including date_cursor for the relevant
-        # policy
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.due_date <= date_cursor)\
-                                .filter(Invoice.deleted==False)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
-
-        # pull all payments made up to and including date_cursor
-        payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Payment.transaction_date <= date_cursor)\
-                                .order_by(Payment.transaction_date)\
-                                .all()
-
-        # Calculate running total of balance.  The account is past due
-        # if there is any invoice for which a balance is present after
-        # all payments up to the due date have been taken into account
-        due = 0
-        for invoice in invoices:
-            due += invoice.amount_due
-            # Grab all payments made before the invoice's due_date
-            while len(payments) and (payments[0].transaction_date <= invoice.due_date):
-                due -= payments.pop(0).amount_paid
-
-            if due > 0:
-                return True
-        else:
-            return False
-
+    @metrics.instrument('PolicyAccounting.evaluate_cancel')
     def evaluate_cancel(self, date_cursor=None):
         """
         Determines whether a policy should be cancelled due to non-payment from 
@@ -190,6 +263,7 @@ class PolicyAccounting(object):
                 )
                 break
 
+    @metrics.instrument('PolicyAccounting.cancel_policy')
     def cancel_policy(self, reason, date, notes=None):
         cancellation = PolicyCancellation(
             policy_id=self.policy.id,
@@ -198,15 +272,31 @@ class PolicyAccounting(object):
             notes=notes
         )
         db.session.add(cancellation)
+        touch_policies([self.policy.id])
         db.session.commit()
+        policy_cache.invalidate(self.policy.id)
 
+    @metrics.instrument('PolicyAccounting.make_invoices')
     def make_invoices(self):
         invoices = self.make_invoices_helper()
 
         # Save the invoices to the Database.
         for invoice in invoices:
             db.session.add(invoice)
+            post_ledger_entry(self.policy.id, invoice.bill_date, invoice.amount_due)
+        mark_dirty([self.policy.id])
+        touch_policies([self.policy.id])
         db.session.commit()
+        policy_cache.invalidate(self.policy.id)
+
+    def billing_dates(self):
+        """
+        Returns the (bill_date, due_date, cancel_date) of every installment
+        of the policy's year under its billing schedule.  Each installment
+        is due a month after it is billed, and the policy can be cancelled
+        two weeks after that.
+        """
+        return billing_calendar.dates(self.policy.effective_date, self.policy.billing_schedule)
 
     def make_invoices_helper(self):
         """
@@ -215,8 +305,7 @@ class PolicyAccounting(object):
 
         This helper method embodies all the functionality needed for the
         "makde_invoices" method but leaves out the database commit.  This is done
-        so that other methods can use this functionality in its own database transaction
-        (see change_billing_schedule).
+        so that other methods can use this functionality in its own database transaction.
         """
 
         # Check that no non-deleted invoices exist right now
@@ -225,47 +314,1104 @@ class PolicyAccounting(object):
                 raise RuntimeError("Attempted to make invoices when non-deleted"\
                     "already exist.")
 
-        invoices = []
-
-        # There is always at least one invoice, so we create that up front, assuming that it is for
-        # a yearly billing schedule.  self.policy.amount_due is liable to change later in this function
-        # if a different billing schedule is employed.
-        first_invoice = Invoice(self.policy.id,
-                                self.policy.effective_date, #bill_date
-                                self.policy.effective_date + relativedelta(months=1), #due
-                                self.policy.effective_date + relativedelta(months=1, days=14), #cancel
-                                self.policy.annual_premium)
-        invoices.append(first_invoice)
-
-        # if the policy employs an annual billing scedule, there are no more invoices to create
-        if self.policy.billing_schedule == "Annual":
-            pass
-        elif self.policy.billing_schedule in ["Two-Pay", "Semi-Annual", "Quarterly", "Monthly"]:
-            # Calculate billing periodicity (number of months between billing cycles)
-            # and billing frequency (how many times per year) depending on the policy's
-            # billing schedule.
-            billing_periodicity = self.billing_schedules.get(self.policy.billing_schedule)
-            billing_frequency = 12 / billing_periodicity
-
-            # Adjust the first invoice's amount due appropriately.
-            first_invoice.amount_due = first_invoice.amount_due / billing_periodicity
-            # For each remaining billing cycle...
-            for i in range(1, billing_periodicity):
-                # calculate date of invoice
-                months_after_eff_date = i * billing_frequency
-                bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
-
-                # create the invoice!
-                invoice = Invoice(self.policy.id,
-                                  bill_date,
-                                  bill_date + relativedelta(months=1),
-                                  bill_date + relativedelta(months=1, days=14),
-                                  self.policy.annual_premium / billing_periodicity)
-                invoices.append(invoice)
-        else:
+        if self.policy.billing_schedule not in self.billing_schedules:
             print "You have chosen a bad billing schedule."
 
-        return invoices
+        # The annual premium is split evenly between the installments, the
+        # first one also carrying the odd cents.
+        dates = self.billing_dates()
+        amounts = split_cents(self.policy.annual_premium, len(dates))
+        return [Invoice(self.policy.id, bill_date, due_date, cancel_date, amount_due)
+                for (bill_date, due_date, cancel_date), amount_due in zip(dates, amounts)]
+
+
+"""
+#######################################################
+Billing calendar.
+#######################################################
+"""
+
+def _add_months(effective_dates, months):
+    """
+    Adds months[i] months to effective_dates[i] for every i, clamping the
+    day to the end of the resulting month like relativedelta(months=...).
+
+    Working on month indexes (year * 12 + month) keeps this to integer
+    arithmetic over the whole batch instead of one relativedelta per date.
+    """
+    results = []
+    for effective_date, offset in zip(effective_dates, months):
+        index = effective_date.year * 12 + effective_date.month - 1 + offset
+        year, month = divmod(index, 12)
+        month += 1
+        day = min(effective_date.day, monthrange(year, month)[1])
+        results.append(date(year, month, day))
+    return results
+
+class BillingCalendar(object):
+    """
+     Memoized installment dates of a policy year: the (bill_date, due_date,
+     cancel_date) of every installment for an effective date and billing
+     schedule.  Most policies share a handful of effective dates, so the
+     dates are computed once per (effective_date, billing_schedule) and
+     shared by every invoice generation path.
+
+     At most max_size calendars are kept, the least recently used being
+     evicted first.  warm() fills the calendars of a range of effective
+     dates ahead of time.
+    """
+    def __init__(self, billing_schedules, max_size=20000):
+        self.billing_schedules = billing_schedules
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _compute(self, effective_date, billing_schedule):
+        # An annual schedule has a single installment
+        billing_periodicity = self.billing_schedules.get(billing_schedule) or 1
+        billing_frequency = 12 / billing_periodicity
+
+        # Each installment is due a month after it is billed, and the policy
+        # can be cancelled two weeks after that.
+        bill_dates = _add_months([effective_date] * billing_periodicity,
+                                 [i * billing_frequency for i in range(billing_periodicity)])
+        due_dates = _add_months(bill_dates, [1] * billing_periodicity)
+        return tuple((bill_date, due_date, due_date + timedelta(days=14))
+                     for bill_date, due_date in zip(bill_dates, due_dates))
+
+    def dates(self, effective_date, billing_schedule):
+        """
+        Returns the (bill_date, due_date, cancel_date) tuple of every
+        installment of a policy year starting on effective_date.
+        """
+        key = (effective_date, billing_schedule)
+        with self._lock:
+            dates = self._entries.pop(key, None)
+            if dates is not None:
+                # Re-insert the entry to mark it as the most recently used
+                self._entries[key] = dates
+                self.hits += 1
+                return dates
+            self.misses += 1
+
+        dates = self._compute(effective_date, billing_schedule)
+        if self.max_size > 0:
+            with self._lock:
+                self._entries[key] = dates
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return dates
+
+    def warm(self, start, end, billing_schedules=None):
+        """
+        Computes the calendars of every effective date from start to end,
+        both included, under billing_schedules (every known schedule by
+        default), and returns how many there were.
+        """
+        billing_schedules = billing_schedules or sorted(self.billing_schedules)
+        count = 0
+        effective_date = start
+        while effective_date <= end:
+            for billing_schedule in billing_schedules:
+                self.dates(effective_date, billing_schedule)
+                count += 1
+            effective_date += timedelta(days=1)
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+billing_calendar = BillingCalendar(
+    PolicyAccounting.billing_schedules,
+    max_size=app.config.get('BILLING_CALENDAR_SIZE', 20000)
+)
+
+
+"""
+#######################################################
+Balance ledger.
+#######################################################
+"""
+
+def ledger_balance(policy_id, date_cursor):
+    """
+    Returns the balance of the policy as of date_cursor (inclusive), read
+    from the running total of the latest ledger entry on or before it.
+    """
+    entry = db.session.query(LedgerEntry.balance)\
+                      .filter(LedgerEntry.policy_id == policy_id)\
+                      .filter(LedgerEntry.entry_date <= date_cursor)\
+                      .order_by(LedgerEntry.entry_date.desc(), LedgerEntry.id.desc())\
+                      .first()
+    return entry.balance if entry else 0
+
+def queued_balance(policy_id, date_cursor):
+    """
+    Returns ledger_balance(policy_id, date_cursor) less the policy's
+    payments up to date_cursor which are still in the payment queue.  Both
+    are read in one statement, so a payment flushed from the queue at the
+    same time is counted exactly once.
+    """
+    balance = db.session.query(LedgerEntry.balance)\
+                        .filter(LedgerEntry.policy_id == policy_id)\
+                        .filter(LedgerEntry.entry_date <= date_cursor)\
+                        .order_by(LedgerEntry.entry_date.desc(), LedgerEntry.id.desc())\
+                        .limit(1)\
+                        .as_scalar()
+    queued = db.session.query(db.func.sum(QueuedPayment.amount_paid))\
+                       .filter(QueuedPayment.policy_id == policy_id)\
+                       .filter(QueuedPayment.transaction_date <= date_cursor)\
+                       .as_scalar()
+    return db.session.query(db.func.coalesce(balance, 0) - db.func.coalesce(queued, 0)).scalar()
+
+def post_ledger_entry(policy_id, entry_date, amount):
+    """
+    Appends a change of amount to the balance of the policy on entry_date.
+    The entry is written in the session's transaction; committing is left
+    to the caller so that it lands in the same transaction as the invoice or
+    payment it records.
+
+    Entries are never removed.  Entries dated after entry_date (future
+    installments, mostly) have amount added to their running totals.
+    """
+    # pysqlite only opens a transaction, and SQLite only takes the write
+    # lock, on the first write.  So nothing is read before the update: the
+    # previous balance is read by the insert itself, under the lock, or a
+    # posting committed meanwhile by another connection would be missed.
+    LedgerEntry.query.filter(LedgerEntry.policy_id == policy_id)\
+                     .filter(LedgerEntry.entry_date > entry_date)\
+                     .update({LedgerEntry.balance: LedgerEntry.balance + amount},
+                             synchronize_session=False)
+    entries = LedgerEntry.__table__
+    previous = db.select([entries.c.balance])\
+                 .where(entries.c.policy_id == policy_id)\
+                 .where(entries.c.entry_date <= entry_date)\
+                 .order_by(entries.c.entry_date.desc(), entries.c.id.desc())\
+                 .limit(1)\
+                 .as_scalar()
+    db.session.execute(entries.insert().values(
+        policy_id=policy_id,
+        entry_date=entry_date,
+        amount=amount,
+        balance=db.func.coalesce(previous, 0) + amount
+    ))
+
+def refresh_ledger_balances(policy_ids):
+    """
+    Recomputes the running totals of every ledger entry of the given
+    policies from the entries' amounts, in one statement per batch of
+    policies.  Used after appending entries in bulk with placeholder
+    balances.  Committing is left to the caller.
+    """
+    entries = LedgerEntry.__table__
+    earlier = entries.alias('earlier')
+    running_total = db.select([db.func.sum(earlier.c.amount)])\
+                      .where(earlier.c.policy_id == entries.c.policy_id)\
+                      .where(db.or_(earlier.c.entry_date < entries.c.entry_date,
+                                    db.and_(earlier.c.entry_date == entries.c.entry_date,
+                                            earlier.c.id <= entries.c.id)))\
+                      .as_scalar()
+    for chunk in _chunks(policy_ids, 500):
+        db.session.execute(
+            entries.update()
+                   .where(entries.c.policy_id.in_(chunk))
+                   .values(balance=running_total)
+        )
+
+def rebuild_ledger(policy_ids=None):
+    """
+    Recreates the ledger entries of the given policies (every policy if none
+    are given) from their non-deleted invoices and their payments.
+
+    This is the migration path for databases created before the ledger
+    existed: run db.create_all() to add the ledger_entries table, then
+    rebuild_ledger().
+    """
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id)]
+
+    for chunk in _chunks(policy_ids, 500):
+        LedgerEntry.query.filter(LedgerEntry.policy_id.in_(chunk))\
+                         .delete(synchronize_session=False)
+
+        deltas = {}
+        rows = db.session.query(Invoice.policy_id, Invoice.bill_date, Invoice.amount_due)\
+                         .filter(Invoice.policy_id.in_(chunk))\
+                         .filter(Invoice.deleted == False)
+        for row in rows:
+            deltas.setdefault(row.policy_id, []).append((row.bill_date, row.amount_due))
+        rows = db.session.query(Payment.policy_id, Payment.transaction_date, Payment.amount_paid)\
+                         .filter(Payment.policy_id.in_(chunk))
+        for row in rows:
+            deltas.setdefault(row.policy_id, []).append((row.transaction_date, -row.amount_paid))
+
+        for policy_id, policy_deltas in deltas.items():
+            balance = 0
+            for entry_date, amount in sorted(policy_deltas):
+                balance += amount
+                db.session.add(LedgerEntry(policy_id, entry_date, amount, balance))
+    db.session.commit()
+
+    for policy_id in policy_ids:
+        policy_cache.invalidate(policy_id)
+
+
+"""
+#######################################################
+Policy search.
+#######################################################
+"""
+
+def search_policies(query, after=None, limit=20, session=None):
+    """
+    Finds the policies whose policy number or named insured's name contains
+    query, ignoring case.  Returns one page of at most limit policies, in id
+    order and with their agents loaded, along with the cursor to pass as
+    after to get the next page (None on the last page).  See
+    search_policy_ids.
+    """
+    ids, cursor = search_policy_ids(query, after, limit, session)
+    return load_policies(ids, ['agent'], session=session), cursor
+
+def search_policy_ids(query, after=None, limit=20, session=None):
+    """
+    Like search_policies, but returns the ids of the policies found rather
+    than the policies, with a single query.
+
+    Queries of three or more characters are answered from the trigram index
+    in policy_search.  Shorter ones cannot use it and fall back to LIKE over
+    the same table, which still stops as soon as the page is full.
+
+    session defaults to db.session; read-only callers can pass
+    db.readonly_session.
+    """
+    session = session or db.session
+    query = query or ''
+    params = {'after': after or 0, 'limit': limit + 1}
+    if len(query) >= 3:
+        where = "policy_search MATCH :match"
+        params['match'] = '"{}"'.format(query.replace('"', '""'))
+    else:
+        where = "(policy_number LIKE :like OR insured_name LIKE :like)"
+        params['like'] = "%{}%".format(query)
+
+    ids = [
+        row[0] for row in session.execute(
+            "SELECT rowid FROM policy_search"
+            " WHERE " + where + " AND rowid > :after"
+            " ORDER BY rowid LIMIT :limit",
+            params
+        )
+    ]
+
+    # One extra id was asked for to know whether another page follows.
+    cursor = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        cursor = ids[-1]
+    return ids, cursor
+
+
+"""
+#######################################################
+Loading policies with their relations.
+#######################################################
+"""
+
+# How each relation of Policy is loaded up front.  Single related rows are
+# joined into the policy query, invoices come from one more query for all
+# of the policies at once.
+policy_relation_loaders = OrderedDict([
+    ('agent', (db.joinedload, Policy.agent_relation)),
+    ('named_insured', (db.joinedload, Policy.named_insured_relation)),
+    ('cancellation', (db.joinedload, Policy.cancellation)),
+    ('invoices', (db.subqueryload, Policy.active_invoices)),
+])
+
+def with_relations(query, relations=None):
+    """
+    Adds loader options to a query of policies, so the given relations
+    (every one of policy_relation_loaders by default) are loaded with the
+    policies instead of with one query per policy when first used.  The
+    invoices loaded are the non-deleted ones, in Policy.active_invoices.
+    """
+    if relations is None:
+        relations = policy_relation_loaders.keys()
+    for relation in relations:
+        if relation not in policy_relation_loaders:
+            raise ValueError("relations must be among: {}".format(
+                ', '.join(policy_relation_loaders)))
+    return query.options(*[loader(attribute) for loader, attribute in
+                           (policy_relation_loaders[relation] for relation in relations)])
+
+def load_policies(policy_ids, relations=None, batch_size=500, session=None):
+    """
+    Returns the policies with the given ids, in id order, with their
+    relations loaded as by with_relations.  Policies are fetched
+    batch_size at a time, so the number of statements only depends on the
+    number of batches: two per batch when invoices are loaded, one
+    otherwise.
+
+    session defaults to db.session; read-only callers can pass
+    db.readonly_session.
+    """
+    session = session or db.session
+    policies = []
+    for chunk in _chunks(sorted(policy_ids), batch_size):
+        policies.extend(with_relations(session.query(Policy), relations)
+                        .filter(Policy.id.in_(chunk))
+                        .order_by(Policy.id)
+                        .all())
+    return policies
+
+
+"""
+#######################################################
+Set-based operations over many policies at once.
+#######################################################
+"""
+
+def _chunks(ids, size):
+    """
+    Yields successive slices of ids holding at most size items.  Used to keep
+    IN (...) clauses below SQLite's bound parameter limit.
+    """
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def _balance_as_of(invoices, payments, date_cursor):
+    """
+    In-memory counterpart of ReadOnlyPolicyAccounting.return_account_balance.
+
+    invoices is a list of (bill_date, amount_due) tuples and payments a list
+    of (transaction_date, amount_paid) tuples, both belonging to one policy.
+    """
+    due = 0
+    for bill_date, amount_due in invoices:
+        if bill_date <= date_cursor:
+            due += amount_due
+    for transaction_date, amount_paid in payments:
+        if transaction_date <= date_cursor:
+            due -= amount_paid
+    return due
+
+def _past_due(invoices, payments):
+    """
+    Returns True if any invoice still has a balance once every payment made
+    up to its due date is taken into account.
+
+    invoices is an iterable of (due_date, amount_due) in billing order and
+    payments an iterable of (transaction_date, amount_paid) in date order,
+    both for one policy.  The two are merged in a single pass, stopping at
+    the first invoice found past due.
+    """
+    payments = iter(payments)
+    payment = next(payments, None)
+    due = 0
+    for due_date, amount_due in invoices:
+        due += amount_due
+        # Take off all payments made up to the invoice's due_date
+        while payment is not None and payment[0] <= due_date:
+            due -= payment[1]
+            payment = next(payments, None)
+
+        if due > 0:
+            return True
+    return False
+
+def pending_cancellation_due_to_non_pay(policy_ids=None, date_cursor=None, batch_size=500):
+    """
+    Returns the set of ids of the policies for which
+    ReadOnlyPolicyAccounting.evaluate_cancellation_pending_due_to_non_pay would
+    return True on date_cursor.
+
+    The invoices and payments of the policies are read as two streams
+    ordered by policy and date, which are merged policy by policy in a
+    single pass.  If policy_ids is not given the whole book is evaluated
+    with one query for each stream.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    if policy_ids is None:
+        chunks = [None]
+    else:
+        chunks = _chunks(policy_ids, batch_size)
+
+    pending = set()
+    for chunk in chunks:
+        invoices = db.session.query(Invoice.policy_id, Invoice.due_date, Invoice.amount_due)\
+                             .filter(Invoice.due_date <= date_cursor)\
+                             .filter(Invoice.deleted == False)\
+                             .order_by(Invoice.policy_id, Invoice.bill_date)
+        payments = db.session.query(Payment.policy_id, Payment.transaction_date, Payment.amount_paid)\
+                             .filter(Payment.transaction_date <= date_cursor)\
+                             .order_by(Payment.policy_id, Payment.transaction_date)
+        if chunk is not None:
+            invoices = invoices.filter(Invoice.policy_id.in_(chunk))
+            payments = payments.filter(Payment.policy_id.in_(chunk))
+
+        payment_groups = groupby(payments.yield_per(1000), key=itemgetter(0))
+        payment_group = next(payment_groups, None)
+        for policy_id, policy_invoices in groupby(invoices.yield_per(1000), key=itemgetter(0)):
+            # Skip the payments of policies which have nothing due
+            while payment_group is not None and payment_group[0] < policy_id:
+                payment_group = next(payment_groups, None)
+
+            policy_payments = ()
+            if payment_group is not None and payment_group[0] == policy_id:
+                policy_payments = (row[1:] for row in payment_group[1])
+
+            if _past_due((row[1:] for row in policy_invoices), policy_payments):
+                pending.add(policy_id)
+
+    return pending
+
+def find_cancellations(policy_ids=None, date_cursor=None, batch_size=500):
+    """
+    Returns the PolicyCancellation objects sweep_cancellations would create,
+    without adding them to the session.
+
+    This makes the same decision as PolicyAccounting.evaluate_cancel for every
+    policy, but rather than running two queries per candidate invoice, the
+    invoices and payments of batch_size policies are loaded with one query
+    each and the balances are worked out in memory.
+
+    If policy_ids is not given, every policy in the book is evaluated.
+    Policies which are already cancelled are skipped, and unlike
+    PolicyAccounting no invoices are generated for policies without any.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id)]
+
+    cancellations = []
+    for chunk in _chunks(policy_ids, batch_size):
+        cancelled = set(
+            row.policy_id for row in
+            db.session.query(PolicyCancellation.policy_id)
+                      .filter(PolicyCancellation.policy_id.in_(chunk))
+        )
+
+        # Group the non-deleted invoices and the payments up to date_cursor
+        # by policy.  Nothing billed or paid after date_cursor can affect a
+        # cancel date at or before it.
+        invoices = {}
+        rows = db.session.query(Invoice.policy_id, Invoice.bill_date,
+                                Invoice.cancel_date, Invoice.amount_due)\
+                         .filter(Invoice.policy_id.in_(chunk))\
+                         .filter(Invoice.bill_date <= date_cursor)\
+                         .filter(Invoice.deleted == False)\
+                         .order_by(Invoice.policy_id, Invoice.bill_date)
+        for row in rows:
+            invoices.setdefault(row.policy_id, []).append(row)
+
+        payments = {}
+        rows = db.session.query(Payment.policy_id, Payment.transaction_date,
+                                Payment.amount_paid)\
+                         .filter(Payment.policy_id.in_(chunk))\
+                         .filter(Payment.transaction_date <= date_cursor)
+        for row in rows:
+            payments.setdefault(row.policy_id, []).append(
+                (row.transaction_date, row.amount_paid))
+
+        for policy_id in chunk:
+            if policy_id in cancelled:
+                continue
+
+            policy_invoices = invoices.get(policy_id, [])
+            billed = [(i.bill_date, i.amount_due) for i in policy_invoices]
+            for invoice in policy_invoices:
+                if invoice.cancel_date > date_cursor:
+                    continue
+                if not _balance_as_of(billed, payments.get(policy_id, []),
+                                      invoice.cancel_date):
+                    continue
+                cancellations.append(PolicyCancellation(
+                    policy_id=policy_id,
+                    reason="Nonpayment",
+                    date=invoice.cancel_date,
+                    notes="Automatically deleted due to non-payment",
+                ))
+                break
+
+    return cancellations
+
+def sweep_cancellations(policy_ids=None, date_cursor=None, batch_size=500):
+    """
+    Evaluates cancellation due to non-payment for many policies at once and
+    returns the list of PolicyCancellation objects created.  The policies
+    are evaluated by find_cancellations, and all cancellations are inserted
+    in a single transaction at the end of the sweep.
+    """
+    cancellations = find_cancellations(policy_ids, date_cursor, batch_size)
+
+    for cancellation in cancellations:
+        db.session.add(cancellation)
+    touch_policies([cancellation.policy_id for cancellation in cancellations])
+    db.session.commit()
+
+    for cancellation in cancellations:
+        policy_cache.invalidate(cancellation.policy_id)
+
+    return cancellations
+
+def bulk_make_invoices(policies, batch_size=5000):
+    """
+    Generates the invoices of many new policies at once and returns how many
+    were inserted.
+
+    policies is an iterable of (policy_id, effective_date, billing_schedule,
+    annual_premium) tuples.  The invoices are the same, row for row, as the
+    ones PolicyAccounting.make_invoices_helper would create, with their
+    dates from the same billing calendar, but the rows are written with one
+    executemany insert, without building Invoice objects.  Ledger entries
+    are written the same way.  Everything is committed in a single
+    transaction.
+
+    Raises a ValueError for an unknown billing schedule and a RuntimeError
+    if any of the policies already has non-deleted invoices.
+    """
+    billing_schedules = PolicyAccounting.billing_schedules
+    policies = list(policies)
+    for policy in policies:
+        if policy[2] not in billing_schedules:
+            raise ValueError("billing_schedule must be one of: {}".format(billing_schedules))
+
+    inserted = 0
+    for chunk in _chunks(policies, batch_size):
+        policy_ids = [policy[0] for policy in chunk]
+        invoiced = db.session.query(Invoice.policy_id)\
+                             .filter(Invoice.policy_id.in_(policy_ids))\
+                             .filter(Invoice.deleted == False)\
+                             .first()
+        if invoiced:
+            raise RuntimeError("Attempted to make invoices when non-deleted"\
+                "already exist.")
+
+        rows = []
+        for policy_id, effective_date, billing_schedule, annual_premium in chunk:
+            dates = billing_calendar.dates(effective_date, billing_schedule)
+            for (bill_date, due_date, cancel_date), amount_due in \
+                    zip(dates, split_cents(annual_premium, len(dates))):
+                rows.append({'policy_id': policy_id,
+                             'bill_date': bill_date,
+                             'due_date': due_date,
+                             'cancel_date': cancel_date,
+                             'amount_due': amount_due,
+                             'deleted': False})
+        if not rows:
+            continue
+        db.session.execute(Invoice.__table__.insert(), rows)
+        inserted += len(rows)
+
+        # New policies start with an empty ledger, so their running totals
+        # are the cumulative installment amounts.  Policies which already
+        # have entries (for instance a payment taken before invoicing) go
+        # through post_ledger_entry so later entries are kept consistent.
+        posted = set(
+            row.policy_id for row in
+            db.session.query(LedgerEntry.policy_id)
+                      .filter(LedgerEntry.policy_id.in_(policy_ids))
+                      .distinct()
+        )
+        entries = []
+        balances = {}
+        for row in rows:
+            if row['policy_id'] in posted:
+                post_ledger_entry(row['policy_id'], row['bill_date'], row['amount_due'])
+                continue
+            balance = balances.get(row['policy_id'], 0) + row['amount_due']
+            balances[row['policy_id']] = balance
+            entries.append({'policy_id': row['policy_id'],
+                            'entry_date': row['bill_date'],
+                            'amount': row['amount_due'],
+                            'balance': balance})
+        if entries:
+            db.session.execute(LedgerEntry.__table__.insert(), entries)
+        mark_dirty(policy_ids)
+        touch_policies(policy_ids)
+
+    db.session.commit()
+
+    for policy in policies:
+        policy_cache.invalidate(policy[0])
+    return inserted
+
+
+class PaymentImportReport(object):
+    """
+     Outcome of a bulk payment import.  rejected lists a
+     (row_number, row, reason) tuple for every row that was not imported,
+     rows being numbered from 1.
+    """
+    def __init__(self):
+        self.imported = 0
+        self.rejected = []
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """
+        Rows processed per second.
+        """
+        if not self.elapsed:
+            return 0.0
+        return (self.imported + len(self.rejected)) / self.elapsed
+
+    def __repr__(self):
+        return "<PaymentImportReport imported={} rejected={} rows/s={:.0f}>".format(
+            self.imported, len(self.rejected), self.throughput)
+
+# Units payment amounts can be given in to import_payments
+amount_units = ('cents', 'dollars')
+
+def parse_payment_row(row, named_insureds, unit='cents'):
+    """
+    Turns a (policy_id, contact_id, amount, date) row, typed or read as
+    strings, into a payment dict.  Amounts are read in unit, one of
+    amount_units, whatever their type: whole numbers of cents, e.g. 1234 or
+    '1234', or dollar amounts, e.g. '12.34', '$1,234' or a Decimal.  Floats
+    are rejected in both.  Raises a ValueError explaining why the row cannot
+    be imported.
+    """
+    if unit not in amount_units:
+        raise ValueError("unit must be one of: {}".format(amount_units))
+    if len(row) != 4:
+        raise ValueError("Expected policy_id, contact_id, amount and date")
+    policy_id, contact_id, amount, transaction_date = row
+
+    policy_id = int(policy_id)
+    if policy_id not in named_insureds:
+        raise ValueError("Unknown policy")
+
+    if contact_id in (None, ''):
+        contact_id = named_insureds[policy_id]
+        if contact_id is None:
+            raise ValueError("No contact given and the policy has no named insured")
+    contact_id = int(contact_id)
+
+    if unit == 'dollars':
+        amount = dollars_to_cents(amount)
+    else:
+        amount = parse_cents(amount)
+    if amount <= 0:
+        raise ValueError("Amount must be positive")
+
+    if transaction_date in (None, ''):
+        raise ValueError("Missing date")
+    if not isinstance(transaction_date, date):
+        transaction_date = date_parse(transaction_date).date()
+    elif isinstance(transaction_date, datetime):
+        transaction_date = transaction_date.date()
+
+    return {'policy_id': policy_id,
+            'contact_id': contact_id,
+            'amount_paid': amount,
+            'transaction_date': transaction_date}
+
+def insert_payments(payments):
+    """
+    Inserts payments, dicts such as parse_payment_row returns, and their
+    ledger entries with executemany inserts, marks their policies dirty and
+    bumps their versions.  Committing is left to the caller.
+    """
+    db.session.execute(Payment.__table__.insert(), payments)
+    # Ledger entries go in with placeholder balances, which are then
+    # recomputed for the affected policies in one statement.
+    db.session.execute(LedgerEntry.__table__.insert(), [
+        {'policy_id': payment['policy_id'],
+         'entry_date': payment['transaction_date'],
+         'amount': -payment['amount_paid'],
+         'balance': 0}
+        for payment in payments
+    ])
+    policy_ids = set(payment['policy_id'] for payment in payments)
+    refresh_ledger_balances(policy_ids)
+    mark_dirty(policy_ids)
+    touch_policies(policy_ids)
+
+def import_payments(rows, batch_size=1000, unit='cents'):
+    """
+    Records many payments at once, e.g. from a bank lockbox file, and
+    returns a PaymentImportReport.
+
+    rows is an iterable of (policy_id, contact_id, amount, date) tuples,
+    whose values may be strings.  Every amount is in unit, 'cents' (e.g.
+    1234) or 'dollars' (e.g. '12.34'), whatever its type; see
+    parse_payment_row.  A missing contact_id defaults to the policy's named
+    insured, like in PolicyAccounting.make_payment.  Rows with an unknown
+    policy or invalid values, floats included, are rejected and reported
+    rather than failing the import.
+
+    Policy ids and named insureds are prefetched with a single query, and
+    payments and their ledger entries are inserted batch_size rows at a
+    time, all in one transaction.
+    """
+    if unit not in amount_units:
+        raise ValueError("unit must be one of: {}".format(amount_units))
+    report = PaymentImportReport()
+    start = time.time()
+    named_insureds = dict(db.session.query(Policy.id, Policy.named_insured))
+
+    batch = []
+    policy_ids = set()
+    for row_number, row in enumerate(rows, 1):
+        try:
+            payment = parse_payment_row(row, named_insureds, unit)
+        except (TypeError, ValueError) as e:
+            report.rejected.append((row_number, row, str(e)))
+            continue
+        batch.append(payment)
+        policy_ids.add(payment['policy_id'])
+        if len(batch) >= batch_size:
+            insert_payments(batch)
+            report.imported += len(batch)
+            batch = []
+    if batch:
+        insert_payments(batch)
+        report.imported += len(batch)
+    db.session.commit()
+
+    for policy_id in policy_ids:
+        policy_cache.invalidate(policy_id)
+
+    report.elapsed = time.time() - start
+    return report
+
+def import_payments_csv(stream, batch_size=1000):
+    """
+    Imports payments from a CSV file object with a header row naming the
+    policy_id, contact_id, amount and date columns.  Amounts are in dollars,
+    e.g. 12.34 or $1,234, and contact_id may be left empty.  See
+    import_payments.
+    """
+    reader = csv.DictReader(stream)
+    return import_payments(
+        ((row.get('policy_id'), row.get('contact_id'), row.get('amount'), row.get('date'))
+         for row in reader),
+        batch_size=batch_size,
+        unit='dollars'
+    )
+
+
+def archive_deleted_invoices(billed_before, batch_size=1000):
+    """
+    Moves the deleted invoices billed before billed_before from the invoices
+    table to invoices_archive and returns how many were moved.
+
+    Deleted invoices are left behind by billing schedule changes.  They no
+    longer count anywhere, their ledger entries having been reversed, but
+    they still take room in the invoices table and its indexes.  Each batch
+    of batch_size invoices is moved in its own transaction.
+    """
+    archived = 0
+    today = datetime.now().date()
+    columns = [Invoice.id, Invoice.policy_id, Invoice.bill_date, Invoice.due_date,
+               Invoice.cancel_date, Invoice.amount_due]
+    while True:
+        rows = db.session.query(*columns)\
+                         .filter(Invoice.deleted == True)\
+                         .filter(Invoice.bill_date < billed_before)\
+                         .order_by(Invoice.id)\
+                         .limit(batch_size)\
+                         .all()
+        if not rows:
+            break
+
+        db.session.execute(InvoiceArchive.__table__.insert(), [
+            dict(zip([c.key for c in columns], row), archived_on=today)
+            for row in rows
+        ])
+        Invoice.query.filter(Invoice.id.in_([row.id for row in rows]))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+        archived += len(rows)
+
+    return archived
+
+
+"""
+#######################################################
+Policy versions.
+#######################################################
+"""
+
+def touch_policies(policy_ids):
+    """
+    Bumps the version of policies whose invoices, payments or cancellation
+    changed, in the current transaction, so the new version is committed
+    along with the change.
+    """
+    policy_ids = set(policy_ids)
+    if not policy_ids:
+        return
+    modified_at = datetime.utcnow()
+    db.session.execute(
+        "INSERT INTO policy_versions (policy_id, version, modified_at)"
+        " VALUES (:policy_id, 1, :modified_at)"
+        " ON CONFLICT (policy_id) DO UPDATE"
+        " SET version = version + 1, modified_at = excluded.modified_at",
+        [{'policy_id': policy_id, 'modified_at': modified_at} for policy_id in policy_ids]
+    )
+
+def policy_versions(policy_ids, session=None):
+    """
+    Returns the (version, modified_at) of the given policies by id, read
+    500 policies per query.  Policies never changed since versions were
+    recorded are left out, and stand for version 0.
+
+    session defaults to db.session; read-only callers can pass
+    db.readonly_session.
+    """
+    session = session or db.session
+    versions = {}
+    for chunk in _chunks(list(policy_ids), 500):
+        versions.update(
+            (row.policy_id, (row.version, row.modified_at)) for row in
+            session.query(PolicyVersion.policy_id, PolicyVersion.version,
+                          PolicyVersion.modified_at)
+                   .filter(PolicyVersion.policy_id.in_(chunk))
+        )
+    return versions
+
+
+"""
+#######################################################
+Incremental cancellation scheduling.
+#######################################################
+"""
+
+# A policy's cancellation status can only change when one of its invoices
+# comes due or reaches its cancel date, or when its invoices or payments
+# change.  cancellation_schedule keeps the next such date of every policy
+# and flags the policies which changed, so a scheduled run only evaluates
+# the policies for which something happened since the previous run.  Runs
+# are expected to move forward in time.
+
+def mark_dirty(policy_ids):
+    """
+    Flags policies for evaluation by the next scheduled run, adding them
+    to the schedule if they are not in it yet.  This runs in the current
+    transaction, so the flag is committed along with the change calling
+    for it.
+    """
+    policy_ids = set(policy_ids)
+    if not policy_ids:
+        return
+    db.session.execute(
+        "INSERT INTO cancellation_schedule (policy_id, dirty, pending, generation)"
+        " VALUES (:policy_id, 1, 0, 1)"
+        " ON CONFLICT (policy_id) DO UPDATE SET dirty = 1, generation = generation + 1",
+        [{'policy_id': policy_id} for policy_id in policy_ids]
+    )
+
+def find_scheduled(date_cursor=None, low=None, high=None):
+    """
+    Returns a (policy_id, generation) tuple for every policy due for
+    evaluation on date_cursor, in id order: those marked dirty and those
+    whose next event has been reached.  low and high (excluded) restrict
+    the policy ids looked at.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    query = db.session.query(CancellationSchedule.policy_id, CancellationSchedule.generation)\
+                      .filter(db.or_(CancellationSchedule.dirty == True,
+                                     CancellationSchedule.next_event <= date_cursor))
+    if low is not None:
+        query = query.filter(CancellationSchedule.policy_id >= low)
+    if high is not None:
+        query = query.filter(CancellationSchedule.policy_id < high)
+    return [tuple(row) for row in query.order_by(CancellationSchedule.policy_id)]
+
+def evaluate_schedule(scheduled, date_cursor=None, batch_size=500):
+    """
+    Evaluates the policies returned by find_scheduled on date_cursor,
+    without writing anything.  Returns the PolicyCancellation objects to
+    create, as find_cancellations does, and the updated schedule entries,
+    to be passed on to save_schedule.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    policy_ids = [policy_id for policy_id, _ in scheduled]
+    pending = pending_cancellation_due_to_non_pay(policy_ids, date_cursor, batch_size)
+    cancellations = find_cancellations(policy_ids, date_cursor, batch_size)
+
+    # An invoice's cancel date always follows its due date, so its next
+    # event is its due date until that has passed.
+    next_event = db.func.min(db.case([(Invoice.due_date > date_cursor, Invoice.due_date)],
+                                     else_=Invoice.cancel_date))
+    next_events = {}
+    for chunk in _chunks(policy_ids, batch_size):
+        next_events.update(
+            db.session.query(Invoice.policy_id, next_event)
+                      .filter(Invoice.policy_id.in_(chunk))
+                      .filter(Invoice.cancel_date > date_cursor)
+                      .filter(Invoice.deleted == False)
+                      .group_by(Invoice.policy_id)
+        )
+
+    entries = [{'policy_id': policy_id,
+                'generation': generation,
+                'next_event': next_events.get(policy_id),
+                'pending': policy_id in pending}
+               for policy_id, generation in scheduled]
+    return cancellations, entries
+
+def save_schedule(cancellations, entries):
+    """
+    Records the outcome of evaluate_schedule.  A policy stays dirty if it
+    was marked again while it was being evaluated, as its entry may be
+    stale.
+    """
+    for cancellation in cancellations:
+        db.session.add(cancellation)
+    if entries:
+        db.session.execute(
+            "UPDATE cancellation_schedule"
+            " SET dirty = 0, next_event = :next_event, pending = :pending"
+            " WHERE policy_id = :policy_id AND generation = :generation",
+            entries
+        )
+    touch_policies([cancellation.policy_id for cancellation in cancellations])
+    db.session.commit()
+
+    for cancellation in cancellations:
+        policy_cache.invalidate(cancellation.policy_id)
+
+def run_cancellation_schedule(date_cursor=None, low=None, high=None, batch_size=500):
+    """
+    Cancels the policies which should be cancelled as of date_cursor, like
+    sweep_cancellations, but only evaluates the policies due for it in the
+    schedule.  Returns the PolicyCancellation objects created and the
+    number of policies evaluated.
+    """
+    scheduled = find_scheduled(date_cursor, low, high)
+    cancellations, entries = evaluate_schedule(scheduled, date_cursor, batch_size)
+    save_schedule(cancellations, entries)
+    return cancellations, len(entries)
+
+def scheduled_pending(low=None, high=None):
+    """
+    Returns the ids of the policies with an invoice past due as of their
+    last evaluation, which after a scheduled run is the same as
+    pending_cancellation_due_to_non_pay for that run's date.
+    """
+    query = db.session.query(CancellationSchedule.policy_id)\
+                      .filter(CancellationSchedule.pending == True)
+    if low is not None:
+        query = query.filter(CancellationSchedule.policy_id >= low)
+    if high is not None:
+        query = query.filter(CancellationSchedule.policy_id < high)
+    return set(row.policy_id for row in query)
+
+def rebuild_cancellation_schedule():
+    """
+    Marks every policy dirty, adding those missing to the schedule, so the
+    next scheduled run evaluates the whole book.  This is the migration
+    path for databases created before the schedule existed, once
+    db.create_all() has created its table.
+    """
+    for chunk in _chunks([row.id for row in db.session.query(Policy.id)], 5000):
+        mark_dirty(chunk)
+    db.session.commit()
+
+
+"""
+#######################################################
+Book reporting.
+#######################################################
+"""
+
+# Columns a book snapshot can be broken down by
+snapshot_groupings = ('agent', 'billing_schedule')
+
+def book_snapshot(date_cursor=None, group_by=None, session=None):
+    """
+    Returns a query for the balance of every policy in effect on
+    date_cursor, or billed or paid by then, as return_account_balance would
+    compute it: the non-deleted invoices billed up to date_cursor minus the
+    payments made up to it.
+
+    Each row holds policy_id, policy_number, billing_schedule, agent,
+    billed, paid and balance, in policy id order.  With group_by set to one
+    of snapshot_groupings the totals are broken down by agent (agent,
+    agent_name) or by billing_schedule instead, with the number of policies
+    in each group.  Raises a ValueError for any other group_by.
+
+    Invoices and payments are summed per policy by two grouped subqueries,
+    both answered from covering indexes, so the whole book is reported on
+    with a single statement.  session defaults to db.session.
+    """
+    if group_by is not None and group_by not in snapshot_groupings:
+        raise ValueError("group_by must be one of: {}".format(snapshot_groupings))
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    session = session or db.session
+
+    billed = session.query(Invoice.policy_id.label('policy_id'),
+                           db.func.sum(Invoice.amount_due).label('amount'))\
+                    .filter(Invoice.bill_date <= date_cursor)\
+                    .filter(Invoice.deleted == False)\
+                    .group_by(Invoice.policy_id)\
+                    .subquery()
+    paid = session.query(Payment.policy_id.label('policy_id'),
+                         db.func.sum(Payment.amount_paid).label('amount'))\
+                  .filter(Payment.transaction_date <= date_cursor)\
+                  .group_by(Payment.policy_id)\
+                  .subquery()
+    billed_amount = db.func.coalesce(billed.c.amount, 0)
+    paid_amount = db.func.coalesce(paid.c.amount, 0)
+
+    if group_by is None:
+        query = session.query(Policy.id.label('policy_id'),
+                              Policy.policy_number,
+                              Policy.billing_schedule,
+                              Policy.agent,
+                              billed_amount.label('billed'),
+                              paid_amount.label('paid'),
+                              (billed_amount - paid_amount).label('balance'))\
+                       .order_by(Policy.id)
+    else:
+        totals = [db.func.count(Policy.id).label('policies'),
+                  db.func.sum(billed_amount).label('billed'),
+                  db.func.sum(paid_amount).label('paid'),
+                  db.func.sum(billed_amount - paid_amount).label('balance')]
+        if group_by == 'agent':
+            query = session.query(Policy.agent, Contact.name.label('agent_name'), *totals)\
+                           .outerjoin(Contact, Contact.id == Policy.agent)\
+                           .group_by(Policy.agent, Contact.name)\
+                           .order_by(Policy.agent)
+        else:
+            query = session.query(Policy.billing_schedule, *totals)\
+                           .group_by(Policy.billing_schedule)\
+                           .order_by(Policy.billing_schedule)
+
+    # Policies taking effect later are kept if they were already billed or
+    # paid, e.g. when paid ahead of time.
+    return query.outerjoin(billed, billed.c.policy_id == Policy.id)\
+                .outerjoin(paid, paid.c.policy_id == Policy.id)\
+                .filter(db.or_(Policy.effective_date <= date_cursor,
+                               billed.c.policy_id != None,
+                               paid.c.policy_id != None))
 
 
 ################################
@@ -276,8 +1422,104 @@ def build_or_refresh_db():
     db.drop_all()
     db.create_all()
     insert_data()
+    rebuild_ledger()
     print "DB Ready!"
 
+# The columns holding money amounts, by table
+money_columns = [
+    ('policies', ['annual_premium']),
+    ('invoices', ['amount_due']),
+    ('invoices_archive', ['amount_due']),
+    ('payments', ['amount_paid']),
+    ('ledger_entries', ['amount', 'balance']),
+]
+
+def migrate_money_to_cents(bind=None):
+    """
+    Converts the money amounts of a database created when they were stored
+    in whole dollars to cents, and returns whether it did.  The conversion
+    and the new user_version are committed together, so the migration can
+    safely be run again: databases already in cents, including any whose
+    schema was created since, are left alone.
+
+    Amounts are converted as they are, invoices which lost odd cents to
+    the old integer division are not made up for.
+    """
+    bind = bind or db.engine
+    connection = bind.raw_connection()
+    sqlite = connection.connection
+    isolation_level = sqlite.isolation_level
+    # pysqlite commits any open transaction before a PRAGMA, so the
+    # transaction is managed by hand to cover the version update.
+    sqlite.isolation_level = None
+    try:
+        cursor = sqlite.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if version >= MONEY_IN_CENTS_VERSION:
+                cursor.execute("ROLLBACK")
+                return False
+            tables = set(row[0] for row in cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))
+            for table, columns in money_columns:
+                if table in tables:
+                    cursor.execute("UPDATE {} SET {}".format(table, ', '.join(
+                        '{0} = {0} * 100'.format(column) for column in columns)))
+            cursor.execute("PRAGMA user_version = {:d}".format(MONEY_IN_CENTS_VERSION))
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        sqlite.isolation_level = isolation_level
+        connection.close()
+
+    policy_cache.clear()
+    return True
+
+def create_missing_indexes(bind=None):
+    """
+    Brings the indexes of an existing database up to date with the ones
+    declared on the models.  db.create_all() only creates missing tables, so
+    databases created before an index was declared need this to pick it up.
+    Returns the names of the indexes created.
+    """
+    bind = bind or db.engine
+    existing = set(
+        row[0] for row in
+        bind.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    )
+
+    created = []
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=bind)
+                created.append(index.name)
+
+    # Refresh the planner's statistics so it prefers the new indexes.
+    if created:
+        bind.execute("ANALYZE")
+    return created
+
+def rebuild_search_index(bind=None):
+    """
+    Creates the policy_search full-text index and its triggers if they are
+    missing, then refills it from the policies and contacts tables.  This is
+    the migration path for databases created before the index existed.
+    """
+    bind = bind or db.engine
+    for statement in policy_search_ddl:
+        bind.execute(statement)
+    bind.execute("DELETE FROM policy_search")
+    bind.execute(
+        "INSERT INTO policy_search(rowid, policy_number, insured_name)"
+        " SELECT policies.id, policies.policy_number, COALESCE(contacts.name, '')"
+        " FROM policies LEFT OUTER JOIN contacts"
+        " ON contacts.id = policies.named_insured"
+    )
+
 def insert_data():
     #Contacts
     contacts = []
@@ -300,25 +1542,26 @@ def insert_data():
         db.session.add(contact)
     db.session.commit()
 
+    #Policies, with their premiums in cents
     policies = []
-    p1 = Policy('Policy One', date(2015, 1, 1), 365)
+    p1 = Policy('Policy One', date(2015, 1, 1), 36500)
     p1.billing_schedule = 'Annual'
     p1.agent = bob_smith.id
     policies.append(p1)
 
-    p2 = Policy('Policy Two', date(2015, 2, 1), 1600)
+    p2 = Policy('Policy Two', date(2015, 2, 1), 160000)
     p2.billing_schedule = 'Quarterly'
     p2.named_insured = anna_white.id
     p2.agent = joe_lee.id
     policies.append(p2)
 
-    p3 = Policy('Policy Three', date(2015, 1, 1), 1200)
+    p3 = Policy('Policy Three', date(2015, 1, 1), 120000)
     p3.billing_schedule = 'Monthly'
     p3.named_insured = ryan_bucket.id
     p3.agent = john_doe_agent.id
     policies.append(p3)
 
-    p4 = Policy("Policy Four", date(2015, 2, 1), 500)
+    p4 = Policy("Policy Four", date(2015, 2, 1), 50000)
     p4.billing_schedule = 'Two-Pay'
     p4.named_insured = ryan_bucket.id
     p4.agent = john_doe_agent.id
@@ -331,7 +1574,7 @@ def insert_data():
     for policy in policies:
         PolicyAccounting(policy.id)
 
-    payment_for_p2 = Payment(p2.id, anna_white.id, 400, date(2015, 2, 1))
+    payment_for_p2 = Payment(p2.id, anna_white.id, 40000, date(2015, 2, 1))
     db.session.add(payment_for_p2)
     db.session.commit()
 
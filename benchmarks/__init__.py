@@ -0,0 +1,4 @@
+"""
+Benchmarks for the accounting hot paths.  Run them from the root of the
+repository, e.g. python -m benchmarks.query_plans
+"""
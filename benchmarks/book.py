@@ -0,0 +1,127 @@
+"""
+Generates a synthetic book of business, for benchmarks that need realistic
+volumes rather than the four policies of insert_data.
+"""
+import random
+from datetime import date, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from accounting import db
+from accounting.models import Contact, Invoice, LedgerEntry, Payment, Policy
+from accounting.utils import bulk_make_invoices
+
+FIRST_NAMES = ['Anna', 'Bob', 'Carla', 'David', 'Emma', 'Frank', 'Grace', 'Henry',
+               'Irene', 'John', 'Karen', 'Louis', 'Mary', 'Nathan', 'Olivia', 'Peter']
+LAST_NAMES = ['White', 'Smith', 'Doe', 'Lee', 'Bucket', 'Brown', 'Garcia', 'Miller',
+              'Davis', 'Lopez', 'Wilson', 'Moore', 'Taylor', 'Thomas', 'Martin', 'Clark']
+
+# Billing schedules and how often they occur in a book by default
+DEFAULT_SCHEDULE_MIX = {'Annual': 0.3, 'Two-Pay': 0.1, 'Quarterly': 0.3, 'Monthly': 0.3}
+
+
+def parse_schedule_mix(value):
+    """
+    Parses a schedule mix such as "Monthly=0.5,Annual=0.5" into a dict.
+    """
+    mix = {}
+    for item in value.split(','):
+        schedule, weight = item.split('=')
+        mix[schedule.strip()] = float(weight)
+    return mix
+
+
+def generate_book(policies=10000, contacts=2000, payment_density=0.8,
+                  schedule_mix=None, uninvoiced=0, start=date(2015, 1, 1), seed=0):
+    """
+    Fills the current database with a synthetic book and returns the ids
+    of its policies.
+
+    One contact in ten is an agent, the others are named insureds.  Policies
+    take effect on a random day of the year from start, with a billing
+    schedule drawn from schedule_mix, a {schedule: weight} dict.  Their
+    invoices are generated the way PolicyAccounting would, except for the
+    last uninvoiced policies which are left without any.  Each installment
+    is paid in full with probability payment_density, on a random day up to
+    six weeks after it is billed, so the book holds paid, late and past due
+    policies.  The ledger is written to match.
+    """
+    rng = random.Random(seed)
+    schedule_mix = schedule_mix or DEFAULT_SCHEDULE_MIX
+    schedules = sorted(schedule_mix)
+    weights = [schedule_mix[schedule] for schedule in schedules]
+
+    def pick_schedule():
+        point = rng.uniform(0, sum(weights))
+        for schedule, weight in zip(schedules, weights):
+            point -= weight
+            if point <= 0:
+                return schedule
+        return schedules[-1]
+
+    db.create_all()
+
+    db.session.execute(Contact.__table__.insert(), [
+        {'name': '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+         'role': 'Agent' if i % 10 == 0 else 'Named Insured'}
+        for i in range(contacts)
+    ])
+    agents = [row.id for row in db.session.query(Contact.id).filter(Contact.role == 'Agent')]
+    insureds = [row.id for row in
+                db.session.query(Contact.id).filter(Contact.role == 'Named Insured')]
+
+    first = (db.session.query(db.func.max(Policy.id)).scalar() or 0) + 1
+    rows = [
+        {'policy_number': 'Policy {:07d}'.format(first + i),
+         'effective_date': start + timedelta(days=rng.randint(0, 364)),
+         'status': 'Active',
+         'billing_schedule': pick_schedule(),
+         'annual_premium': rng.choice([60000, 120000, 180000, 240000, 360000, 99999]),
+         'named_insured': rng.choice(insureds),
+         'agent': rng.choice(agents)}
+        for i in range(policies)
+    ]
+    db.session.execute(Policy.__table__.insert(), rows)
+    db.session.commit()
+
+    book = db.session.query(Policy.id, Policy.effective_date, Policy.billing_schedule,
+                            Policy.annual_premium, Policy.named_insured)\
+                     .filter(Policy.id >= first)\
+                     .order_by(Policy.id)\
+                     .all()
+    invoiced = book[:len(book) - uninvoiced]
+    bulk_make_invoices(tuple(policy)[:4] for policy in invoiced)
+
+    named_insureds = dict((policy.id, policy.named_insured) for policy in invoiced)
+    payments = []
+    for invoice in db.session.query(Invoice.policy_id, Invoice.bill_date, Invoice.amount_due)\
+                             .filter(Invoice.policy_id >= first):
+        if rng.random() < payment_density:
+            payments.append({'policy_id': invoice.policy_id,
+                             'contact_id': named_insureds[invoice.policy_id],
+                             'amount_paid': invoice.amount_due,
+                             'transaction_date': invoice.bill_date +
+                                                 timedelta(days=rng.randint(0, 42))})
+    if payments:
+        db.session.execute(Payment.__table__.insert(), payments)
+
+    # bulk_make_invoices only ledgered the invoices, so the ledger of the
+    # new policies is written again with their payments.
+    deltas = [(row.policy_id, row.bill_date, row.amount_due) for row in
+              db.session.query(Invoice.policy_id, Invoice.bill_date, Invoice.amount_due)
+                        .filter(Invoice.policy_id >= first)]
+    deltas += [(p['policy_id'], p['transaction_date'], -p['amount_paid']) for p in payments]
+    deltas.sort()
+    entries = []
+    for policy_id, policy_deltas in groupby(deltas, key=itemgetter(0)):
+        balance = 0
+        for _, entry_date, amount in policy_deltas:
+            balance += amount
+            entries.append({'policy_id': policy_id, 'entry_date': entry_date,
+                            'amount': amount, 'balance': balance})
+    LedgerEntry.query.filter(LedgerEntry.policy_id >= first).delete(synchronize_session=False)
+    if entries:
+        db.session.execute(LedgerEntry.__table__.insert(), entries)
+    db.session.commit()
+
+    return [policy.id for policy in book]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Runs make_payment writers alongside /policies/<id>/invoices readers in
+threads, once with SQLite's defaults (rollback journal, no pool, no busy
+timeout) and once with the engine settings from accounting/config.py, and
+reports latencies, throughput and errors for both.
+
+The benchmark builds its own throwaway databases and never touches
+accounting.sqlite.  The policy cache is disabled so every read hits the
+database.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date
+
+from accounting import app, db
+from accounting.cache import policy_cache
+from accounting.models import Contact, Policy
+from accounting.utils import PolicyAccounting, bulk_make_invoices
+
+
+def populate(policies):
+    db.create_all()
+    contact = Contact('Benchmark Insured', 'Named Insured')
+    db.session.add(contact)
+    db.session.commit()
+
+    db.session.execute(Policy.__table__.insert(), [
+        {'policy_number': 'Policy %d' % i,
+         'effective_date': date(2015, 1, 1),
+         'status': 'Active',
+         'billing_schedule': 'Monthly',
+         'annual_premium': 1200,
+         'named_insured': contact.id}
+        for i in range(policies)
+    ])
+    db.session.commit()
+    bulk_make_invoices((row.id, date(2015, 1, 1), 'Monthly', 1200)
+                       for row in db.session.query(Policy.id))
+
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return 0.0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def run(policies, writers, readers, operations):
+    results = {'write': [], 'read': [], 'errors': []}
+    lock = threading.Lock()
+
+    def record(kind, elapsed=None, error=None):
+        with lock:
+            if error is not None:
+                results['errors'].append(error)
+            else:
+                results[kind].append(elapsed)
+
+    def writer():
+        for _ in range(operations):
+            policy_id = random.randint(1, policies)
+            start = time.time()
+            try:
+                pa = PolicyAccounting(policy_id)
+                pa.make_payment(date_cursor=date(2015, 3, 1), amount=10)
+                record('write', time.time() - start)
+            except Exception as e:
+                db.session.rollback()
+                record('write', error=str(e).split('\n')[0])
+        db.session.remove()
+
+    def reader():
+        client = app.test_client()
+        for _ in range(operations):
+            policy_id = random.randint(1, policies)
+            start = time.time()
+            response = client.get('/policies/%d/invoices?date=2015-12-31' % policy_id)
+            # Read the whole streamed body, and close the response so the
+            # request context is torn down in this thread.
+            response.data
+            response.close()
+            if response.status_code == 200:
+                record('read', time.time() - start)
+            else:
+                record('read', error='HTTP %d' % response.status_code)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results['elapsed'] = time.time() - start
+    return results
+
+
+def report(name, results):
+    print "%s (%.2f s):" % (name, results['elapsed'])
+    for kind in ['write', 'read']:
+        latencies = results[kind]
+        print "  %-5s %5d ok  %7.1f/s  p50 %6.1f ms  p99 %6.1f ms" % (
+            kind, len(latencies), len(latencies) / results['elapsed'],
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+    errors = results['errors']
+    print "  errors %d%s" % (len(errors), (": " + errors[0]) if errors else "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--policies', type=int, default=2000)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=200,
+                        help='operations per thread')
+    args = parser.parse_args()
+
+    policy_cache.max_size = 0
+    tuned = dict((key, app.config[key]) for key in
+                 ['SQLITE_PRAGMAS', 'SQLALCHEMY_POOL_SIZE', 'SQLALCHEMY_MAX_OVERFLOW'])
+    configurations = [
+        ('SQLite defaults', {'SQLITE_PRAGMAS': [],
+                             'SQLALCHEMY_POOL_SIZE': None,
+                             'SQLALCHEMY_MAX_OVERFLOW': None}),
+        ('Configured engine', tuned),
+    ]
+
+    for name, config in configurations:
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            # A new database URI makes the extension create new engines,
+            # picking up the configuration below.
+            app.config.update(config)
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+            random.seed(0)
+            populate(args.policies)
+            db.session.remove()
+            report(name, run(args.policies, args.writers, args.readers, args.operations))
+        finally:
+            db.session.remove()
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+
+if __name__ == "__main__":
+    main()
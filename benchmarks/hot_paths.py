@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Times the accounting hot paths against a synthetic book: invoice generation,
+balances, cancellation checks, billing schedule changes and the search,
+invoices and payments endpoints.  Prints the results as JSON, and with
+--compare reports how they moved against an earlier run's output.
+
+The benchmark builds its own throwaway database and never touches
+accounting.sqlite.  The policy cache is disabled unless --cache is given, so
+every call hits the database.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+
+from accounting import app, db
+from accounting.cache import policy_cache
+from accounting.models import Policy
+from accounting.utils import PolicyAccounting, ReadOnlyPolicyAccounting
+
+from benchmarks.book import DEFAULT_SCHEDULE_MIX, FIRST_NAMES, generate_book, \
+    parse_schedule_mix
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return OrderedDict([
+        ('samples', count),
+        ('mean_ms', sum(latencies) * 1000 / count),
+        ('p50_ms', latencies[count / 2] * 1000),
+        ('p95_ms', latencies[min(count - 1, int(count * 0.95))] * 1000),
+        ('max_ms', latencies[-1] * 1000),
+    ])
+
+
+def timed(function, arguments):
+    """
+    Calls function once with each tuple of arguments and returns the
+    latency of every call.
+    """
+    latencies = []
+    for args in arguments:
+        start = time.time()
+        function(*args)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def get(client, url):
+    response = client.get(url)
+    # Read the whole streamed body before the clock stops
+    response.data
+    response.close()
+    if response.status_code != 200:
+        raise RuntimeError("GET {} returned {}".format(url, response.status_code))
+
+
+def run(invoiced, uninvoiced, samples, rng):
+    """
+    Runs every benchmark and returns their latencies by name.  The read
+    only benchmarks go first, as the others change the book.
+    """
+    client = app.test_client()
+
+    def dates():
+        return date(2015, 1, 1) + timedelta(days=rng.randint(0, 729))
+
+    def policies():
+        return [rng.choice(invoiced) for _ in range(samples)]
+
+    def balance(policy_id, date_cursor):
+        ReadOnlyPolicyAccounting(policy_id).return_account_balance(date_cursor)
+
+    def evaluate_cancel(policy_id, date_cursor):
+        PolicyAccounting(policy_id).evaluate_cancel(date_cursor)
+
+    def change_billing_schedule(policy_id, billing_schedule, date_cursor):
+        PolicyAccounting(policy_id).change_billing_schedule(billing_schedule, date_cursor)
+
+    # The schedules a policy can be stored with
+    schedules = sorted(Policy.__table__.c.billing_schedule.type.enums)
+    results = OrderedDict()
+    results['return_account_balance'] = timed(
+        balance, [(p, dates()) for p in policies()])
+    results['GET /policies/search'] = timed(
+        get, [(client, '/policies/search?query=' + rng.choice(FIRST_NAMES).lower())
+              for _ in range(samples)])
+    results['GET /policies/<id>/invoices'] = timed(
+        get, [(client, '/policies/{}/invoices?date={}'.format(p, dates())) for p in policies()])
+    results['GET /policies/<id>/payments'] = timed(
+        get, [(client, '/policies/{}/payments'.format(p)) for p in policies()])
+    # PolicyAccounting makes the invoices of policies which have none
+    results['make_invoices'] = timed(PolicyAccounting, [(p,) for p in uninvoiced])
+    results['evaluate_cancel'] = timed(
+        evaluate_cancel, [(p, dates()) for p in policies()])
+    results['change_billing_schedule'] = timed(
+        change_billing_schedule, [(p, rng.choice(schedules), dates()) for p in policies()])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each benchmark's mean against the baseline's to stderr and
+    returns the names of those which got slower by more than threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        ratio = result['mean_ms'] / before['mean_ms'] if before['mean_ms'] else 0.0
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print >> sys.stderr, "%-30s %9.3f ms -> %9.3f ms  %5.2fx%s" % (
+            name, before['mean_ms'], result['mean_ms'], ratio, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--policies', type=int, default=10000)
+    parser.add_argument('--contacts', type=int, default=2000)
+    parser.add_argument('--payment-density', type=float, default=0.8,
+                        help='share of installments paid')
+    parser.add_argument('--schedule-mix', type=parse_schedule_mix,
+                        default=DEFAULT_SCHEDULE_MIX,
+                        help='e.g. Monthly=0.5,Quarterly=0.3,Annual=0.2')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='calls timed per benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the policy cache enabled')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    parser.add_argument('--compare', type=argparse.FileType('r'),
+                        help='JSON output of an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    if not args.cache:
+        policy_cache.max_size = 0
+
+    handle, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(handle)
+    try:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        start = time.time()
+        policy_ids = generate_book(args.policies, args.contacts, args.payment_density,
+                                   args.schedule_mix, uninvoiced=args.samples,
+                                   seed=args.seed)
+        setup = time.time() - start
+        db.session.remove()
+
+        invoiced, uninvoiced = policy_ids[:-args.samples], policy_ids[-args.samples:]
+        latencies = run(invoiced, uninvoiced, args.samples, random.Random(args.seed))
+    finally:
+        db.session.remove()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    results = OrderedDict((name, summarize(l)) for name, l in latencies.items())
+    output = OrderedDict([
+        ('config', OrderedDict([
+            ('policies', args.policies),
+            ('contacts', args.contacts),
+            ('payment_density', args.payment_density),
+            ('schedule_mix', args.schedule_mix),
+            ('samples', args.samples),
+            ('seed', args.seed),
+            ('cache', args.cache),
+        ])),
+        ('setup_s', setup),
+        ('results', results),
+    ])
+    json.dump(output, args.output, indent=2)
+    args.output.write('\n')
+
+    if args.compare:
+        regressions = compare(results, json.load(args.compare), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
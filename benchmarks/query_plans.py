@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Shows the SQLite query plans and timings of the invoice and payment lookups
+made by PolicyAccounting and the endpoints, before and after the indexes
+declared on the models are created.
+
+The benchmark builds its own throwaway database and never touches
+accounting.sqlite.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from accounting import db
+from accounting.models import Invoice, Payment
+
+
+def populate(engine, policies):
+    """
+    Inserts policies with a year of monthly invoices each (half of them
+    with a deleted earlier schedule) and a few payments.
+    """
+    db.metadata.create_all(engine)
+    start = date(2015, 1, 1)
+    invoices = []
+    payments = []
+    for policy_id in range(1, policies + 1):
+        effective = start + timedelta(days=policy_id % 365)
+        schedules = [True, False] if policy_id % 2 else [False]
+        for deleted in schedules:
+            for month in range(12):
+                bill_date = effective + timedelta(days=30 * month)
+                invoices.append({'policy_id': policy_id,
+                                 'bill_date': bill_date,
+                                 'due_date': bill_date + timedelta(days=30),
+                                 'cancel_date': bill_date + timedelta(days=44),
+                                 'amount_due': 100,
+                                 'deleted': deleted})
+        for month in range(random.randint(0, 12)):
+            payments.append({'policy_id': policy_id,
+                             'contact_id': 1,
+                             'amount_paid': 100,
+                             'transaction_date': effective + timedelta(days=30 * month + 10)})
+    engine.execute(Invoice.__table__.insert(), invoices)
+    engine.execute(Payment.__table__.insert(), payments)
+
+
+def drop_indexes(engine):
+    for table in (Invoice.__table__, Payment.__table__):
+        for index in table.indexes:
+            engine.execute("DROP INDEX IF EXISTS %s" % index.name)
+
+
+def create_indexes(engine):
+    for table in (Invoice.__table__, Payment.__table__):
+        for index in table.indexes:
+            index.create(bind=engine)
+    engine.execute("ANALYZE")
+
+
+def queries(session, policy_id, date_cursor):
+    """
+    The query shapes used by PolicyAccounting and the endpoints.
+    """
+    return [
+        ('invoices by bill_date',
+         session.query(Invoice).filter_by(policy_id=policy_id)
+                               .filter(Invoice.bill_date <= date_cursor)
+                               .filter(Invoice.deleted == False)
+                               .order_by(Invoice.bill_date)),
+        ('invoices by due_date',
+         session.query(Invoice).filter_by(policy_id=policy_id)
+                               .filter(Invoice.due_date <= date_cursor)
+                               .filter(Invoice.deleted == False)
+                               .order_by(Invoice.bill_date)),
+        ('invoices by cancel_date',
+         session.query(Invoice).filter_by(policy_id=policy_id)
+                               .filter(Invoice.cancel_date <= date_cursor)
+                               .filter(Invoice.deleted == False)
+                               .order_by(Invoice.bill_date)),
+        ('payments by transaction_date',
+         session.query(Payment).filter_by(policy_id=policy_id)
+                               .filter(Payment.transaction_date <= date_cursor)
+                               .order_by(Payment.transaction_date)),
+    ]
+
+
+def explain(engine, query):
+    compiled = query.statement.compile(bind=engine)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    rows = engine.execute("EXPLAIN QUERY PLAN " + str(compiled), *params)
+    return [list(row)[-1] for row in rows]
+
+
+def report(engine, session, policies, repeat):
+    date_cursor = date(2015, 7, 1)
+    for name, query in queries(session, 1, date_cursor):
+        print "  %s" % name
+        for step in explain(engine, query):
+            print "    plan: %s" % step
+
+        policy_ids = [random.randint(1, policies) for _ in range(repeat)]
+        start = time.time()
+        for policy_id in policy_ids:
+            for other_name, other in queries(session, policy_id, date_cursor):
+                if other_name == name:
+                    other.all()
+        elapsed = time.time() - start
+        print "    %.3f ms per query" % (elapsed * 1000.0 / repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--policies', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(0)
+    handle, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(handle)
+    try:
+        engine = create_engine('sqlite:///' + path)
+        session = sessionmaker(bind=engine)()
+        populate(engine, args.policies)
+
+        drop_indexes(engine)
+        print "Before (primary keys only):"
+        report(engine, session, args.policies, args.repeat)
+
+        create_indexes(engine)
+        print "After (model indexes):"
+        report(engine, session, args.policies, args.repeat)
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Compares serializing invoices by loading Invoice objects and calling
+to_dict() on each with selecting plain row tuples and encoding them with
+Invoice.row_encoder().
+
+The benchmark builds its own throwaway database and never touches
+accounting.sqlite.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from accounting import db
+from accounting.models import Invoice
+
+
+def populate(engine, rows):
+    db.metadata.create_all(engine)
+    start = date(2015, 1, 1)
+    invoices = []
+    for i in range(rows):
+        bill_date = start + timedelta(days=i % 365)
+        invoices.append({'policy_id': i / 12 + 1,
+                         'bill_date': bill_date,
+                         'due_date': bill_date + timedelta(days=30),
+                         'cancel_date': bill_date + timedelta(days=44),
+                         'amount_due': 100,
+                         'deleted': False})
+    engine.execute(Invoice.__table__.insert(), invoices)
+
+
+def objects_to_dict(session):
+    invoices = session.query(Invoice).all()
+    return json.dumps([i.to_dict() for i in invoices], default=str)
+
+
+def rows_to_encoder(session):
+    encode = Invoice.row_encoder()
+    rows = session.query(*Invoice.serializable_columns()).all()
+    return '[' + ','.join(encode(row) for row in rows) + ']'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    handle, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(handle)
+    try:
+        engine = create_engine('sqlite:///' + path)
+        populate(engine, args.rows)
+
+        print "Serializing %d invoices (best of %d):" % (args.rows, args.repeat)
+        for name, serialize in [('objects + to_dict', objects_to_dict),
+                                ('row tuples + row_encoder', rows_to_encoder)]:
+            best = None
+            for _ in range(args.repeat):
+                # A fresh session each time, so no run benefits from objects
+                # already in the identity map.
+                session = sessionmaker(bind=engine)()
+                start = time.time()
+                output = serialize(session)
+                elapsed = time.time() - start
+                session.close()
+                best = elapsed if best is None else min(best, elapsed)
+            print "  %-26s %.3f s  (%d bytes)" % (name, best, len(output))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
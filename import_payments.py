@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+"""
+Imports payments from a CSV file, such as a bank lockbox file, with a header
+row naming the policy_id, contact_id, amount and date columns.
+"""
+import argparse
+import sys
+
+from accounting.utils import import_payments_csv
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('csv_file', type=argparse.FileType('rb'))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    report = import_payments_csv(args.csv_file, batch_size=args.batch_size)
+
+    print "Imported {} payments in {:.2f}s ({:.0f} rows/s)".format(
+        report.imported, report.elapsed, report.throughput)
+    for row_number, row, reason in report.rejected:
+        print "Rejected row {}: {} ({})".format(row_number, ','.join(map(str, row)), reason)
+    sys.exit(1 if report.rejected else 0)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Runs the nightly billing work: records queued payments, invoices policies
+which have none, lists the policies with a past due invoice and cancels
+those past their cancel date.  Policy ids are split into ranges which are
+processed by a pool of worker processes.  Deleted invoices can then be
+archived.
+"""
+import argparse
+import sys
+from datetime import timedelta
+
+from dateutil.parser import parse as date_parse
+
+from accounting.batch import run_nightly
+from accounting.utils import archive_deleted_invoices
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--date', type=lambda value: date_parse(value).date(),
+                        help='date to run for, today by default')
+    parser.add_argument('--workers', type=int, help='one per CPU by default')
+    parser.add_argument('--shards', type=int, help='four per worker by default')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only evaluate the policies which changed or reached a due '
+                             'or cancel date since the last incremental run')
+    parser.add_argument('--archive-after', type=int, metavar='DAYS',
+                        help='archive deleted invoices billed more than DAYS days ago')
+    args = parser.parse_args()
+
+    report = run_nightly(args.date, workers=args.workers, shards=args.shards,
+                         batch_size=args.batch_size, incremental=args.incremental)
+
+    print "Nightly run for {}: {} policies in {} shards, {:.2f}s ({:.1f} shards at once)".format(
+        report.date_cursor, report.policies, report.shards, report.elapsed, report.parallelism)
+    print "Recorded {} queued payments".format(report.flushed)
+    print "Invoiced {} policies ({} invoices)".format(
+        len(report.invoiced_policies), report.invoiced)
+    print "Evaluated {} policies for cancellation".format(report.evaluated)
+    print "Pending cancellation due to non-payment: {}".format(
+        ', '.join(map(str, report.pending)) or 'none')
+    for policy_id, date in report.cancelled:
+        print "Cancelled policy {} as of {}".format(policy_id, date)
+    for (low, high), error in report.errors:
+        print "Failed on policies {} to {}:\n{}".format(low, high - 1, error)
+
+    if args.archive_after is not None:
+        archived = archive_deleted_invoices(report.date_cursor - timedelta(days=args.archive_after))
+        print "Archived {} deleted invoices".format(archived)
+    sys.exit(1 if report.errors else 0)
@@ -1,5 +1,19 @@
 #!/usr/bin/env python
+from datetime import date, timedelta
+
 from accounting import app
+from accounting.assets import static_assets
+from accounting.payment_queue import payment_queue
+from accounting.utils import billing_calendar
 
 if __name__ == "__main__":
+    # Policies in force took effect within the last year, and new ones
+    # mostly take effect within the next few months.
+    today = date.today()
+    billing_calendar.warm(today - timedelta(days=366), today + timedelta(days=90))
+    # Hash and gzip the static files before the first page asks for them
+    static_assets.build()
+    # Flush whatever the last run left in the payment queue
+    if app.config['PAYMENT_QUEUE_ENABLED']:
+        payment_queue.start()
     app.run(debug=True, host='0.0.0.0')